@@ -1,9 +1,14 @@
 from xscontainer import util
 from xscontainer.util import log
+from xscontainer.util import metrics
 
+import collections
+import copy
+import hashlib
 import os
 import tempfile
 import threading
+import time
 import XenAPI
 
 XSCONTAINER_PRIVATE_SECRET_UUID = 'xscontainer-private-secret-uuid'
@@ -16,6 +21,19 @@ NULLREF = 'OpaqueRef:NULL'
 
 GLOBAL_XAPI_SESSION = None
 GLOBAL_XAPI_SESSION_LOCK = threading.Lock()
+# The INSTALLATION_UUID of /etc/xensource-inventory, once read
+THIS_HOST_UUID = None
+
+# The classes that RECORD_CACHE keeps, as they are named in XAPI events
+RECORD_CACHE_CLASSES = ['vm', 'host', 'network', 'pool']
+# The classes that RecordCache.load fetches with the event token. There is
+# one pool record, so the token doesn't get more costly with the pool size.
+RECORD_CACHE_LOAD_CLASSES = ['pool']
+# How long plugin processes use the records they fetched
+PLUGIN_RECORD_CACHE_TTL_S = 5
+# How many of the values that we wrote to a key of other_config are known
+# as ours, when an event shows one of them after we wrote the next
+WRITTEN_DIGESTS_KEPT = 8
 
 
 def refresh_session_on_failure(func):
@@ -49,6 +67,12 @@ class XenAPIClient(object):
     def get_all_vm_records(self):
         return self.get_session().xenapi.VM.get_all_records()
 
+    def get_vm_records_where(self, expression):
+        """ Returns the records of the VMs that match expression, which XAPI
+            evaluates on its side """
+        return RECORD_CACHE.get_records_where(self.get_session(), 'VM',
+                                              expression)
+
     @refresh_session_on_failure
     def api_call(self, object_name, method, *args):
         method_args = (self.get_session_handle(),) + args
@@ -88,6 +112,8 @@ class XenAPIObject(object):
 
         self.client = client
 
+        if uuid and not ref:
+            ref = RECORD_CACHE.lookup_ref(self.OBJECT, uuid)
         if uuid and not ref:
             ref = self.client.api_call(self.OBJECT, "get_by_uuid", uuid)
 
@@ -113,7 +139,9 @@ class XenAPIObject(object):
         return XenAPI._parse_result(res)
 
     def remove_from_other_config(self, key):
-        return self.api_call("remove_from_other_config", key)
+        result = self.api_call("remove_from_other_config", key)
+        RECORD_CACHE.update_map(self.OBJECT, self.ref, 'other_config', key)
+        return result
 
 
 class Host(XenAPIObject):
@@ -127,19 +155,84 @@ class VM(XenAPIObject):
 
     def get_uuid(self):
         if self.uuid is None:
-            self.uuid = self.get_session().xenapi.VM.get_uuid(self.ref)
+            self.uuid = RECORD_CACHE.get_field(self.get_session(), 'VM',
+                                               self.ref, 'uuid')
         return self.uuid
 
     def get_other_config(self):
-        return self.client.get_session().xenapi.VM.get_other_config(self.ref)
+        return RECORD_CACHE.get_field(self.client.get_session(), 'VM',
+                                      self.ref, 'other_config')
+
+    # _written_digests[key] = digest of the value we last wrote
+    _written_digests = None
+    # _recent_digests[key] = deque of the digests of the values we wrote
+    _recent_digests = None
+    other_config_writes = 0
+    other_config_writes_skipped = 0
 
     def update_other_config(self, key, value):
-        # session.xenapi.VM.remove_from_other_config(vmref, name)
-        # session.xenapi.VM.add_to_other_config(vmref, name, value)
-        other_config = self.get_other_config()
-        other_config[key] = value
-        self.client.get_session().xenapi.VM.set_other_config(self.ref,
-                                                             other_config)
+        # Only touch this key - set_other_config would rewrite the whole map
+        # and race with writers of other keys
+        with metrics.Timer('xscontainer_xapi_write_seconds',
+                           {'vm': self.get_uuid()}):
+            self.api_call("remove_from_other_config", key)
+            self.api_call("add_to_other_config", key, value)
+        RECORD_CACHE.update_map(self.OBJECT, self.ref, 'other_config', key,
+                                value)
+        self.other_config_writes = self.other_config_writes + 1
+
+    def update_other_config_if_changed(self, key, value):
+        """ Skips the write, if value is what we wrote last time. Returns
+            True, if it was written. """
+        if self._written_digests is None:
+            self._written_digests = {}
+        digest = get_digest(value)
+        if self._written_digests.get(key) == digest:
+            self.other_config_writes_skipped = (
+                self.other_config_writes_skipped + 1)
+            metrics.METRICS.inc('xscontainer_xapi_writes_skipped_total',
+                                {'vm': self.get_uuid()})
+            return False
+        # Forget the old value first, in case the write fails half way
+        self._written_digests.pop(key, None)
+        self.update_other_config(key, value)
+        self._written_digests[key] = digest
+        if self._recent_digests is None:
+            self._recent_digests = {}
+        self._recent_digests.setdefault(key, collections.deque(
+            maxlen=WRITTEN_DIGESTS_KEPT)).append(digest)
+        return True
+
+    def remove_from_other_config(self, key):
+        if self._written_digests:
+            self._written_digests.pop(key, None)
+        return super(VM, self).remove_from_other_config(key)
+
+    def is_written_by_others(self, key, digest):
+        """ Returns True, if we wrote key and the value with digest, which
+            e.g. an event shows, isn't one of the values we wrote lately """
+        recent = (self._recent_digests or {}).get(key)
+        return bool(recent) and digest not in recent
+
+    def get_written_digests(self):
+        return dict(self._written_digests or {})
+
+    def adopt_written_digests(self, digests, other_config):
+        """ Takes over the digests of values that other_config still holds,
+            e.g. written before a restart. Returns the keys adopted. """
+        if self._written_digests is None:
+            self._written_digests = {}
+        adopted = []
+        for key, digest in digests.iteritems():
+            if (key in other_config and
+                    get_digest(other_config[key]) == digest):
+                self._written_digests[key] = digest
+                adopted.append(key)
+        return sorted(adopted)
+
+
+def get_digest(value):
+    return hashlib.sha1(value).hexdigest()
 
 
 def get_local_api_session():
@@ -173,7 +266,7 @@ def reinit_global_xapi_session():
 
 
 def get_hi_mgmtnet_ref(session):
-    networkrecords = session.xenapi.network.get_all_records()
+    networkrecords = RECORD_CACHE.get_all_records(session, 'network')
     for networkref, networkrecord in networkrecords.iteritems():
         if networkrecord['bridge'] == 'xenapi':
             return networkref
@@ -184,6 +277,8 @@ def disable_gw_of_hi_mgmtnet_ref(session):
     other_config = session.xenapi.network.get_other_config(networkref)
     other_config['ip_disable_gw'] = 'true'
     session.xenapi.network.set_other_config(networkref, other_config)
+    RECORD_CACHE.update_field('network', networkref, 'other_config',
+                              other_config)
 
 
 def get_hi_mgmtnet_device(session, vmuuid):
@@ -197,7 +292,8 @@ def get_hi_mgmtnet_device(session, vmuuid):
 
 def get_vm_ips(session, vmuuid):
     vmref = get_vm_ref_by_uuid(session, vmuuid)
-    guest_metrics = session.xenapi.VM.get_guest_metrics(vmref)
+    guest_metrics = RECORD_CACHE.get_field(session, 'VM', vmref,
+                                           'guest_metrics')
     if guest_metrics != NULLREF:
         ips = session.xenapi.VM_guest_metrics.get_networks(guest_metrics)
     else:
@@ -207,14 +303,12 @@ def get_vm_ips(session, vmuuid):
 
 
 def get_vm_is_running(session, vm_uuid):
-    vm_ref = session.xenapi.VM.get_by_uuid(vm_uuid)
-    vm_record = session.xenapi.VM.get_record(vm_ref)
+    vm_record = get_vm_record_by_uuid(session, vm_uuid)
     return (vm_record['power_state'] == 'Running')
 
 
 def get_hi_preferene_on(session):
-    pool = session.xenapi.pool.get_all()[0]
-    other_config = session.xenapi.pool.get_other_config(pool)
+    other_config = get_pool_other_config(session)
     if ('xscontainer-use-hostinternalnetwork' in other_config and
         (other_config['xscontainer-use-hostinternalnetwork'].lower()
          in ['1', 'yes', 'true', 'on'])):
@@ -225,6 +319,10 @@ def get_hi_preferene_on(session):
 
 def get_this_host_uuid():
     # ToDo: There must be a better way that also works with plugins?!?
+    global THIS_HOST_UUID
+    if THIS_HOST_UUID is not None:
+        # The uuid of a host never changes
+        return THIS_HOST_UUID
     uuid = None
     filehandler = open("/etc/xensource-inventory", 'r')
     try:
@@ -234,15 +332,20 @@ def get_this_host_uuid():
                 break
     finally:
         filehandler.close()
+    THIS_HOST_UUID = uuid
     return uuid
 
 
 def get_this_host_ref(session):
     host_uuid = get_this_host_uuid()
-    host_ref = session.xenapi.host.get_by_uuid(host_uuid)
+    host_ref = RECORD_CACHE.get_ref(session, 'host', host_uuid)
     return host_ref
 
 
+def get_pool_master_ref(session):
+    return get_pool_record(session)['master']
+
+
 def call_plugin(session, hostref, plugin, function, args):
     result = session.xenapi.host.call_plugin(hostref, plugin, function, args)
     return result
@@ -250,12 +353,12 @@ def call_plugin(session, hostref, plugin, function, args):
 
 def get_vm_record_by_uuid(session, vmuuid):
     vmref = get_vm_ref_by_uuid(session, vmuuid)
-    vmrecord = session.xenapi.VM.get_record(vmref)
+    vmrecord = RECORD_CACHE.get_record(session, 'VM', vmref)
     return vmrecord
 
 
 def get_vm_ref_by_uuid(session, vmuuid):
-    vmref = session.xenapi.VM.get_by_uuid(vmuuid)
+    vmref = RECORD_CACHE.get_ref(session, 'VM', vmuuid)
     return vmref
 
 
@@ -266,7 +369,8 @@ def get_vm_records(session):
 
 def get_vm_other_config(session, vmuuid):
     vm_ref = get_vm_ref_by_uuid(session, vmuuid)
-    other_config = session.xenapi.VM.get_other_config(vm_ref)
+    other_config = RECORD_CACHE.get_field(session, 'VM', vm_ref,
+                                          'other_config')
     return other_config
 
 
@@ -296,7 +400,11 @@ def create_vif(session, network, vmref):
                  "qos_algorithm_params": {},
                  "other_config": {}
                  }
-    return _retry_device_exists(session.xenapi.VIF.create, vifconfig, 'device')
+    vifref = _retry_device_exists(session.xenapi.VIF.create, vifconfig,
+                                  'device')
+    # The VIFs of the VM changed
+    RECORD_CACHE.invalidate('VM', vmref)
+    return vifref
 
 
 def create_vbd(session, vmref, vdiref, vbdmode, bootable,
@@ -311,8 +419,10 @@ def create_vbd(session, vmref, vdiref, vbdmode, bootable,
                'other_config': other_config_keys,
                'qos_algorithm_type': '',
                'qos_algorithm_params': {}, }
-    return _retry_device_exists(session.xenapi.VBD.create, vbdconf,
-                                'userdevice')
+    vbdref = _retry_device_exists(session.xenapi.VBD.create, vbdconf,
+                                  'userdevice')
+    RECORD_CACHE.invalidate('VM', vmref)
+    return vbdref
 
 
 # ToDo: Ugly - this function may modify the file specified as filename
@@ -370,9 +480,7 @@ def export_disk(session, vdiuuid):
 
 
 def get_default_sr(session):
-    pool = session.xenapi.pool.get_all()[0]
-    default_sr = session.xenapi.pool.get_default_SR(pool)
-    return default_sr
+    return get_pool_record(session)['default_SR']
 
 
 def get_value_from_vm_other_config(session, vmuuid, name):
@@ -387,22 +495,26 @@ def update_vm_other_config(session, vm_uuid, kvpairs):
     vm_ref = get_vm_ref_by_uuid(session, vm_uuid)
     # session.xenapi.VM.remove_from_other_config(vmref, name)
     # session.xenapi.VM.add_to_other_config(vmref, name, value)
+    # Not from RECORD_CACHE, as a stale map would undo other writes
     other_config = session.xenapi.VM.get_other_config(vm_ref)
     for key, value in kvpairs.items():
         other_config[key] = value
     session.xenapi.VM.set_other_config(vm_ref, other_config)
+    RECORD_CACHE.update_field('VM', vm_ref, 'other_config', other_config)
 
 
-def get_idrsa_secret(session, secret_type):
+def get_idrsa_secret_uuid(session, secret_type):
     other_config = get_pool_other_config(session)
     if (XSCONTAINER_PRIVATE_SECRET_UUID not in other_config or
             XSCONTAINER_PUBLIC_SECRET_UUID not in other_config):
         set_idrsa_secret(session)
         other_config = get_pool_other_config(session)
-    secret_uuid = other_config[secret_type]
-    secret_ref = session.xenapi.secret.get_by_uuid(secret_uuid)
-    secret_record = session.xenapi.secret.get_record(secret_ref)
-    return secret_record['value']
+    return other_config[secret_type]
+
+
+def get_idrsa_secret(session, secret_type):
+    secret_uuid = get_idrsa_secret_uuid(session, secret_type)
+    return get_secret_values(session, [secret_uuid])[secret_uuid]
 
 
 def get_idrsa_secret_private(session):
@@ -434,24 +546,353 @@ def create_secret_return_uuid(session, value):
     return secret_record['uuid']
 
 
+def get_secret_values(session, secret_uuids):
+    """ Returns the values of the secrets keyed by uuid, fetched with a
+        single call """
+    if not secret_uuids:
+        return {}
+    records = session.xenapi.secret.get_all_records_where(
+        " or ".join('field "uuid"="%s"' % (secret_uuid)
+                    for secret_uuid in secret_uuids))
+    values = dict((record['uuid'], record['value'])
+                  for record in records.itervalues())
+    for secret_uuid in secret_uuids:
+        if secret_uuid not in values:
+            raise util.XSContainerException(
+                "Secret %s does not exist" % (secret_uuid))
+    return values
+
+
+def get_pool_record(session):
+    return RECORD_CACHE.get_all_records(session, 'pool').values()[0]
+
+
 def get_pool_other_config(session):
-    pool_ref = session.xenapi.pool.get_all()[0]
-    other_config = session.xenapi.pool.get_other_config(pool_ref)
-    return other_config
+    return get_pool_record(session)['other_config']
 
 
 def set_pool_other_config_values(session, values_to_set):
-    other_config = get_pool_other_config(session)
+    pool_ref = session.xenapi.pool.get_all()[0]
+    # Not from RECORD_CACHE, as a stale map would undo other writes
+    other_config = session.xenapi.pool.get_other_config(pool_ref)
     for key, value in values_to_set.iteritems():
         other_config[key] = value
-    pool_ref = session.xenapi.pool.get_all()[0]
     session.xenapi.pool.set_other_config(pool_ref, other_config)
+    RECORD_CACHE.update_field('pool', pool_ref, 'other_config', other_config)
 
 
-def get_suitable_vm_ips(session, vmuuid, port):
+class VmIpCache(object):
+
+    """
+    Remembers the IP that last worked per VM and port, so that the IPs of a
+    VM don't need to be probed before every request. An entry is only used
+    while the VM reports the same candidate IPs in its guest metrics, and
+    it's dropped when a connection to the IP fails.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        util.recreate_lock_after_fork(self)
+        # _cache[(vmuuid, port)] = (address, candidates)
+        self._cache = {}
+
+    def get(self, vmuuid, port, candidates):
+        self._lock.acquire()
+        try:
+            entry = self._cache.get((vmuuid, port))
+        finally:
+            self._lock.release()
+        if entry and entry[1] == candidates:
+            return entry[0]
+        return None
+
+    def remember(self, vmuuid, port, address, candidates):
+        self._lock.acquire()
+        try:
+            self._cache[(vmuuid, port)] = (address, candidates)
+        finally:
+            self._lock.release()
+
+    def invalidate(self, vmuuid, port=None):
+        self._lock.acquire()
+        try:
+            for key in self._cache.keys():
+                if key[0] == vmuuid and port in (None, key[1]):
+                    del self._cache[key]
+        finally:
+            self._lock.release()
+
+    def get_state(self):
+        """ Returns the entries as a list that can be saved as JSON """
+        self._lock.acquire()
+        try:
+            return [[vmuuid, port, address, candidates] for
+                    ((vmuuid, port), (address, candidates))
+                    in self._cache.iteritems()]
+        finally:
+            self._lock.release()
+
+    def load_state(self, entries):
+        for vmuuid, port, address, candidates in entries:
+            self.remember(vmuuid, port, address, candidates)
+
+
+VM_IP_CACHE = VmIpCache()
+
+
+class RecordCache(object):
+
+    """
+    A local copy of the VM, host, network and pool records, so that
+    looking up a ref by uuid, a record or a field like other_config doesn't
+    take a round trip to the pool master. It holds nothing, unless a
+    process opts in:
+        - The monitor replicates the records. load only fetches the pool
+          record with the event token, the other records are kept once
+          they have been fetched or an event brought them. apply_events,
+          called from the event_from loop that the monitor runs anyway,
+          keeps them current.
+        - Short-lived processes like the plugin call set_ttl. Records are
+          then fetched when first needed and used for ttl seconds.
+    What the cache can't answer is asked from XAPI. Writes through
+    api_helper are applied to the cached records, or drop them where that
+    isn't possible. A replica gets a dropped record back when it is fetched
+    again or with the next event of the object.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        util.recreate_lock_after_fork(self)
+        self._ttl = None
+        self._replicated = False
+        # _records[class][ref] = (record, time it expires or None)
+        self._records = {}
+        # _refs[class][uuid] = ref
+        self._refs = {}
+        # _complete[class] = time it expires or None, while _records holds
+        # all records of the class
+        self._complete = {}
+        # Counts the events applied to a replica. _touched[(class, ref)] is
+        # the count at the last event of an object.
+        self._sequence = 0
+        self._touched = {}
+
+    def set_ttl(self, ttl):
+        self._ttl = ttl
+
+    def load(self, session):
+        """ Starts replicating the records and returns the token to follow
+            the changes of RECORD_CACHE_CLASSES from """
+        result = session.xenapi.event_from(RECORD_CACHE_LOAD_CLASSES, '',
+                                           0.0)
+        self._lock.acquire()
+        try:
+            self._clear()
+            self._replicated = True
+            for class_name in RECORD_CACHE_LOAD_CLASSES:
+                self._complete[class_name] = None
+            self._apply_events(result['events'])
+        finally:
+            self._lock.release()
+        return result['token']
+
+    def apply_events(self, events):
+        self._lock.acquire()
+        try:
+            if self._replicated:
+                self._apply_events(events)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """ To be called when events are no longer followed """
+        self._lock.acquire()
+        try:
+            self._clear()
+        finally:
+            self._lock.release()
+
+    def update_field(self, class_name, ref, field, value):
+        """ Applies a write of a field to the cached record """
+        self._lock.acquire()
+        try:
+            entry = self._records.get(class_name.lower(), {}).get(ref)
+            if entry:
+                entry[0][field] = copy.deepcopy(value)
+        finally:
+            self._lock.release()
+
+    def update_map(self, class_name, ref, field, key, value=None):
+        """ Applies add_to_<field>, or without value remove_from_<field>,
+            to the cached record """
+        self._lock.acquire()
+        try:
+            entry = self._records.get(class_name.lower(), {}).get(ref)
+            if entry and value is None:
+                entry[0][field].pop(key, None)
+            elif entry:
+                entry[0][field][key] = value
+        finally:
+            self._lock.release()
+
+    def invalidate(self, class_name, ref):
+        self._lock.acquire()
+        try:
+            entry = self._records.get(class_name.lower(), {}).get(ref)
+            if entry:
+                # Expired, but the uuid still maps to the ref
+                self._records[class_name.lower()][ref] = (entry[0], 0)
+        finally:
+            self._lock.release()
+
+    def lookup_ref(self, class_name, uuid):
+        """ Returns the ref of uuid, if it is known, else None """
+        self._lock.acquire()
+        try:
+            return self._refs.get(class_name.lower(), {}).get(uuid)
+        finally:
+            self._lock.release()
+
+    def get_ref(self, session, class_name, uuid):
+        ref = self.lookup_ref(class_name, uuid)
+        if ref is None:
+            ref = getattr(session.xenapi, class_name).get_by_uuid(uuid)
+        return ref
+
+    def get_record(self, session, class_name, ref):
+        record = self._get_cached(class_name, ref)
+        if record is None:
+            started = self._get_sequence()
+            record = getattr(session.xenapi, class_name).get_record(ref)
+            self._remember(class_name, {ref: record}, started)
+        return record
+
+    def get_records_where(self, session, class_name, expression):
+        """ Always asks XAPI, but keeps the records like get_record """
+        started = self._get_sequence()
+        records = getattr(session.xenapi,
+                          class_name).get_all_records_where(expression)
+        self._remember(class_name, records, started)
+        return records
+
+    def get_field(self, session, class_name, ref, field):
+        """ Without a cached record, only the field is fetched, unless a ttl
+            has been set """
+        value = self._get_cached(class_name, ref, field)
+        if value is None and self._ttl:
+            return self.get_record(session, class_name, ref)[field]
+        elif value is None:
+            return getattr(getattr(session.xenapi, class_name),
+                           'get_' + field)(ref)
+        return value
+
+    def get_all_records(self, session, class_name):
+        self._lock.acquire()
+        try:
+            records = None
+            if self._is_current(self._complete.get(class_name.lower(), 0)):
+                records = dict((ref, entry[0]) for (ref, entry)
+                               in self._records[class_name.lower()].items()
+                               if self._is_current(entry[1]))
+                if (len(records) !=
+                        len(self._records[class_name.lower()])):
+                    # Some have been invalidated
+                    records = None
+                else:
+                    records = copy.deepcopy(records)
+        finally:
+            self._lock.release()
+        if records is None:
+            started = self._get_sequence()
+            records = getattr(session.xenapi, class_name).get_all_records()
+            self._remember(class_name, records, started, complete=True)
+        return records
+
+    def _is_current(self, expires):
+        return expires is None or expires > time.time()
+
+    def _get_cached(self, class_name, ref, field=None):
+        """ Returns a copy of the cached record, or of one of its fields,
+            or None. The copy is taken under the lock, as writes change the
+            cached records in place. """
+        self._lock.acquire()
+        try:
+            entry = self._records.get(class_name.lower(), {}).get(ref)
+            if entry and self._is_current(entry[1]):
+                if field is None:
+                    return copy.deepcopy(entry[0])
+                return copy.deepcopy(entry[0][field])
+        finally:
+            self._lock.release()
+        return None
+
+    def _get_sequence(self):
+        self._lock.acquire()
+        try:
+            return self._sequence
+        finally:
+            self._lock.release()
+
+    def _remember(self, class_name, records, started, complete=False):
+        """ Keeps records that have been fetched since the event count was
+            started, if a ttl has been set or while replicating. A replica
+            skips the records of objects that an event changed meanwhile,
+            as the event may be newer. """
+        class_name = class_name.lower()
+        self._lock.acquire()
+        try:
+            if self._replicated:
+                expires = None
+            elif self._ttl:
+                expires = time.time() + self._ttl
+            else:
+                return
+            for ref, record in records.iteritems():
+                if self._touched.get((class_name, ref), 0) <= started:
+                    self._set(class_name, ref, copy.deepcopy(record),
+                              expires)
+            if complete:
+                self._complete[class_name] = expires
+        finally:
+            self._lock.release()
+
+    def _set(self, class_name, ref, record, expires):
+        self._records.setdefault(class_name, {})[ref] = (record, expires)
+        self._refs.setdefault(class_name, {})[record['uuid']] = ref
+
+    def _apply_events(self, events):
+        for event in events:
+            class_name = event['class'].lower()
+            if class_name not in RECORD_CACHE_CLASSES:
+                continue
+            self._sequence = self._sequence + 1
+            self._touched[(class_name, event['ref'])] = self._sequence
+            if event['operation'] == 'del':
+                entry = self._records.get(class_name, {}).pop(event['ref'],
+                                                              None)
+                if entry:
+                    self._refs[class_name].pop(entry[0]['uuid'], None)
+            elif 'snapshot' in event:
+                # The caller goes on to use the snapshot while others write
+                # to the cached record
+                self._set(class_name, event['ref'],
+                          copy.deepcopy(event['snapshot']), None)
+
+    def _clear(self):
+        self._replicated = False
+        self._records = {}
+        self._refs = {}
+        self._complete = {}
+        self._touched = {}
+
+
+RECORD_CACHE = RecordCache()
+
+
+def _get_candidate_vm_ips(session, vmuuid):
     ips = get_vm_ips(session, vmuuid)
     stage1filteredips = []
-    for address in ips.itervalues():
+    for address in sorted(ips.itervalues()):
         if ':' not in address:
             # If we get here - it's ipv4
             if address.startswith('169.254.'):
@@ -462,27 +903,52 @@ def get_suitable_vm_ips(session, vmuuid, port):
         else:
             # Ignore ipv6 as Dom0 won't be able to use it
             pass
+    return stage1filteredips
+
+
+def get_suitable_vm_ips(session, vmuuid, port):
+    """ Probes all IPs of the VM at the same time and yields those that
+        accept connections on port, the fastest first """
+    stage1filteredips = _get_candidate_vm_ips(session, vmuuid)
     ipfound = False
-    for address in stage1filteredips:
-        if util.test_connection(address, port):
-            ipfound = True
-            yield address
+    for address in util.probe_connections(stage1filteredips, port):
+        ipfound = True
+        yield address
     if not ipfound:
         raise util.XSContainerException(
             "No valid IP found for vmuuid %s" % (vmuuid))
 
 
 def get_suitable_vm_ip(session, vmuuid, port):
-    return get_suitable_vm_ips(session, vmuuid, port).next()
+    candidates = _get_candidate_vm_ips(session, vmuuid)
+    address = VM_IP_CACHE.get(vmuuid, port, candidates)
+    if address is None:
+        probe = util.probe_connections(candidates, port)
+        try:
+            for address in probe:
+                break
+            else:
+                raise util.XSContainerException(
+                    "No valid IP found for vmuuid %s" % (vmuuid))
+        finally:
+            probe.close()
+        VM_IP_CACHE.remember(vmuuid, port, address, candidates)
+    return address
+
+
+def forget_suitable_vm_ip(vmuuid, port=None):
+    """ To be called when connecting to the IP of the VM failed """
+    VM_IP_CACHE.invalidate(vmuuid, port)
+
+
+def get_xscontainer_username(other_config):
+    """ Returns the username from the other_config of a VM """
+    # assume CoreOs's "core" by default
+    return other_config.get(XSCONTAINER_USERNAME, 'core')
 
 
 def get_vm_xscontainer_username(session, vmuuid):
-    username = get_value_from_vm_other_config(session, vmuuid,
-                                              XSCONTAINER_USERNAME)
-    if username is None:
-        # assume CoreOs's "core" by default
-        username = 'core'
-    return username
+    return get_xscontainer_username(get_vm_other_config(session, vmuuid))
 
 
 def set_vm_xscontainer_username(session, vmuuid, newusername):
@@ -490,16 +956,18 @@ def set_vm_xscontainer_username(session, vmuuid, newusername):
         session, vmuuid, {XSCONTAINER_USERNAME: newusername})
 
 
-def get_vm_xscontainer_mode(session, vmuuid):
-    mode = get_value_from_vm_other_config(session, vmuuid,
-                                          XSCONTAINER_MODE)
-    if mode is None:
-        # default so ssh as that is what came first
-        mode = 'ssh'
+def get_xscontainer_mode(other_config):
+    """ Returns the connection mode from the other_config of a VM """
+    # default so ssh as that is what came first
+    mode = other_config.get(XSCONTAINER_MODE, 'ssh')
     assert mode in ('ssh', 'tls')
     return mode
 
 
+def get_vm_xscontainer_mode(session, vmuuid):
+    return get_xscontainer_mode(get_vm_other_config(session, vmuuid))
+
+
 def set_vm_xscontainer_mode(session, vmuuid, mode):
     assert mode in ('ssh', 'tls')
     update_vm_other_config(session, vmuuid, {XSCONTAINER_MODE: mode})
@@ -557,6 +1025,26 @@ def get_host_ref_for_vm_uuid(session, vm_uuid):
     return host_ref
 
 
+def get_host_ref_for_plugin_args(session, args):
+    """ Returns a tuple of the host that should handle a plugin call with
+        args, or None if any host can, and why. A call about a VM goes to
+        the host running it, one about a VDI or SR to a host with access to
+        it. """
+    if 'vmuuid' in args:
+        host_ref = get_host_ref_for_vm_uuid(session, args['vmuuid'])
+        if host_ref:
+            return (host_ref, "vmuuid %s" % (args['vmuuid']))
+    if 'vdiuuid' in args:
+        host_ref = get_host_ref_for_vdi_uuid(session, args['vdiuuid'])
+        if host_ref:
+            return (host_ref, "vdiuuid %s" % (args['vdiuuid']))
+    if 'sruuid' in args:
+        host_ref = get_host_ref_for_sr_uuid(session, args['sruuid'])
+        if host_ref:
+            return (host_ref, "sruuid %s" % (args['sruuid']))
+    return (None, None)
+
+
 def get_cd_vbd_ref(session, vm_uuid):
     vm_record = get_vm_record_by_uuid(session, vm_uuid)
     for vbd_ref in vm_record['VBDs']:
@@ -263,8 +263,8 @@ def remove_config_drive(session, vmrecord, configdisk_namelabel):
 
 def create_config_drive(session, vmuuid, sruuid, userdata):
     log.info("create_config_drive for vm %s on sr %s" % (vmuuid, sruuid))
-    vmref = session.xenapi.VM.get_by_uuid(vmuuid)
-    vmrecord = session.xenapi.VM.get_record(vmref)
+    vmref = api_helper.get_vm_ref_by_uuid(session, vmuuid)
+    vmrecord = api_helper.get_vm_record_by_uuid(session, vmuuid)
     prepare_vm_for_config_drive(session, vmref, vmuuid)
     isofile = create_config_drive_iso(session, userdata, vmuuid)
     other_config_keys = {OTHER_CONFIG_CONFIG_DRIVE_KEY: 'True'}
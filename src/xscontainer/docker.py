@@ -1,30 +1,38 @@
 from xscontainer import api_helper
 from xscontainer import remote_helper
 from xscontainer import util
+from xscontainer.util import json_stream
 from xscontainer.util import log
 
 import re
 import json
-
-
-def prepare_request_stdin(request_type, request):
-    return ("%s %s HTTP/1.0\r\n\r\n" % (request_type, request))
+import time
+import urllib
+
+# Events the monitor reacts to, see MonitoredVM.handle_docker_event
+PS_EVENTS = ['create', 'destroy', 'die', 'kill', 'pause', 'restart', 'start',
+             'stop', 'unpause']
+# Image events, as they change what /info reports about images
+INFO_EVENTS = ['delete', 'import', 'load', 'pull', 'untag']
+# The events endpoint accepts filters for event since API 1.16 and for type
+# since API 1.22
+EVENT_FILTER_API_VERSION = (1, 16)
+TYPE_FILTER_API_VERSION = (1, 22)
+# See ContainerTable
+CONTAINER_TABLE_RECONCILE_S = 300
+# Above this number of changed containers, listing all is cheaper
+CONTAINER_TABLE_INCREMENTAL_MAX = 10
 
 
 def _interact_with_api(session, vmuuid, request_type, request,
-                       message_error=False):
-    request = prepare_request_stdin(request_type, request)
-    stdout = remote_helper.execute_docker(session, vmuuid, request)
-    headerend = stdout.index('\r\n\r\n')
-    header = stdout[:headerend]
-    body = stdout[headerend + 4:]
-    # ToDo: Should use re
-    headersplits = header.split('\r\n', 2)[0].split(' ')
-    # protocol = headersplits[0]
-    statuscode = headersplits[1]
+                       message_error=False, body_sink=None):
+    response = remote_helper.execute_docker(session, vmuuid, request_type,
+                                            request, body_sink)
+    body = response.body
+    statuscode = str(response.status)
     if statuscode[0] != '2':
         # this did not work
-        status = ' '.join(headersplits[2:])
+        status = response.reason
         failure_title = "Container Management Error"
         failure_body = body.strip()
         if failure_body == "":
@@ -40,8 +48,9 @@ def _interact_with_api(session, vmuuid, request_type, request,
         if message_error:
             api_helper.send_message(session, vmuuid, failure_title,
                                     failure_body)
-        message = ("Request '%s' led to status %s - %s: %s"
-                   % (request, status, failure_title, failure_body))
+        message = ("Request '%s %s' led to status %s - %s: %s"
+                   % (request_type, request, status, failure_title,
+                      failure_body))
         log.info(message)
         raise util.XSContainerException(message)
     return body
@@ -53,6 +62,19 @@ def _get_api_json(session, vmuuid, request):
     return results
 
 
+def _get_api_json_array(session, vmuuid, request):
+    """ Decodes the elements of a JSON array while the response is still
+        being received, rather than holding all of the raw body first """
+    decoder = json_stream.JsonStreamDecoder(array=True)
+    results = []
+
+    def _decode(data):
+        results.extend(decoder.feed(data))
+    _interact_with_api(session, vmuuid, 'GET', request, body_sink=_decode)
+    results.extend(decoder.close())
+    return util.convert_dict_to_ascii(results)
+
+
 def _post_api(session, vmuuid, request):
     stdout = _interact_with_api(session, vmuuid, 'POST', request,
                                 message_error=True)
@@ -87,22 +109,92 @@ def patch_docker_ps_status(ps_dict):
     return
 
 
-def get_ps_dict(session, vmuuid):
-    container_results = _get_api_json(session, vmuuid,
-                                      '/containers/json?all=1&size=1')
+def _patch_ps_entry(container_result):
+    container_result['Names'] = container_result['Names'][0][1:]
+    # Do some patching for XC - ToDo: patch XC to not require these
+    container_result['Container'] = container_result['Id'][:10]
+    patch_docker_ps_status(container_result)
+    patched_result = {}
+    for (key, value) in container_result.iteritems():
+        patched_result[key.lower()] = value
+    return {'entry': patched_result}
+
+
+def get_ps_dict(session, vmuuid, container_id=None):
+    """ Lists all containers, or with container_id only that one """
+    request = '/containers/json?all=1&size=1'
+    if container_id:
+        request = request + '&filters=' + urllib.quote(
+            json.dumps({'id': [container_id]}))
+    container_results = _get_api_json_array(session, vmuuid, request)
     return_results = []
     for container_result in container_results:
-        container_result['Names'] = container_result['Names'][0][1:]
-        # Do some patching for XC - ToDo: patch XC to not require these
-        container_result['Container'] = container_result['Id'][:10]
-        patch_docker_ps_status(container_result)
-        patched_result = {}
-        for (key, value) in container_result.iteritems():
-            patched_result[key.lower()] = value
-        return_results.append({'entry': patched_result})
+        if container_id and container_result['Id'] != container_id:
+            # The id filter also matches on prefixes
+            continue
+        return_results.append(_patch_ps_entry(container_result))
     return return_results
 
 
+class ContainerTable(object):
+
+    """
+    The containers of a VM, kept up to date from Docker events, so that an
+    event only needs the container it's about to be listed, rather than
+    all of them. A full listing is done to seed the table, for bursts, and
+    every CONTAINER_TABLE_RECONCILE_S to catch drift.
+    """
+
+    def __init__(self):
+        # _containers[container id] = {'entry': {...}}
+        self._containers = None
+        self.last_reconcile = 0
+        self.incremental_updates = 0
+        self.reconciles = 0
+        # Containers that a periodic reconcile found to be out of date
+        self.drift = 0
+
+    def is_seeded(self):
+        return self._containers is not None
+
+    def needs_reconcile(self, now=None):
+        if now is None:
+            now = time.time()
+        return (not self.is_seeded() or
+                now - self.last_reconcile >= CONTAINER_TABLE_RECONCILE_S)
+
+    def reconcile(self, session, vmuuid, periodic=False):
+        containers = {}
+        for entry in get_ps_dict(session, vmuuid):
+            containers[entry['entry']['id']] = entry
+        if periodic and self.is_seeded():
+            for container_id in set(containers) | set(self._containers):
+                if (containers.get(container_id) !=
+                        self._containers.get(container_id)):
+                    self.drift = self.drift + 1
+        self._containers = containers
+        self.last_reconcile = time.time()
+        self.reconciles = self.reconciles + 1
+
+    def update_container(self, session, vmuuid, container_id):
+        entries = get_ps_dict(session, vmuuid, container_id)
+        if entries:
+            self._containers[container_id] = entries[0]
+        else:
+            # The container has been removed
+            self._containers.pop(container_id, None)
+        self.incremental_updates = self.incremental_updates + 1
+
+    def get_ps_dict(self):
+        """ Returns the containers like docker.get_ps_dict, newest first """
+        return sorted(self._containers.itervalues(),
+                      key=lambda entry: (-entry['entry'].get('created', 0),
+                                         entry['entry']['id']))
+
+    def get_ps_xml(self):
+        return util.converttoxml({'docker_ps': self.get_ps_dict()})
+
+
 def get_ps_xml(session, vmuuid):
     result = {'docker_ps': get_ps_dict(session, vmuuid)}
     return util.converttoxml(result)
@@ -203,25 +295,53 @@ def unpause(session, vmuuid, container):
 
 
 def update_docker_info(thevm):
-    thevm.update_other_config('docker_info', get_info_xml(thevm.get_session(),
-                                                          thevm.get_uuid()))
+    thevm.update_other_config_if_changed(
+        'docker_info', get_info_xml(thevm.get_session(), thevm.get_uuid()))
 
 
 def update_docker_version(thevm):
-    thevm.update_other_config('docker_version',
-                              get_version_xml(thevm.get_session(),
-                                              thevm.get_uuid()))
+    """ Returns the version dict that has been written """
+    version = get_version_dict(thevm.get_session(), thevm.get_uuid())
+    thevm.update_other_config_if_changed(
+        'docker_version', util.converttoxml({'docker_version': version}))
+    return version
+
+
+def _parse_api_version(version):
+    try:
+        return tuple(int(part) for part in version['ApiVersion'].split('.'))
+    except (KeyError, AttributeError, ValueError):
+        return None
+
+
+def get_events_path(version=None):
+    """ Returns the path to subscribe to the events the monitor reacts to.
+        Docker filters them on its side if the API version of the version
+        dict supports it, else all events are sent. """
+    api_version = None
+    if version:
+        api_version = _parse_api_version(version)
+    if api_version is None or api_version < EVENT_FILTER_API_VERSION:
+        return '/events'
+    filters = {'event': PS_EVENTS + INFO_EVENTS}
+    if api_version >= TYPE_FILTER_API_VERSION:
+        # Leave out network and volume events of the same name
+        filters['type'] = ['container', 'image']
+    return '/events?filters=' + urllib.quote(json.dumps(filters,
+                                                        sort_keys=True))
 
 
 def update_docker_ps(thevm):
-    thevm.update_other_config('docker_ps', get_ps_xml(thevm.get_session(),
-                                                      thevm.get_uuid()))
+    thevm.update_other_config_if_changed(
+        'docker_ps', get_ps_xml(thevm.get_session(), thevm.get_uuid()))
 
 
 def update_docker_ps_workaround(session, vm_uuid):
     """
     Only recent docker versions support sending events for pause and unpause.
-    This works around this - at least when we post the command.
+    This works around this - at least when we post the command. The monitor
+    sees the write in a VM event and lists all containers next time, see
+    MonitoredVM.check_docker_ps_digest.
     """
     client = api_helper.XenAPIClient(session)
     thevm = api_helper.VM(client, uuid=vm_uuid)
@@ -3,23 +3,68 @@ from xscontainer import docker
 from xscontainer import remote_helper
 from xscontainer import util
 from xscontainer.util import log
+from xscontainer.util import metrics
 from xscontainer.util import tls_secret
+from xscontainer.docker_monitor import admission
+from xscontainer.docker_monitor import reactor
+from xscontainer.docker_monitor import sharding
+from xscontainer.docker_monitor import state
+from xscontainer.docker_monitor import writer
 
+import multiprocessing
 import os
+import random
 import thread
 import time
 import signal
 import socket
 import sys
+import threading
 import XenAPI
 import xmlrpclib
 
+# 'threaded' monitors each VM with a thread of its own, 'reactor' monitors
+# all VMs with one epoll loop and a few worker threads and 'sharded' spreads
+# the VMs over processes that each run a reactor
+MONITOR_MODES = ['threaded', 'reactor', 'sharded']
+MONITOR_MODE = 'threaded'
+SHARD_CHECK_INTERVAL_S = 5
 MONITORRETRYSLEEPINS = 20
+# Backoff for VMs that keep failing, and how long to wait after failures
+# that are unlikely to go away by themselves
+MONITOR_RETRY_MAX_S = 300
+MONITOR_RETRY_PERSISTENT_S = 600
+# Retry quickly while a VM that just got its guest metrics is booting
+MONITOR_FAST_CONNECT_WINDOW_S = 60
+MONITOR_FAST_CONNECT_RETRY_S = 2
+# Refreshes requested by Docker events are delayed until no further event
+# asked for the same refresh for REFRESH_COALESCE_WINDOW_S, but no longer
+# than REFRESH_MAX_STALENESS_S after the first event
+REFRESH_COALESCE_WINDOW_S = 1.0
+REFRESH_MAX_STALENESS_S = 5.0
+# /info is expensive for Docker and rarely changes: it is refetched every
+# INFO_REFRESH_INTERVAL_S (randomised) and for image events, but not more
+# often than every INFO_MIN_INTERVAL_S. /version is fetched on connecting.
+INFO_REFRESH_INTERVAL_S = 600
+INFO_MIN_INTERVAL_S = 60
+# How many other_config writes per second the monitor of a host may send
+# to XAPI. 0 writes directly, without a limit.
+WRITE_BUDGET_PER_S = writer.WRITE_BUDGET_PER_S
+WRITE_QUEUE_STOP_TIMEOUT_S = 10
 MONITOR_TIMEOUT_WARNING_S = 120.0
 REGISTRATION_KEY = "xscontainer-monitor"
 REGISTRATION_KEY_ON = 'True'
 REGISTRATION_KEY_OFF = 'False'
 EVENT_FROM_TIMEOUT_S = 3600.0
+STATS_REPORT_INTERVAL_S = 3600
+# What DockerMonitor.refresh asks XAPI for, rather than for all VMs,
+# templates and snapshots of the pool. Running VMs elsewhere are processed
+# once their events come in.
+RESIDENT_VMS_EXPRESSION = ('field "resident_on"="%s" and '
+                           'field "power_state"="Running" and '
+                           'field "is_a_template"="false"')
+HALTED_VMS_EXPRESSION = ('field "power_state"="Halted" and '
+                         'field "is_a_template"="false"')
 XAPIRETRYSLEEPINS = 10
 
 DOCKER_MONITOR = None
@@ -33,19 +78,224 @@ class DeregistrationError(Exception):
     pass
 
 
+class ReconnectPolicy(object):
+
+    """
+    Decides how long a VM's monitoring loop waits before reconnecting. The
+    wait doubles with every failure up to MONITOR_RETRY_MAX_S, and is
+    randomised, so that many broken VMs don't retry in lockstep.
+    """
+
+    def __init__(self, fast_connect=False):
+        self.failures = 0
+        self.persistent_failure = False
+        self.fast_connect_until = 0
+        if fast_connect:
+            self.fast_connect_until = (time.time() +
+                                       MONITOR_FAST_CONNECT_WINDOW_S)
+
+    def succeeded(self):
+        self.failures = 0
+        self.persistent_failure = False
+        # Once connected, a booting VM has finished booting
+        self.fast_connect_until = 0
+
+    def failed(self, persistent=False):
+        self.failures = self.failures + 1
+        self.persistent_failure = persistent
+
+    def reset(self):
+        """ The configuration of the VM changed - retry soon """
+        self.failures = 0
+        self.persistent_failure = False
+
+    def get_delay(self):
+        if self.persistent_failure:
+            delay = MONITOR_RETRY_PERSISTENT_S
+        elif time.time() < self.fast_connect_until:
+            delay = MONITOR_FAST_CONNECT_RETRY_S
+        else:
+            delay = min(MONITORRETRYSLEEPINS * 2 ** max(self.failures - 1, 0),
+                        MONITOR_RETRY_MAX_S)
+        return random.uniform(delay / 2.0, delay)
+
+
+class RefreshScheduler(object):
+
+    """
+    Coalesces the refreshes that a burst of Docker events asks for, e.g.
+    from starting 50 containers at once, into few refreshes.
+    """
+
+    def __init__(self, window=None, max_staleness=None):
+        if window is None:
+            window = REFRESH_COALESCE_WINDOW_S
+        if max_staleness is None:
+            max_staleness = REFRESH_MAX_STALENESS_S
+        self.window = window
+        self.max_staleness = max_staleness
+        # _pending[refresh] = (time of the first request, due time)
+        self._pending = {}
+        self.refreshes_saved = 0
+
+    def request(self, refresh, now=None, not_before=None):
+        """ not_before delays the refresh beyond the usual staleness """
+        if now is None:
+            now = time.time()
+        if refresh in self._pending:
+            first, _ = self._pending[refresh]
+            self.refreshes_saved = self.refreshes_saved + 1
+        else:
+            first = now
+        due = min(now + self.window, first + self.max_staleness)
+        if not_before is not None:
+            due = max(due, not_before)
+        self._pending[refresh] = (first, due)
+
+    def get_next_due(self):
+        """ Returns when the next refresh is due, or None """
+        if not self._pending:
+            return None
+        return min(due for (_, due) in self._pending.itervalues())
+
+    def pop_due(self, now=None):
+        """ Returns the refreshes that are due now """
+        if now is None:
+            now = time.time()
+        due = [refresh for (refresh, (_, duetime))
+               in self._pending.iteritems() if duetime <= now]
+        for refresh in due:
+            self._pending.pop(refresh, None)
+        return sorted(due)
+
+    def clear(self):
+        self._pending = {}
+
+
 class MonitoredVM(api_helper.VM):
 
     """A VM class that can be monitored."""
     """_stop_monitoring_request must be a mutable type such as list()"""
     _stop_monitoring_request = list()
     _error_message = None
+    _event_filters_refused = False
+    # Docker events received, and how many of them led to a refresh
+    events_received = 0
+    events_acted_on = 0
+    refreshes_done = 0
+    info_fetches = 0
+    # The last /info, when it was fetched and when it is due again
+    _info_xml = None
+    _info_fetched = 0
+    _info_due = None
+    _refresh_scheduler = None
+    _container_table = None
+    # Containers named by events since the last ps refresh. None stands
+    # for an unknown container.
+    _dirty_containers = None
+    _reconcile_requested = False
+
+    _reconnect_policy = None
+    _retry_now = False
+    _config = None
+    _start_time = None
+    # The MonitorReactor that handles this VM, if not monitored by a thread
+    _reactor = None
+    # The WriteBehindQueue for other_config writes, if they are rate limited
+    _write_queue = None
+    # The saved state of a previous monitor, see DockerMonitor.get_state
+    _warm_state = None
+    # other_config holds values that Docker hasn't confirmed since the
+    # monitor (re)connected, and is wiped if connecting fails
+    _other_config_stale = False
+    # Leave other_config as it is when stopping, for the next monitor
+    _keep_other_config = False
+    # The AdmissionController for connecting, and the priority with it
+    _admission = None
+    _priority = 0
+
+    def __init__(self, client, ref=None, uuid=None):
+        api_helper.VM.__init__(self, client, ref, uuid)
+        # Guards _dirty_containers, which the reactor's thread adds to while
+        # a worker takes them for a refresh
+        self._dirty_lock = threading.Lock()
 
-    def start_monitoring(self):
+    def start_monitoring(self, fast_connect=False, reactor=None,
+                         write_queue=None, warm_state=None, admission=None,
+                         priority=0):
         self._stop_monitoring_request = list()
-        thread.start_new_thread(self._monitoring_loop, tuple())
+        self._reconnect_policy = ReconnectPolicy(fast_connect)
+        self.events_received = 0
+        self.events_acted_on = 0
+        self.refreshes_done = 0
+        self.info_fetches = 0
+        self._info_xml = None
+        self._info_fetched = 0
+        self._info_due = None
+        self._refresh_scheduler = RefreshScheduler()
+        self._container_table = docker.ContainerTable()
+        self._dirty_containers = set()
+        self._reactor = reactor
+        self._write_queue = write_queue
+        self._warm_state = warm_state
+        self._keep_other_config = False
+        self._admission = admission
+        self._priority = priority
+        if admission:
+            admission.expect(self.get_id())
+        if reactor:
+            reactor.add_vm(self)
+        else:
+            thread.start_new_thread(self._monitoring_loop, tuple())
 
-    def stop_monitoring(self):
+    def stop_monitoring(self, keep_other_config=False):
+        self._keep_other_config = keep_other_config
         self._stop_monitoring_request.append("stop")
+        if self._reactor:
+            self._reactor.remove_vm(self)
+        if self._admission:
+            self._admission.cancel(self.get_id())
+
+    def update_config(self, config):
+        """ config holds the xscontainer settings of the VM. A change may fix
+            a persistent failure, so retry soon. """
+        if self._config is not None and config != self._config:
+            remote_helper.forget_vm(self.get_uuid())
+            if self._reconnect_policy:
+                self._reconnect_policy.reset()
+            self._retry_now = True
+            if self._reactor:
+                self._reactor.retry_now(self)
+        self._config = config
+
+    def update_other_config_if_changed(self, key, value):
+        if self._write_queue:
+            self._write_queue.put(self, key, value)
+            return True
+        return api_helper.VM.update_other_config_if_changed(self, key, value)
+
+    def remove_from_other_config(self, key):
+        if self._write_queue:
+            # Also supersedes a write of the key that is still queued
+            self._write_queue.put(self, key, None)
+            return
+        return api_helper.VM.remove_from_other_config(self, key)
+
+    def write_other_config(self, key, value):
+        """ Called by the WriteBehindQueue. None removes the key. """
+        if value is None:
+            api_helper.VM.remove_from_other_config(self, key)
+        else:
+            api_helper.VM.update_other_config_if_changed(self, key, value)
+
+    def _wait_before_reconnect(self):
+        delay = self._reconnect_policy.get_delay()
+        log.info("Will retry VM %s in %.1fs" % (self.get_uuid(), delay))
+        deadline = time.time() + delay
+        while (not self._stop_monitoring_request and not self._retry_now and
+               time.time() < deadline):
+            time.sleep(min(1.0, max(deadline - time.time(), 0)))
+        self._retry_now = False
 
     def _send_monitor_error_message(self):
         self._wipe_monitor_error_message_if_needed()
@@ -63,6 +313,11 @@ class MonitoredVM(api_helper.VM):
         except (XenAPI.Failure):
             # this can happen when XAPI is not running.
             pass
+        except util.XSContainerException:
+            # The cause couldn't be determined, which mustn't stop the
+            # monitoring of the VM
+            log.exception("Failed to send the monitor error message for "
+                          "VM %s" % (self.get_uuid()))
 
     def _wipe_monitor_error_message_if_needed(self):
         if self._error_message:
@@ -77,61 +332,327 @@ class MonitoredVM(api_helper.VM):
                 pass
             self._error_message = None
 
+    def _prepare_monitoring(self):
+        self._start_time = time.time()
+        if self._reconnect_policy is None:
+            self._reconnect_policy = ReconnectPolicy()
+        if self._refresh_scheduler is None:
+            self._refresh_scheduler = RefreshScheduler()
+        if self._container_table is None:
+            self._container_table = docker.ContainerTable()
+            self._dirty_containers = set()
+        if not self._adopt_warm_state():
+            self._wipe_docker_other_config()
+
+    def _adopt_warm_state(self):
+        """ Takes over what a previous monitor wrote, if other_config still
+            holds it. Connecting then only writes what differs. """
+        warm_state = self._warm_state
+        self._warm_state = None
+        if not warm_state:
+            return False
+        adopted = self.adopt_written_digests(warm_state.get('digests', {}),
+                                             self.get_other_config())
+        log.info("VM %s: other_config of the previous monitor kept for %s"
+                 % (self.get_uuid(), ", ".join(adopted) or "no keys"))
+        self._other_config_stale = True
+        return True
+
+    def _wipe_docker_other_config(self):
+        docker.wipe_docker_other_config(self)
+        self._other_config_stale = False
+
+    def _refresh_all(self):
+        """ Refreshes everything in other_config and returns the path to
+            subscribe to events with """
+        try:
+            # A reconnect soon after the last fetch, e.g. of a flapping VM,
+            # writes back the info it has got already
+            self._update_docker_info(reuse=True)
+            version = docker.update_docker_version(self)
+            self._update_docker_ps(full=True)
+        except Exception:
+            if self.get_written_digests():
+                self._other_config_stale = True
+            raise
+        self._other_config_stale = False
+        # if we got past the above, it's about time to delete the
+        # error message, as all appears to be working again
+        self._wipe_monitor_error_message_if_needed()
+        self._reconnect_policy.succeeded()
+        self._count('xscontainer_monitor_connects_total')
+        metrics.METRICS.touch('xscontainer_monitor_seconds_since_refresh',
+                              {'vm': self.get_uuid()})
+        self._retry_now = False
+        if self._event_filters_refused:
+            version = None
+        return docker.get_events_path(version)
+
+    def _admitted_refresh_all(self):
+        """ Runs _refresh_all once the AdmissionController lets it. Returns
+            None, if monitoring stopped while waiting. """
+        if not self._admission:
+            return self._refresh_all()
+        if not self._admission.acquire(self.get_id(), self._priority,
+                                       self._stop_monitoring_request):
+            return None
+        try:
+            return self._refresh_all()
+        finally:
+            self._admission.release(self.get_id())
+
+    def _disconnected(self):
+        """ other_config is only wiped if reconnecting fails, so that a
+            short outage doesn't rewrite it """
+        self._refresh_scheduler.clear()
+        self._other_config_stale = True
+        self._count('xscontainer_monitor_disconnects_total')
+        table = self._container_table
+        log.info("VM %s: %d Docker events received, %d acted on, %d "
+                 "refreshes done, %d saved by coalescing, %d containers "
+                 "listed one by one, %d full listings, %d containers out of "
+                 "date at reconciles, %d info fetches, %d other_config "
+                 "writes, %d unchanged writes skipped"
+                 % (self.get_uuid(), self.events_received,
+                    self.events_acted_on, self.refreshes_done,
+                    self._refresh_scheduler.refreshes_saved,
+                    table.incremental_updates, table.reconciles,
+                    table.drift, self.info_fetches, self.other_config_writes,
+                    self.other_config_writes_skipped))
+
+    def _check_event_filters_refused(self, exception, events_path):
+        if (exception.status == 400 and
+                events_path != docker.get_events_path()):
+            # The API version was misleading - filter here
+            log.info("Docker in VM %s refused event filters, will filter "
+                     "the events itself" % (self.get_uuid()))
+            self._event_filters_refused = True
+
+    def _connection_failed(self, exception):
+        if self._other_config_stale:
+            self._wipe_docker_other_config()
+        self._count('xscontainer_monitor_connect_failures_total')
+        persistent = remote_helper.is_persistent_failure(exception)
+        self._reconnect_policy.failed(persistent)
+        passed_time = time.time() - self._start_time
+        if (not self._error_message and
+                passed_time >= MONITOR_TIMEOUT_WARNING_S):
+            self._send_monitor_error_message()
+        log.info("Could not connect to VM %s, will retry" % (self.get_uuid()))
+
+    def _finish_monitoring(self):
+        if self._other_config_stale and not self._keep_other_config:
+            self._wipe_docker_other_config()
+        # Make sure that we don't leave back error messsages for VMs that are
+        # not monitored anymore
+        self._wipe_monitor_error_message_if_needed()
+        metrics.METRICS.remove(vm=self.get_uuid())
+        remote_helper.forget_vm(self.get_uuid())
+        log.info("monitor_loop returns from handling vm %s"
+                 % (self.get_uuid()))
+
     def _monitoring_loop(self):
         vmuuid = self.get_uuid()
         log.info("monitor_loop handles VM %s" % (vmuuid))
-        start_time = time.time()
-        docker.wipe_docker_other_config(self)
+        self._prepare_monitoring()
         # keep track of when to wipe other_config to safe CPU-time
         while not self._stop_monitoring_request:
             try:
-                docker.update_docker_info(self)
-                docker.update_docker_version(self)
-                docker.update_docker_ps(self)
-                # if we got past the above, it's about time to delete the
-                # error message, as all appears to be working again
-                self._wipe_monitor_error_message_if_needed()
+                events_path = self._admitted_refresh_all()
+                if events_path is None:
+                    break
                 try:
                     try:
                         for event in remote_helper.execute_docker_event_listen(
                                 self.get_session(), vmuuid,
-                                self._stop_monitoring_request):
-                            self.handle_docker_event(event)
+                                self._stop_monitoring_request, events_path,
+                                yield_idle=True):
+                            if event is not None:
+                                self.handle_docker_event(event)
+                            self.run_due_refreshes()
                     finally:
-                        docker.wipe_docker_other_config(self)
+                        self._disconnected()
+                except remote_helper.DockerEventsRefused as exception:
+                    self._check_event_filters_refused(exception, events_path)
+                    raise
                 except (XenAPI.Failure, util.XSContainerException):
                     log.exception("__monitor_vm_events threw an exception, "
                                   "will retry")
                     raise
-            except (XenAPI.Failure, util.XSContainerException):
-                passed_time = time.time() - start_time
-                if (not self._error_message and
-                        passed_time >= MONITOR_TIMEOUT_WARNING_S):
-                    self._send_monitor_error_message()
-                log.info("Could not connect to VM %s, will retry" % (vmuuid))
+            except (XenAPI.Failure, util.XSContainerException) as exception:
+                sys.exc_clear()
+                self._connection_failed(exception)
             if not self._stop_monitoring_request:
-                time.sleep(MONITORRETRYSLEEPINS)
-        # Make sure that we don't leave back error messsages for VMs that are
-        # not monitored anymore
-        self._wipe_monitor_error_message_if_needed()
-        log.info("monitor_loop returns from handling vm %s" % (vmuuid))
+                self._wait_before_reconnect()
+        self._finish_monitoring()
 
-    def handle_docker_event(self, event):
+    def get_refresh_for_event(self, event):
+        """ Returns 'ps' or 'info', if the event requires a refresh, else
+            None. Events that aren't of interest are still filtered here, in
+            case Docker is too old to filter them. """
+        self.events_received = self.events_received + 1
+        self._count('xscontainer_docker_events_total')
+        refresh = None
         if 'status' in event:
-            if event['status'] in ['create', 'destroy', 'die',
-                                   'kill', 'pause', 'restart',
-                                   'start', 'stop', 'unpause']:
-                try:
-                    docker.update_docker_ps(self)
-                except util.XSContainerException as exception:
-                    # This can happen, when the docker daemon stops
-                    log.exception(exception)
-            elif event['status'] in ['create', 'destroy', 'delete']:
-                try:
-                    docker.update_docker_info(self)
-                except util.XSContainerException as exception:
-                    # This can happen, when the docker daemon stops
-                    log.exception(exception)
+            if event['status'] in docker.PS_EVENTS:
+                refresh = 'ps'
+            elif event['status'] in docker.INFO_EVENTS:
+                refresh = 'info'
+        if refresh:
+            self.events_acted_on = self.events_acted_on + 1
+            self._count('xscontainer_docker_events_acted_on_total')
+        if refresh == 'ps':
+            self._dirty_lock.acquire()
+            try:
+                self._dirty_containers.add(event.get('id'))
+            finally:
+                self._dirty_lock.release()
+        return refresh
+
+    def check_docker_ps_digest(self, digest):
+        """ Called with the digest of docker_ps in a VM event. The plugin
+            writes docker_ps itself after pause and unpause, which older
+            Docker daemons send no events for. The table is then stale, so
+            the next ps refresh lists all containers and writes the result
+            even if it didn't change. Returns True in that case. """
+        if (self._dirty_containers is None or
+                not self.is_written_by_others('docker_ps', digest)):
+            return False
+        log.info("docker_ps of VM %s has been written by others"
+                 % (self.get_uuid()))
+        self._written_digests.pop('docker_ps', None)
+        self._dirty_lock.acquire()
+        try:
+            self._dirty_containers.add(None)
+        finally:
+            self._dirty_lock.release()
+        return True
+
+    def refresh(self, refresh):
+        self.refreshes_done = self.refreshes_done + 1
+        try:
+            if refresh == 'ps':
+                self._update_docker_ps()
+            elif refresh == 'info':
+                self._update_docker_info()
+        except util.XSContainerException as exception:
+            # This can happen, when the docker daemon stops
+            log.exception(exception)
+            return
+        self._count('xscontainer_monitor_refreshes_total')
+        metrics.METRICS.touch('xscontainer_monitor_seconds_since_refresh',
+                              {'vm': self.get_uuid()})
+
+    def _count(self, name):
+        metrics.METRICS.inc(name, {'vm': self.get_uuid()})
+
+    def _update_docker_info(self, reuse=False):
+        now = time.time()
+        if (not reuse or self._info_xml is None or
+                now - self._info_fetched >= INFO_MIN_INTERVAL_S):
+            self._info_xml = docker.get_info_xml(self.get_session(),
+                                                 self.get_uuid())
+            self._info_fetched = now
+            self._info_due = now + random.uniform(
+                INFO_REFRESH_INTERVAL_S / 2.0, INFO_REFRESH_INTERVAL_S)
+            self.info_fetches = self.info_fetches + 1
+        self.update_other_config_if_changed('docker_info', self._info_xml)
+
+    def _update_docker_ps(self, full=False):
+        """ Only lists the containers that events were about, unless there
+            were too many or the table is due for a full reconcile """
+        self._dirty_lock.acquire()
+        try:
+            dirty = self._dirty_containers
+            self._dirty_containers = set()
+        finally:
+            self._dirty_lock.release()
+        periodic = self._reconcile_requested
+        self._reconcile_requested = False
+        table = self._container_table
+        session = self.get_session()
+        vmuuid = self.get_uuid()
+        try:
+            if (full or periodic or not table.is_seeded() or not dirty or
+                    None in dirty or
+                    len(dirty) > docker.CONTAINER_TABLE_INCREMENTAL_MAX):
+                table.reconcile(session, vmuuid, periodic)
+            else:
+                for container_id in dirty:
+                    table.update_container(session, vmuuid, container_id)
+        except Exception:
+            # The next ps refresh lists them instead. A failed periodic
+            # reconcile is still due and is requested again.
+            self._dirty_lock.acquire()
+            try:
+                self._dirty_containers.update(dirty)
+            finally:
+                self._dirty_lock.release()
+            raise
+        self.update_other_config_if_changed('docker_ps', table.get_ps_xml())
+
+    def request_reconcile_if_due(self):
+        """ Returns True, if a full reconcile of the containers has been
+            requested """
+        if (not self._container_table.is_seeded() or
+                not self._container_table.needs_reconcile()):
+            return False
+        if not self._reconcile_requested:
+            self._reconcile_requested = True
+            self._refresh_scheduler.request('ps')
+        return True
+
+    def request_info_if_due(self):
+        """ Returns True, if the periodic info refresh has been requested """
+        if self._info_due is None or time.time() < self._info_due:
+            return False
+        # The refresh sets when the next one is due
+        self._info_due = None
+        self.request_refresh('info')
+        return True
+
+    def request_periodic_refreshes(self):
+        """ Returns True, if a periodic refresh has been requested """
+        reconcile = self.request_reconcile_if_due()
+        info = self.request_info_if_due()
+        return reconcile or info
+
+    def request_refresh(self, refresh):
+        not_before = None
+        if refresh == 'info':
+            not_before = self._info_fetched + INFO_MIN_INTERVAL_S
+        self._refresh_scheduler.request(refresh, not_before=not_before)
+
+    def run_due_refreshes(self):
+        self.request_periodic_refreshes()
+        for refresh in self._refresh_scheduler.pop_due():
+            self.refresh(refresh)
+
+    def handle_docker_event(self, event):
+        """ Returns True, if the event asked for a refresh. The refresh is
+            coalesced with those of further events - see RefreshScheduler
+            and run_due_refreshes. """
+        refresh = self.get_refresh_for_event(event)
+        if refresh:
+            self.request_refresh(refresh)
+            return True
+        return False
+
+
+def _get_xscontainer_config(vmrecord):
+    """ Returns the settings in other_config that affect connecting """
+    other_config = vmrecord['other_config']
+    return dict((key, value) for (key, value) in other_config.iteritems()
+                if key.startswith('xscontainer-') and key != REGISTRATION_KEY)
+
+
+def _get_relevant_fields(vmrecord):
+    """ Returns what process_vmrecord looks at in a VM record """
+    other_config = vmrecord['other_config']
+    return (vmrecord['power_state'], vmrecord['resident_on'],
+            vmrecord['guest_metrics'], vmrecord['is_control_domain'],
+            sorted((key, value) for (key, value) in other_config.iteritems()
+                   if key.startswith('xscontainer-')))
 
 
 class DockerMonitor(object):
@@ -143,11 +664,35 @@ class DockerMonitor(object):
     host = None
     # tls_secret_cache[VMREF][TLS_SECRET_UUID]
     tls_secret_cache = {}
+    reactor = None
+    write_queue = None
+    state_path = None
+    admission = None
+    metrics_exporter = None
 
-    def __init__(self, host=None):
+    def __init__(self, host=None, mode=MONITOR_MODE, write_budget=None):
         self.vms = {}
+        # _vm_fields[VMREF] = _get_relevant_fields of the last record
+        self._vm_fields = {}
+        self.vm_events_processed = 0
+        self.vm_events_suppressed = 0
+        # _warm_states[VMREF] = state of the VM saved by a previous monitor
+        self._warm_states = {}
 
         self.set_host(host)
+        if write_budget is None:
+            write_budget = WRITE_BUDGET_PER_S
+        if write_budget:
+            self.write_queue = writer.WriteBehindQueue(write_budget)
+            self.write_queue.start()
+        self.admission = admission.AdmissionController()
+        if mode == 'reactor':
+            if reactor.is_supported():
+                self.reactor = reactor.MonitorReactor()
+                self.reactor.start()
+            else:
+                log.warning("epoll is not available - monitoring VMs with "
+                            "threads instead")
 
     def set_host(self, host):
         self.host = host
@@ -179,12 +724,14 @@ class DockerMonitor(object):
     def is_registered_vm_ref(self, vm_ref):
         return vm_ref in self.vms.keys()
 
-    def start_monitoring(self, vm_ref):
+    def start_monitoring(self, vm_ref, fast_connect=False, priority=0):
         log.info("Starting to monitor VM: %s" % vm_ref)
         thevm = MonitoredVM(self.host.client, ref=vm_ref)
         self.register(thevm)
-        thevm.start_monitoring()
-        return
+        thevm.start_monitoring(fast_connect, self.reactor, self.write_queue,
+                               self._warm_states.pop(vm_ref, None),
+                               self.admission, priority)
+        return thevm
 
     def stop_monitoring(self, vm_ref):
         log.info("Removing monitor for VM ref: %s"
@@ -195,10 +742,34 @@ class DockerMonitor(object):
             thevm.stop_monitoring()
 
     def refresh(self):
-        vm_records = self.host.client.get_all_vm_records()
-        for (vm_ref, vm_rec) in vm_records.items():
-            self.process_vmrecord(vm_ref, vm_rec)
-        return
+        """ Loads the VMs that run on this host. The pool master also loads
+            the halted VMs, to remember their TLS secrets. """
+        start = time.time()
+        client = self.host.client
+        vm_records = client.get_vm_records_where(
+            RESIDENT_VMS_EXPRESSION % (self.host.ref))
+        # Measure how long it takes until all VMs have tried to connect
+        if self.admission:
+            self.admission.begin_ramp()
+        try:
+            for (vm_ref, vm_rec) in vm_records.items():
+                self.process_vmrecord(vm_ref, vm_rec)
+        finally:
+            if self.admission:
+                self.admission.end_ramp()
+        # Stop monitoring VMs that left this host while we weren't listening
+        for vm_ref in self.vms.keys():
+            if vm_ref not in vm_records:
+                self.stop_monitoring(vm_ref)
+        loaded = len(vm_records)
+        session = client.get_session()
+        if api_helper.get_pool_master_ref(session) == self.host.ref:
+            vm_records = client.get_vm_records_where(HALTED_VMS_EXPRESSION)
+            for (vm_ref, vm_rec) in vm_records.items():
+                self.process_vmrecord(vm_ref, vm_rec)
+            loaded = loaded + len(vm_records)
+        log.info("Loaded %d VM records in %.2fs"
+                 % (loaded, time.time() - start))
 
     def _should_monitor(self, vmrecord):
         # Check the VM is registered for monitoring
@@ -227,17 +798,27 @@ class DockerMonitor(object):
             # If conditions above are met, we should process the event.
             return True
 
-    def process_vmrecord(self, vmref, vmrecord):
+    def process_vmrecord(self, vmref, vmrecord, from_event=False):
         """
         This function is for processing a vmrecord and determining the course
-        of action that should be taken.
+        of action that should be taken. from_event is set for records of
+        VM events, i.e. changes while we are running.
         """
+        self._vm_fields[vmref] = _get_relevant_fields(vmrecord)
         is_monitored = self.is_registered_vm_ref(vmref)
         should_monitor = self._should_monitor(vmrecord)
-        if not is_monitored and should_monitor:
-            self.start_monitoring(vmref)
-        elif is_monitored and not should_monitor:
+        if should_monitor:
+            thevm = self.get_vm_by_ref(vmref)
+            if not is_monitored:
+                # A VM that just got guest metrics is likely booting. VMs
+                # with a lower start order connect first.
+                thevm = self.start_monitoring(vmref, from_event,
+                                              int(vmrecord.get('order', 0)))
+            thevm.update_config(_get_xscontainer_config(vmrecord))
+        elif is_monitored:
             self.stop_monitoring(vmref)
+            # The VM may come back with different IPs, e.g. after a reboot
+            api_helper.forget_suitable_vm_ip(vmrecord['uuid'])
         # Remember TLS secrets of VMs to tidy in process_vm_del
         for key in tls_secret.XSCONTAINER_TLS_KEYS:
             if key in vmrecord['other_config']:
@@ -246,15 +827,108 @@ class DockerMonitor(object):
                 secret_uuid = vmrecord['other_config'][key]
                 self.tls_secret_cache[vmref][key] = secret_uuid
 
-    def tear_down_all(self):
+    def process_vm_event(self, vmref, vmrecord):
+        """
+        Processes the record of a VM mod event, unless nothing changed that
+        process_vmrecord looks at - most events are caused by our own
+        other_config writes. Returns True, if the record was processed.
+        """
+        thevm = self.get_vm_by_ref(vmref)
+        if thevm and 'docker_ps' in vmrecord['other_config']:
+            thevm.check_docker_ps_digest(api_helper.get_digest(
+                vmrecord['other_config']['docker_ps']))
+        if self._vm_fields.get(vmref) == _get_relevant_fields(vmrecord):
+            self.vm_events_suppressed = self.vm_events_suppressed + 1
+            return False
+        self.vm_events_processed = self.vm_events_processed + 1
+        self.process_vmrecord(vmref, vmrecord, from_event=True)
+        return True
+
+    def export_metrics(self, path, host_labels=None):
+        """ Writes the metrics of this process to path from now on, until
+            tear_down_all """
+        metrics.METRICS.add_collector(self._collect_metrics)
+        self.metrics_exporter = metrics.start_exporter(path, host_labels)
+
+    def stop_exporting_metrics(self):
+        if self.metrics_exporter:
+            self.metrics_exporter.stop(remove=True)
+
+    def _collect_metrics(self):
+        values = [('xscontainer_monitor_vms', metrics.GAUGE, {},
+                   len(self.vms)),
+                  ('xscontainer_xapi_vm_events_total', metrics.COUNTER,
+                   {'result': 'processed'}, self.vm_events_processed),
+                  ('xscontainer_xapi_vm_events_total', metrics.COUNTER,
+                   {'result': 'suppressed'}, self.vm_events_suppressed)]
+        if self.write_queue:
+            stats = self.write_queue.get_stats()
+            values.extend([
+                ('xscontainer_write_queue_depth', metrics.GAUGE, {},
+                 stats['depth']),
+                ('xscontainer_write_queue_oldest_seconds', metrics.GAUGE, {},
+                 stats['oldest_s']),
+                ('xscontainer_write_queue_latency_max_seconds',
+                 metrics.GAUGE, {}, stats['latency_max_s']),
+                ('xscontainer_write_queue_writes_total', metrics.COUNTER,
+                 {'result': 'written'}, stats['writes']),
+                ('xscontainer_write_queue_writes_total', metrics.COUNTER,
+                 {'result': 'superseded'}, stats['superseded']),
+                ('xscontainer_write_queue_writes_total', metrics.COUNTER,
+                 {'result': 'failed'}, stats['failures'])])
+        if self.admission:
+            stats = self.admission.get_stats()
+            values.extend([
+                ('xscontainer_admission_connecting', metrics.GAUGE, {},
+                 stats['connecting']),
+                ('xscontainer_admission_waiting', metrics.GAUGE, {},
+                 stats['waiting'])])
+            if stats['last_ramp_s'] is not None:
+                values.append(('xscontainer_startup_ramp_seconds',
+                               metrics.GAUGE, {}, stats['last_ramp_s']))
+        return values
+
+    def log_stats(self):
+        log.info("Monitoring %d VMs, %d VM events processed, %d ignored as "
+                 "nothing relevant changed"
+                 % (len(self.vms), self.vm_events_processed,
+                    self.vm_events_suppressed))
+
+    def get_state(self):
+        """ Returns what a restarted monitor needs to know to continue with
+            the other_config that is left behind """
+        vms = {}
+        for thevm in self.get_registered():
+            vms[thevm.get_id()] = {'digests': thevm.get_written_digests()}
+        return {'vms': vms, 'ips': api_helper.VM_IP_CACHE.get_state()}
+
+    def load_state(self, path):
+        self.state_path = path
+        saved = state.load(path)
+        if saved:
+            self._warm_states = saved.get('vms', {})
+            api_helper.VM_IP_CACHE.load_state(saved.get('ips', []))
+            log.info("Loaded the state of %d VMs from %s"
+                     % (len(self._warm_states), path))
+
+    def tear_down_all(self, keep_other_config=False):
+        """ keep_other_config leaves other_config for a restarted monitor,
+            to take over with the state that is saved for it """
+        keep_other_config = keep_other_config and self.state_path is not None
         for entry in self.get_registered():
-            entry.stop_monitoring()
+            entry.stop_monitoring(keep_other_config)
         # @todo: we could have wait for thread.join with timeout here
         # Wait for children
         time.sleep(2)
+        if self.write_queue:
+            self.write_queue.stop(WRITE_QUEUE_STOP_TIMEOUT_S)
+        if keep_other_config:
+            state.save(self.state_path, self.get_state())
+        self.stop_exporting_metrics()
 
     def process_vm_del(self, vm_ref):
         """ Tidy TLS secrets after vm-destroy """
+        self._vm_fields.pop(vm_ref, None)
         if vm_ref in self.tls_secret_cache:
             for key in tls_secret.XSCONTAINER_TLS_KEYS:
                 if key in self.tls_secret_cache[vm_ref]:
@@ -266,6 +940,132 @@ class DockerMonitor(object):
             del(self.tls_secret_cache[vm_ref])
 
 
+class ShardedVM(object):
+
+    """Stands in for a MonitoredVM that is monitored by a shard process."""
+
+    def __init__(self, supervisor, vm_ref):
+        self._supervisor = supervisor
+        self.ref = vm_ref
+        # Of the docker_ps value that the last event showed
+        self._docker_ps_digest = None
+
+    def get_id(self):
+        return self.ref
+
+    def start_monitoring(self, fast_connect=False, priority=0):
+        self._supervisor.start(self.ref, fast_connect, priority)
+
+    def stop_monitoring(self, keep_other_config=False):
+        self._supervisor.stop(self.ref)
+
+    def update_config(self, config):
+        self._supervisor.update_config(self.ref, config)
+
+    def check_docker_ps_digest(self, digest):
+        # Most events are about writes of other keys
+        if digest != self._docker_ps_digest:
+            self._docker_ps_digest = digest
+            self._supervisor.check_docker_ps_digest(self.ref, digest)
+
+
+class ShardedDockerMonitor(DockerMonitor):
+
+    """
+    Decides which VMs to monitor like DockerMonitor, but has them monitored
+    by shard processes.
+    """
+
+    def __init__(self, host=None, processes=None, write_budget=None):
+        # The shards write other_config and connect, so the supervisor has
+        # no write queue and no admission control
+        DockerMonitor.__init__(self, host, write_budget=0)
+        self.admission = None
+        if not processes:
+            processes = multiprocessing.cpu_count()
+        if write_budget is None:
+            write_budget = WRITE_BUDGET_PER_S
+        log.info("Monitoring VMs with %d shard processes" % (processes))
+        # The shards share the budget of the host
+        self.supervisor = sharding.ShardSupervisor(
+            processes, _run_monitor_shard,
+            (float(write_budget) / processes,))
+        thread.start_new_thread(self._watch_shards, tuple())
+
+    def start_monitoring(self, vm_ref, fast_connect=False, priority=0):
+        log.info("Starting to monitor VM: %s" % vm_ref)
+        thevm = ShardedVM(self.supervisor, vm_ref)
+        self.register(thevm)
+        thevm.start_monitoring(fast_connect, priority)
+        return thevm
+
+    def tear_down_all(self, keep_other_config=False):
+        # The shards save their state when they are told to exit
+        self.supervisor.stop_all()
+        self.stop_exporting_metrics()
+
+    def _watch_shards(self):
+        while True:
+            time.sleep(SHARD_CHECK_INTERVAL_S)
+            try:
+                self.supervisor.check_workers()
+            except Exception:
+                log.exception("Failed to check the monitor shards")
+
+
+def _run_monitor_shard(shard, pipe, write_budget=None):
+    """ The main function of a shard process """
+    global DOCKER_MONITOR
+    # Don't share the XAPI connection of the supervisor, nor its copy of
+    # the records, which no events would keep current here. The locks of
+    # the shared objects are new since the fork, see
+    # util.recreate_lock_after_fork.
+    api_helper.GLOBAL_XAPI_SESSION_LOCK = threading.Lock()
+    api_helper.GLOBAL_XAPI_SESSION = None
+    api_helper.RECORD_CACHE.clear()
+    log.info("Monitor shard %d started" % (shard))
+    client = api_helper.LocalXenAPIClient()
+    host = api_helper.Host(client,
+                           api_helper.get_this_host_ref(client.get_session()))
+    DOCKER_MONITOR = DockerMonitor(host, 'reactor', write_budget)
+    DOCKER_MONITOR.load_state(state.get_shard_path(state.STATE_PATH, shard))
+    # The series that aren't about a VM are reported by every shard
+    DOCKER_MONITOR.export_metrics(
+        state.get_shard_path(metrics.METRICS_PATH, shard), {'shard': shard})
+    supervisor_pid = os.getppid()
+    # The VMs handed over in the first burst of commands make up the ramp
+    DOCKER_MONITOR.admission.begin_ramp()
+    while True:
+        try:
+            if not pipe.poll(SHARD_CHECK_INTERVAL_S):
+                DOCKER_MONITOR.admission.end_ramp()
+                if os.getppid() != supervisor_pid:
+                    # The supervisor is gone without telling us
+                    break
+                continue
+            message = pipe.recv()
+        except EOFError:
+            # The supervisor is gone
+            break
+        if message[0] == 'start':
+            DOCKER_MONITOR.start_monitoring(message[1], message[2],
+                                            message[3])
+        elif message[0] == 'stop':
+            DOCKER_MONITOR.stop_monitoring(message[1])
+        elif message[0] == 'config':
+            thevm = DOCKER_MONITOR.get_vm_by_ref(message[1])
+            if thevm:
+                thevm.update_config(message[2])
+        elif message[0] == 'ps':
+            thevm = DOCKER_MONITOR.get_vm_by_ref(message[1])
+            if thevm:
+                thevm.check_docker_ps_digest(message[2])
+        elif message[0] == 'exit':
+            break
+    DOCKER_MONITOR.tear_down_all(keep_other_config=True)
+    log.info("Monitor shard %d exits" % (shard))
+
+
 def interrupt_handler(signum, frame):
     """
     This function handles SIGTERM and SIGINT. It does by tearing down the
@@ -275,11 +1075,11 @@ def interrupt_handler(signum, frame):
     if DOCKER_MONITOR:
         util.log.warning("Signal %d received  - Tearing down monitoring"
                          % (signum))
-        DOCKER_MONITOR.tear_down_all()
+        DOCKER_MONITOR.tear_down_all(keep_other_config=True)
     sys.exit(0)
 
 
-def monitor_host():
+def monitor_host(mode=MONITOR_MODE, processes=None, write_budget=None):
     global DOCKER_MONITOR
     session = None
     host = None
@@ -297,33 +1097,51 @@ def monitor_host():
             # need to refresh the host, in case we just joined a pool
             host = api_helper.Host(client,
                                    api_helper.get_this_host_ref(session))
-            if not DOCKER_MONITOR:
-                DOCKER_MONITOR = DockerMonitor(host)
+            if not DOCKER_MONITOR and mode == 'sharded':
+                DOCKER_MONITOR = ShardedDockerMonitor(host, processes,
+                                                      write_budget)
+                DOCKER_MONITOR.export_metrics(metrics.METRICS_PATH)
+            elif not DOCKER_MONITOR:
+                DOCKER_MONITOR = DockerMonitor(host, mode, write_budget)
+                DOCKER_MONITOR.load_state(state.STATE_PATH)
+                DOCKER_MONITOR.export_metrics(metrics.METRICS_PATH)
             else:
                 DOCKER_MONITOR.set_host(host)
             log.info("Monitoring host %s" % (host.get_id()))
             try:
-                # Avoid race conditions - get a current event token
-                event_from = session.xenapi.event_from(["vm"], '',  0.0)
-                token_from = event_from['token']
+                # Avoid race conditions - get a current event token. It
+                # only comes with the pool record, the records of the VMs,
+                # hosts and networks are kept in api_helper.RECORD_CACHE
+                # once fetched, and the events keep them current.
+                token_from = api_helper.RECORD_CACHE.load(session)
                 # Now load the VMs that are enabled for monitoring
                 DOCKER_MONITOR.refresh()
+                next_report = time.time() + STATS_REPORT_INTERVAL_S
                 while True:
                     event_from = session.xenapi.event_from(
-                        ["vm"], token_from, EVENT_FROM_TIMEOUT_S)
+                        api_helper.RECORD_CACHE_CLASSES, token_from,
+                        EVENT_FROM_TIMEOUT_S)
                     token_from = event_from['token']
                     events = event_from['events']
+                    api_helper.RECORD_CACHE.apply_events(events)
                     for event in events:
-                        if (event['operation'] == 'mod' and
+                        if event['class'] != 'vm':
+                            continue
+                        elif (event['operation'] == 'mod' and
                                 'snapshot' in event):
                             # At this point the monitor may need to
                             # refresh it's monitoring state of a particular
                             # vm.
-                            DOCKER_MONITOR.process_vmrecord(event['ref'],
+                            DOCKER_MONITOR.process_vm_event(event['ref'],
                                                             event['snapshot'])
                         elif event['operation'] == 'del':
                             DOCKER_MONITOR.process_vm_del(event['ref'])
+                    if time.time() >= next_report:
+                        DOCKER_MONITOR.log_stats()
+                        next_report = time.time() + STATS_REPORT_INTERVAL_S
             finally:
+                # Without events, the records would go stale
+                api_helper.RECORD_CACHE.clear()
                 try:
                     session.xenapi.session.logout()
                 except XenAPI.Failure:
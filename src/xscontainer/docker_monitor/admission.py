@@ -0,0 +1,148 @@
+"""
+Limits how many VMs set up their connection to Docker at the same time, so
+that starting to monitor hundreds of VMs at once, e.g. after a host reboot,
+doesn't make the SSH/TLS handshakes and first refreshes time out.
+"""
+from xscontainer.util import log
+
+import heapq
+import threading
+import time
+
+MAX_CONNECTING = 8
+ACQUIRE_POLL_S = 1.0
+
+
+class AdmissionController(object):
+
+    """
+    Admits up to limit connection setups at a time. Waiting setups are
+    admitted by priority - lower first - and else in the order they came
+    in. Also measures how long the ramp after begin_ramp takes, until every
+    VM expected during the ramp had its first go.
+    """
+
+    def __init__(self, limit=MAX_CONNECTING):
+        self.limit = limit
+        self._lock = threading.Lock()
+        # _waiting = [(priority, sequence, key, callback), ...] as a heap
+        self._waiting = []
+        self._sequence = 0
+        self._admitted = set()
+        self._ramp = set()
+        self._ramp_start = None
+        self._ramp_size = 0
+        self._ramp_collecting = False
+        self.last_ramp_s = None
+
+    def request(self, key, callback, priority=0):
+        """ Calls callback, from this or another thread, once key has been
+            admitted. Thread-safe. """
+        self._lock.acquire()
+        try:
+            self._remove_waiting(key)
+            if key in self._admitted or len(self._admitted) < self.limit:
+                self._admitted.add(key)
+            else:
+                self._sequence = self._sequence + 1
+                heapq.heappush(self._waiting, (priority, self._sequence, key,
+                                               callback))
+                return
+        finally:
+            self._lock.release()
+        callback()
+
+    def acquire(self, key, priority=0, stop_request=None):
+        """ Waits for key to be admitted. Returns False, if stop_request -
+            see MonitoredVM - came in meanwhile. """
+        admitted = threading.Event()
+        self.request(key, admitted.set, priority)
+        while not admitted.is_set():
+            admitted.wait(ACQUIRE_POLL_S)
+            if stop_request:
+                self.cancel(key)
+                return False
+        return True
+
+    def release(self, key):
+        """ The connection setup of key is done, whether it worked or not """
+        self._lock.acquire()
+        try:
+            self._admitted.discard(key)
+            self._ramp.discard(key)
+            callbacks = self._admit_waiting()
+            self._check_ramp()
+        finally:
+            self._lock.release()
+        for callback in callbacks:
+            callback()
+
+    def cancel(self, key):
+        """ key doesn't need to connect anymore """
+        self._lock.acquire()
+        try:
+            self._remove_waiting(key)
+        finally:
+            self._lock.release()
+        self.release(key)
+
+    def begin_ramp(self):
+        self._lock.acquire()
+        try:
+            self._ramp = set()
+            self._ramp_start = time.time()
+            self._ramp_collecting = True
+        finally:
+            self._lock.release()
+
+    def expect(self, key):
+        """ key is part of the ramp, if it is being collected """
+        self._lock.acquire()
+        try:
+            if self._ramp_collecting:
+                self._ramp.add(key)
+        finally:
+            self._lock.release()
+
+    def end_ramp(self):
+        """ All keys of the ramp are known """
+        self._lock.acquire()
+        try:
+            self._ramp_collecting = False
+            self._ramp_size = len(self._ramp)
+            self._check_ramp()
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        self._lock.acquire()
+        try:
+            return {'connecting': len(self._admitted),
+                    'waiting': len(self._waiting),
+                    'last_ramp_s': self.last_ramp_s}
+        finally:
+            self._lock.release()
+
+    def _remove_waiting(self, key):
+        waiting = [entry for entry in self._waiting if entry[2] != key]
+        if len(waiting) != len(self._waiting):
+            heapq.heapify(waiting)
+            self._waiting = waiting
+
+    def _admit_waiting(self):
+        callbacks = []
+        while self._waiting and len(self._admitted) < self.limit:
+            _, _, key, callback = heapq.heappop(self._waiting)
+            self._admitted.add(key)
+            callbacks.append(callback)
+        return callbacks
+
+    def _check_ramp(self):
+        if (self._ramp_start is None or self._ramp_collecting or
+                self._ramp):
+            return
+        self.last_ramp_s = time.time() - self._ramp_start
+        self._ramp_start = None
+        log.info("Startup ramp done: %d VMs tried to connect within %.1fs, "
+                 "at most %d at a time"
+                 % (self._ramp_size, self.last_ramp_s, self.limit))
@@ -0,0 +1,439 @@
+"""
+Monitors the Docker event streams of all VMs from a single thread using
+epoll, rather than with a thread per VM. Blocking work - connecting,
+refreshing other_config and sending messages via XAPI - is handed to a
+small pool of worker threads. Jobs of the same VM never run concurrently.
+"""
+from xscontainer import remote_helper
+from xscontainer import util
+from xscontainer.remote_helper import http_client
+from xscontainer.util import log
+
+import collections
+import errno
+import fcntl
+import heapq
+import os
+import Queue
+import select
+import sys
+import threading
+import time
+import XenAPI
+
+WORKER_THREADS = 8
+STOP_TIMEOUT_S = 5
+# How often to check whether a VM's containers are due for a full listing
+# or its info for a refresh
+RECONCILE_CHECK_INTERVAL_S = 30
+
+
+def is_supported():
+    return hasattr(select, 'epoll')
+
+
+class WorkerPool(object):
+
+    """Runs jobs on a fixed number of threads."""
+
+    def __init__(self, size):
+        self._queue = Queue.Queue()
+        self._threads = []
+        for _ in range(size):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._threads.append(worker)
+
+    def submit(self, function, *args):
+        self._queue.put((function, args))
+
+    def stop(self, timeout=None):
+        for _ in self._threads:
+            self._queue.put(None)
+        for worker in self._threads:
+            worker.join(timeout)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            function, args = job
+            try:
+                function(*args)
+            except Exception:
+                log.exception("Monitor job %s failed" % (function.__name__))
+
+
+class VmState(object):
+
+    """What the reactor knows about a monitored VM."""
+
+    def __init__(self, thevm):
+        self.vm = thevm
+        self.connection = None
+        self.fileno = None
+        self.decoder = None
+        self.events_path = None
+        self.stopped = False
+        # Increased to invalidate pending reconnect timers
+        self.generation = 0
+        self.waiting = False
+        # When the timer for the next coalesced refresh is due
+        self.refresh_due = None
+        # Jobs run one after the other: (key, function, args)
+        self.busy = False
+        self.jobs = collections.deque()
+
+
+class MonitorReactor(object):
+
+    """
+    Multiplexes the event streams, reconnect timers and refresh jobs of all
+    monitored VMs. Apart from add_vm, remove_vm, retry_now and stop, the
+    methods must only be called on the reactor's thread.
+    """
+
+    def __init__(self, workers=WORKER_THREADS):
+        self._epoll = select.epoll()
+        self._pool = WorkerPool(workers)
+        # _timers = [(when, sequence, function, args), ...] as a heap
+        self._timers = []
+        self._sequence = 0
+        self._calls_lock = threading.Lock()
+        self._calls = []
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._epoll.register(self._wakeup_read, select.EPOLLIN)
+        # _streams[fileno] = VmState
+        self._streams = {}
+        # _vms[id(thevm)] = VmState
+        self._vms = {}
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """ Stops monitoring all VMs. With a timeout, waits for the
+            reactor's thread to finish. """
+        self.call_soon(self._stop)
+        if timeout is not None and self._thread:
+            self._thread.join(timeout)
+
+    def add_vm(self, thevm):
+        self.call_soon(self._add_vm, thevm)
+
+    def remove_vm(self, thevm):
+        self.call_soon(self._remove_vm, thevm)
+
+    def retry_now(self, thevm):
+        self.call_soon(self._retry_now, thevm)
+
+    def call_soon(self, function, *args):
+        """ Runs function on the reactor's thread. Thread-safe. """
+        self._calls_lock.acquire()
+        try:
+            self._calls.append((function, args))
+        finally:
+            self._calls_lock.release()
+        try:
+            os.write(self._wakeup_write, 'x')
+        except OSError as exception:
+            # The pipe is full, so the reactor is woken up anyway
+            if exception.errno != errno.EAGAIN:
+                raise
+            sys.exc_clear()
+
+    def call_later(self, delay, function, *args):
+        self._sequence = self._sequence + 1
+        heapq.heappush(self._timers, (time.time() + delay, self._sequence,
+                                      function, args))
+
+    def run(self):
+        self._running = True
+        while self._running:
+            timeout = -1
+            if self._timers:
+                timeout = max(self._timers[0][0] - time.time(), 0)
+            try:
+                ready = self._epoll.poll(timeout)
+            except IOError as exception:
+                if exception.errno != errno.EINTR:
+                    raise
+                sys.exc_clear()
+                continue
+            for fileno, _ in ready:
+                if fileno == self._wakeup_read:
+                    self._drain_wakeup()
+                elif fileno in self._streams:
+                    self._read_stream(self._streams[fileno])
+            self._run_calls()
+            self._run_timers()
+        self._pool.stop(STOP_TIMEOUT_S)
+        self._epoll.close()
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup_read, 4096):
+                pass
+        except OSError as exception:
+            if exception.errno != errno.EAGAIN:
+                raise
+            sys.exc_clear()
+
+    def _run_calls(self):
+        self._calls_lock.acquire()
+        try:
+            calls = self._calls
+            self._calls = []
+        finally:
+            self._calls_lock.release()
+        for function, args in calls:
+            self._run_safely(function, args)
+
+    def _run_timers(self):
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, function, args = heapq.heappop(self._timers)
+            self._run_safely(function, args)
+
+    def _run_safely(self, function, args):
+        try:
+            function(*args)
+        except Exception:
+            log.exception("Monitor reactor call %s failed"
+                          % (function.__name__))
+
+    def _stop(self):
+        for state in self._vms.values():
+            self._remove_vm(state.vm)
+        self._running = False
+
+    # Jobs
+
+    def _submit(self, state, key, function, *args):
+        """ Queues a job for a worker. A job with the same key that is still
+            queued for the VM makes this one unnecessary. Returns True, if
+            the job has been queued. """
+        if key is not None:
+            for job in state.jobs:
+                if job[0] == key:
+                    return False
+        state.jobs.append((key, function, args))
+        self._run_next_job(state)
+        return True
+
+    def _run_next_job(self, state):
+        if state.busy or not state.jobs:
+            return
+        state.busy = True
+        _, function, args = state.jobs.popleft()
+        self._pool.submit(self._run_job, state, function, args)
+
+    def _run_job(self, state, function, args):
+        """ Runs on a worker thread """
+        try:
+            function(*args)
+        finally:
+            self.call_soon(self._job_done, state)
+
+    def _job_done(self, state):
+        state.busy = False
+        self._run_next_job(state)
+
+    # VMs
+
+    def _add_vm(self, thevm):
+        if id(thevm) in self._vms:
+            return
+        state = VmState(thevm)
+        self._vms[id(thevm)] = state
+        self._submit(state, None, self._prepare_job, state)
+        self._connect(state, state.generation)
+
+    def _remove_vm(self, thevm):
+        state = self._vms.pop(id(thevm), None)
+        if state is None:
+            return
+        state.stopped = True
+        state.generation = state.generation + 1
+        connection = self._unregister_stream(state)
+        self._submit(state, None, self._finish_job, state, connection)
+
+    def _retry_now(self, thevm):
+        state = self._vms.get(id(thevm))
+        if state and state.waiting:
+            state.generation = state.generation + 1
+            self._connect(state, state.generation)
+
+    def _reconnect_later(self, state):
+        if state.stopped:
+            return
+        delay = state.vm._reconnect_policy.get_delay()
+        log.info("Will retry VM %s in %.1fs" % (state.vm.get_uuid(), delay))
+        state.waiting = True
+        self.call_later(delay, self._connect, state, state.generation)
+
+    def _connect(self, state, generation):
+        if state.stopped or generation != state.generation:
+            return
+        state.waiting = False
+        admission = state.vm._admission
+        if admission:
+            admission.request(state.vm.get_id(),
+                              lambda: self.call_soon(self._admitted, state,
+                                                     generation),
+                              state.vm._priority)
+        else:
+            self._submit(state, 'connect', self._connect_job, state)
+
+    def _admitted(self, state, generation):
+        if (state.stopped or generation != state.generation or
+                not self._submit(state, 'connect', self._connect_job,
+                                 state)):
+            # Not needed anymore
+            state.vm._admission.release(state.vm.get_id())
+
+    def _register_stream(self, state, connection, events_path):
+        if state.stopped:
+            self._submit(state, None, self._close_job, state, connection)
+            return
+        state.connection = connection
+        state.fileno = connection.fileno()
+        state.decoder = remote_helper.DockerEventDecoder()
+        state.events_path = events_path
+        self._streams[state.fileno] = state
+        self._epoll.register(state.fileno, select.EPOLLIN)
+        self.call_later(RECONCILE_CHECK_INTERVAL_S, self._check_reconcile,
+                        state, connection)
+
+    def _unregister_stream(self, state):
+        connection = state.connection
+        if connection is not None:
+            self._streams.pop(state.fileno, None)
+            try:
+                self._epoll.unregister(state.fileno)
+            except (IOError, ValueError):
+                sys.exc_clear()
+            state.connection = None
+            state.fileno = None
+            state.decoder = None
+        return connection
+
+    def _read_stream(self, state):
+        thevm = state.vm
+        try:
+            while True:
+                data = state.connection.recv(http_client.RECV_SIZE)
+                if data is None:
+                    # Nothing more to read right now, e.g. just part of a
+                    # TLS record has arrived
+                    return
+                if data == '':
+                    self._stream_closed(state, None)
+                    return
+                for event in state.decoder.feed(data):
+                    refresh = thevm.get_refresh_for_event(event)
+                    if refresh:
+                        thevm.request_refresh(refresh)
+                self._schedule_refreshes(state)
+                if not state.connection.pending():
+                    return
+        except util.XSContainerException as exception:
+            sys.exc_clear()
+            self._stream_closed(state, exception)
+
+    def _check_reconcile(self, state, connection):
+        if state.stopped or state.connection is not connection:
+            return
+        if state.vm.request_periodic_refreshes():
+            self._schedule_refreshes(state)
+        self.call_later(RECONCILE_CHECK_INTERVAL_S, self._check_reconcile,
+                        state, connection)
+
+    def _schedule_refreshes(self, state):
+        due = state.vm._refresh_scheduler.get_next_due()
+        if due is None:
+            return
+        if state.refresh_due is not None and state.refresh_due <= due:
+            # The timer that is set already will come first
+            return
+        state.refresh_due = due
+        self.call_later(max(due - time.time(), 0), self._run_due_refreshes,
+                        state, due)
+
+    def _run_due_refreshes(self, state, due):
+        if state.stopped or state.refresh_due != due:
+            # Superseded by an earlier timer
+            return
+        state.refresh_due = None
+        for refresh in state.vm._refresh_scheduler.pop_due():
+            self._submit(state, refresh, state.vm.refresh, refresh)
+        self._schedule_refreshes(state)
+
+    def _stream_closed(self, state, exception):
+        connection = self._unregister_stream(state)
+        self._submit(state, None, self._disconnected_job, state, connection,
+                     exception, state.events_path)
+
+    # Jobs that run on worker threads
+
+    def _prepare_job(self, state):
+        log.info("monitor_loop handles VM %s" % (state.vm.get_uuid()))
+        state.vm._prepare_monitoring()
+
+    def _connect_job(self, state):
+        thevm = state.vm
+        try:
+            try:
+                events_path = thevm._refresh_all()
+                try:
+                    connection = remote_helper.open_docker_event_stream(
+                        thevm.get_session(), thevm.get_uuid(), events_path)
+                    # A read must never hold up the reactor's thread
+                    connection.setblocking(False)
+                except Exception:
+                    thevm._disconnected()
+                    raise
+            finally:
+                if thevm._admission:
+                    thevm._admission.release(thevm.get_id())
+        except Exception as exception:
+            if not isinstance(exception, (XenAPI.Failure,
+                                          util.XSContainerException)):
+                log.exception("Unexpected failure when connecting to VM %s"
+                              % (thevm.get_uuid()))
+            sys.exc_clear()
+            thevm._connection_failed(exception)
+            self.call_soon(self._reconnect_later, state)
+            return
+        self.call_soon(self._register_stream, state, connection, events_path)
+
+    def _disconnected_job(self, state, connection, exception, events_path):
+        thevm = state.vm
+        connection.close()
+        thevm._disconnected()
+        if exception is not None:
+            log.info("Event stream of VM %s failed: %s"
+                     % (thevm.get_uuid(), exception))
+            if isinstance(exception, remote_helper.DockerEventsRefused):
+                thevm._check_event_filters_refused(exception, events_path)
+            thevm._connection_failed(exception)
+        self.call_soon(self._reconnect_later, state)
+
+    def _close_job(self, state, connection):
+        connection.close()
+        state.vm._disconnected()
+
+    def _finish_job(self, state, connection):
+        if connection is not None:
+            self._close_job(state, connection)
+        state.vm._finish_monitoring()
@@ -0,0 +1,226 @@
+"""
+Spreads the monitored VMs over several worker processes, so that JSON
+decoding, XML conversion and SSH crypto can use more than one Dom0 core.
+VMs are assigned to workers by consistent hashing of the VM ref, so that
+only the VMs of a worker move when it has to be taken out.
+"""
+from xscontainer.util import log
+
+import bisect
+import hashlib
+import multiprocessing
+import threading
+import time
+
+RING_REPLICAS = 64
+# A worker that dies within SHARD_MIN_UPTIME_S of being started more than
+# SHARD_MAX_CRASHES times in a row is taken out of the ring
+SHARD_MIN_UPTIME_S = 60
+SHARD_MAX_CRASHES = 3
+WORKER_STOP_TIMEOUT_S = 5
+
+
+def _hash(key):
+    return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+
+    """Consistent hashing of keys onto shards."""
+
+    def __init__(self, shards=(), replicas=RING_REPLICAS):
+        self._replicas = replicas
+        # _points = [(hash, shard), ...] sorted by hash
+        self._points = []
+        for shard in shards:
+            self.add(shard)
+
+    def add(self, shard):
+        for replica in range(self._replicas):
+            bisect.insort(self._points, (_hash("%s-%d" % (shard, replica)),
+                                         shard))
+
+    def remove(self, shard):
+        self._points = [point for point in self._points if point[1] != shard]
+
+    def get_shards(self):
+        return sorted(set(point[1] for point in self._points))
+
+    def get_shard(self, key):
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, (_hash(key),))
+        if index == len(self._points):
+            index = 0
+        return self._points[index][1]
+
+
+class ShardWorker(object):
+
+    """A worker process and the pipe to send it commands."""
+
+    def __init__(self, shard, target, args):
+        self.shard = shard
+        reader, self._writer = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(
+            target=target, args=(shard, reader) + tuple(args),
+            name="xscontainer-monitor-shard-%d" % (shard))
+        self.process.daemon = True
+        self.process.start()
+        # Only the worker reads from the pipe
+        reader.close()
+        self.started = time.time()
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def send(self, message):
+        try:
+            self._writer.send(message)
+            return True
+        except (IOError, OSError, EOFError, ValueError) as exception:
+            log.info("Failed to send %s to monitor shard %d: %s"
+                     % (message[0], self.shard, exception))
+            return False
+
+    def stop(self):
+        self.send(('exit',))
+        self.process.join(WORKER_STOP_TIMEOUT_S)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.close()
+
+    def close(self):
+        self._writer.close()
+
+
+class ShardSupervisor(object):
+
+    """
+    Assigns VMs to worker processes and forwards the monitoring decisions
+    for them. target(shard, pipe, *args) is run in each worker process and
+    must carry out the commands ('start', vm_ref, fast_connect, priority),
+    ('stop', vm_ref), ('config', vm_ref, config), ('ps', vm_ref, digest)
+    and ('exit',).
+    """
+
+    def __init__(self, processes, target, args=()):
+        self._target = target
+        self._args = args
+        self._lock = threading.Lock()
+        self._ring = HashRing(range(processes))
+        self._workers = {}
+        self._crashes = {}
+        # _vms[vm_ref] = {'shard': shard, 'config': config,
+        #                 'priority': priority}
+        self._vms = {}
+        for shard in range(processes):
+            self._workers[shard] = ShardWorker(shard, target, args)
+            self._crashes[shard] = 0
+
+    def start(self, vm_ref, fast_connect=False, priority=0):
+        self._lock.acquire()
+        try:
+            shard = self._ring.get_shard(vm_ref)
+            self._vms[vm_ref] = {'shard': shard, 'config': None,
+                                 'priority': priority}
+            self._send(shard, ('start', vm_ref, fast_connect, priority))
+        finally:
+            self._lock.release()
+
+    def stop(self, vm_ref):
+        self._lock.acquire()
+        try:
+            entry = self._vms.pop(vm_ref, None)
+            if entry:
+                self._send(entry['shard'], ('stop', vm_ref))
+        finally:
+            self._lock.release()
+
+    def update_config(self, vm_ref, config):
+        self._lock.acquire()
+        try:
+            entry = self._vms.get(vm_ref)
+            if entry:
+                entry['config'] = config
+                self._send(entry['shard'], ('config', vm_ref, config))
+        finally:
+            self._lock.release()
+
+    def check_docker_ps_digest(self, vm_ref, digest):
+        self._lock.acquire()
+        try:
+            entry = self._vms.get(vm_ref)
+            if entry:
+                self._send(entry['shard'], ('ps', vm_ref, digest))
+        finally:
+            self._lock.release()
+
+    def get_shard(self, vm_ref):
+        entry = self._vms.get(vm_ref)
+        if entry:
+            return entry['shard']
+        return None
+
+    def check_workers(self):
+        """ Replaces workers that died and hands them their VMs again. A
+            worker that keeps crashing is taken out and its VMs are spread
+            over the others. """
+        self._lock.acquire()
+        try:
+            for shard in self._ring.get_shards():
+                worker = self._workers[shard]
+                if worker.is_alive():
+                    continue
+                log.warning("Monitor shard %d died with exit code %s"
+                            % (shard, worker.process.exitcode))
+                worker.close()
+                if time.time() - worker.started < SHARD_MIN_UPTIME_S:
+                    self._crashes[shard] = self._crashes[shard] + 1
+                else:
+                    self._crashes[shard] = 0
+                if (self._crashes[shard] > SHARD_MAX_CRASHES and
+                        len(self._ring.get_shards()) > 1):
+                    log.error("Monitor shard %d keeps crashing, moving its "
+                              "VMs to other shards" % (shard))
+                    del self._workers[shard]
+                    self._ring.remove(shard)
+                    self._rebalance()
+                    continue
+                self._workers[shard] = ShardWorker(shard, self._target,
+                                                   self._args)
+                for vm_ref, entry in self._vms.iteritems():
+                    if entry['shard'] == shard:
+                        self._send_start(vm_ref, entry)
+        finally:
+            self._lock.release()
+
+    def stop_all(self):
+        self._lock.acquire()
+        try:
+            for worker in self._workers.values():
+                worker.stop()
+            self._vms = {}
+        finally:
+            self._lock.release()
+
+    def _rebalance(self):
+        for vm_ref, entry in self._vms.iteritems():
+            shard = self._ring.get_shard(vm_ref)
+            if shard == entry['shard']:
+                continue
+            if entry['shard'] in self._workers:
+                self._send(entry['shard'], ('stop', vm_ref))
+            entry['shard'] = shard
+            self._send_start(vm_ref, entry)
+
+    def _send_start(self, vm_ref, entry):
+        # A VM that moves isn't booting anymore
+        self._send(entry['shard'], ('start', vm_ref, False,
+                                    entry['priority']))
+        if entry['config'] is not None:
+            self._send(entry['shard'], ('config', vm_ref, entry['config']))
+
+    def _send(self, shard, message):
+        # A worker that can't be reached is dealt with by check_workers
+        self._workers[shard].send(message)
@@ -0,0 +1,59 @@
+"""
+Saves what the monitor knows about the VMs when it is stopped, so that a
+restarted monitor can check the other_config it left behind against Docker
+rather than wiping and rewriting it for every VM.
+"""
+from xscontainer.util import log
+
+import json
+import os
+
+STATE_PATH = '/var/run/xscontainer-monitor.state'
+STATE_VERSION = 1
+
+
+def get_shard_path(path, shard):
+    return "%s.%d" % (path, shard)
+
+
+def save(path, state):
+    state = dict(state)
+    state['version'] = STATE_VERSION
+    temppath = path + '.tmp'
+    try:
+        filehandler = open(temppath, 'w')
+        try:
+            json.dump(state, filehandler)
+        finally:
+            filehandler.close()
+        os.rename(temppath, path)
+    except (IOError, OSError) as exception:
+        log.warning("Failed to save the monitor state to %s: %s"
+                    % (path, exception))
+        return False
+    return True
+
+
+def load(path):
+    """ Returns the state saved at path and removes it, so that it can't be
+        used twice. Returns None, if there is no usable state. """
+    if not os.path.exists(path):
+        return None
+    try:
+        try:
+            filehandler = open(path, 'r')
+            try:
+                state = json.load(filehandler)
+            finally:
+                filehandler.close()
+        finally:
+            os.remove(path)
+    except (IOError, OSError, ValueError) as exception:
+        log.warning("Failed to load the monitor state from %s: %s"
+                    % (path, exception))
+        return None
+    if not isinstance(state, dict) or state.get('version') != STATE_VERSION:
+        log.info("Ignoring the monitor state from %s of another version"
+                 % (path))
+        return None
+    return state
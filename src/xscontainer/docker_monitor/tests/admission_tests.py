@@ -0,0 +1,46 @@
+import unittest
+
+from xscontainer.docker_monitor import admission
+
+
+class TestAdmissionController(unittest.TestCase):
+
+    def test_limit_and_priority(self):
+        controller = admission.AdmissionController(limit=2)
+        admitted = []
+        for key, priority in [('a', 0), ('b', 0), ('c', 5), ('d', 1),
+                              ('e', 1)]:
+            controller.request(key, lambda key=key: admitted.append(key),
+                               priority)
+        self.assertEqual(admitted, ['a', 'b'])
+
+        controller.release('a')
+        controller.release('b')
+        self.assertEqual(admitted, ['a', 'b', 'd', 'e'])
+
+        controller.cancel('c')
+        controller.release('d')
+        self.assertEqual(admitted, ['a', 'b', 'd', 'e'])
+        self.assertEqual(controller.get_stats()['connecting'], 1)
+
+    def test_acquire_is_stopped(self):
+        controller = admission.AdmissionController(limit=1)
+        self.assertTrue(controller.acquire('a'))
+        self.assertFalse(controller.acquire('b', stop_request=['stop']))
+        self.assertEqual(controller.get_stats()['waiting'], 0)
+
+    def test_ramp(self):
+        controller = admission.AdmissionController(limit=1)
+        controller.begin_ramp()
+        controller.expect('a')
+        controller.expect('b')
+        controller.release('a')
+        controller.end_ramp()
+        self.assertEqual(controller.last_ramp_s, None)
+
+        controller.cancel('b')
+        self.assertTrue(controller.last_ramp_s >= 0)
+        # Later VMs aren't part of the ramp
+        controller.expect('c')
+        self.assertEqual(controller.get_stats()['last_ramp_s'],
+                         controller.last_ramp_s)
@@ -1,7 +1,10 @@
+import time
 import unittest
-from mock import MagicMock, patch
+from mock import MagicMock, call, patch
 
+from xscontainer import docker_monitor
 from xscontainer.docker_monitor import DockerMonitor, MonitoredVM
+from xscontainer.docker_monitor import ReconnectPolicy, RefreshScheduler
 
 
 class TestDockerMonitorRegistration(unittest.TestCase):
@@ -70,12 +73,13 @@ class TestDockerMonitorRefresh(unittest.TestCase):
 
         mvm_rec = MagicMock()
 
-        host.client.get_all_vm_records.return_value = {'test_rec': mvm_rec}
+        host.client.get_vm_records_where.return_value = {'test_rec': mvm_rec}
 
         dm = DockerMonitor(host)
         dm.refresh()
 
-        host.client.get_all_vm_records.assert_called_once_with()
+        host.client.get_vm_records_where.assert_called_once_with(
+            docker_monitor.RESIDENT_VMS_EXPRESSION % (host.ref))
         mprocess_vmrecord.assert_called_with('test_rec', mvm_rec)
 
     @patch("xscontainer.docker_monitor.DockerMonitor.process_vmrecord")
@@ -88,16 +92,47 @@ class TestDockerMonitorRefresh(unittest.TestCase):
         for i in range(n):
             mvm_recs["rec_%d" % i] = MagicMock()
 
-        host.client.get_all_vm_records.return_value = mvm_recs
+        host.client.get_vm_records_where.return_value = mvm_recs
 
         dm = DockerMonitor(host)
         dm.refresh()
 
-        host.client.get_all_vm_records.assert_called_once_with()
+        host.client.get_vm_records_where.assert_called_once_with(
+            docker_monitor.RESIDENT_VMS_EXPRESSION % (host.ref))
 
         # Assert we process every record.
         self.assertEqual(mprocess_vmrecord.call_count, n)
 
+    @patch("xscontainer.api_helper.get_pool_master_ref")
+    @patch("xscontainer.docker_monitor.DockerMonitor.process_vmrecord")
+    def test_master_loads_halted_vms(self, mprocess_vmrecord,
+                                     mget_pool_master_ref):
+        host = MagicMock()
+        mget_pool_master_ref.return_value = host.ref
+        host.client.get_vm_records_where.side_effect = [
+            {'running': MagicMock()}, {'halted': MagicMock()}]
+
+        dm = DockerMonitor(host)
+        dm.refresh()
+
+        host.client.get_vm_records_where.assert_called_with(
+            docker_monitor.HALTED_VMS_EXPRESSION)
+        self.assertEqual(mprocess_vmrecord.call_count, 2)
+
+    @patch("xscontainer.docker_monitor.DockerMonitor.process_vmrecord")
+    def test_vm_that_left_is_stopped(self, mprocess_vmrecord):
+        host = MagicMock()
+        host.client.get_vm_records_where.return_value = {}
+        dm = DockerMonitor(host)
+        thevm = MagicMock()
+        thevm.get_id.return_value = 'gone'
+        dm.register(thevm)
+
+        dm.refresh()
+
+        thevm.stop_monitoring.assert_called_once_with()
+        self.assertFalse(dm.is_registered_vm_ref('gone'))
+
 
 class TestDockerMonitorThreads(unittest.TestCase):
 
@@ -129,3 +164,398 @@ class TestDockerMonitorThreads(unittest.TestCase):
         dm.stop_monitoring(mvm_ref)
 
         self.assertEqual(thevm._stop_monitoring_request, ["stop"])
+
+
+class TestDockerMonitorEvents(unittest.TestCase):
+
+    """
+    Test which Docker events lead to a refresh.
+    """
+
+    @patch("xscontainer.docker_monitor.MonitoredVM._update_docker_info")
+    @patch("xscontainer.docker_monitor.MonitoredVM._update_docker_ps")
+    def test_events_acted_on(self, mupdate_docker_ps, mupdate_docker_info):
+        thevm = MonitoredVM(MagicMock(), ref=MagicMock())
+        thevm._refresh_scheduler = RefreshScheduler(window=0)
+        thevm._container_table = docker_monitor.docker.ContainerTable()
+        thevm._dirty_containers = set()
+
+        self.assertTrue(thevm.handle_docker_event({'status': 'die'}))
+        self.assertTrue(thevm.handle_docker_event({'status': 'delete'}))
+        self.assertFalse(thevm.handle_docker_event(
+            {'status': 'exec_start: /bin/healthcheck'}))
+        self.assertFalse(thevm.handle_docker_event({'status': 'resize'}))
+        thevm.run_due_refreshes()
+
+        mupdate_docker_ps.assert_called_once_with()
+        mupdate_docker_info.assert_called_once_with()
+        self.assertEqual(thevm.events_received, 4)
+        self.assertEqual(thevm.events_acted_on, 2)
+
+
+@patch("xscontainer.docker.get_ps_dict")
+class TestContainerTableUpdates(unittest.TestCase):
+
+    """
+    Test that events only lead to the named containers being listed.
+    """
+
+    def setUp(self):
+        self.thevm = MonitoredVM(MagicMock(), ref=MagicMock(), uuid='vm')
+        self.thevm.update_other_config = MagicMock()
+        self.thevm._container_table = docker_monitor.docker.ContainerTable()
+        self.thevm._dirty_containers = set()
+        self.thevm._refresh_scheduler = RefreshScheduler()
+
+    def _entry(self, container_id, created=0):
+        return {'entry': {'id': container_id, 'created': created}}
+
+    def test_event_lists_one_container(self, mget_ps_dict):
+        mget_ps_dict.return_value = [self._entry('a', 1)]
+        self.thevm._update_docker_ps(full=True)
+        mget_ps_dict.assert_called_with(self.thevm.get_session(), 'vm')
+
+        mget_ps_dict.return_value = [self._entry('b', 2)]
+        self.thevm.get_refresh_for_event({'status': 'start', 'id': 'b'})
+        self.thevm._update_docker_ps()
+
+        mget_ps_dict.assert_called_with(self.thevm.get_session(), 'vm', 'b')
+        self.assertEqual(self.thevm._container_table.get_ps_dict(),
+                         [self._entry('b', 2), self._entry('a', 1)])
+
+    def test_failed_listing_is_repeated(self, mget_ps_dict):
+        mget_ps_dict.return_value = [self._entry('a', 1)]
+        self.thevm._update_docker_ps(full=True)
+        self.thevm.get_refresh_for_event({'status': 'start', 'id': 'b'})
+        mget_ps_dict.side_effect = docker_monitor.util.XSContainerException(
+            "Docker is gone")
+        self.thevm.refresh('ps')
+
+        mget_ps_dict.side_effect = None
+        mget_ps_dict.return_value = [self._entry('b', 2)]
+        self.thevm._update_docker_ps()
+
+        mget_ps_dict.assert_called_with(self.thevm.get_session(), 'vm', 'b')
+        self.assertEqual(self.thevm._container_table.get_ps_dict(),
+                         [self._entry('b', 2), self._entry('a', 1)])
+
+    def test_docker_ps_written_by_others(self, mget_ps_dict):
+        mget_ps_dict.return_value = [self._entry('a', 1)]
+        self.thevm._update_docker_ps(full=True)
+        written = self.thevm.update_other_config.call_args[0][1]
+        self.assertFalse(self.thevm.check_docker_ps_digest(
+            docker_monitor.api_helper.get_digest(written)))
+
+        self.assertTrue(self.thevm.check_docker_ps_digest(
+            docker_monitor.api_helper.get_digest('<docker_ps/>')))
+        self.thevm.get_refresh_for_event({'status': 'start', 'id': 'b'})
+        self.thevm._update_docker_ps()
+
+        mget_ps_dict.assert_called_with(self.thevm.get_session(), 'vm')
+        self.assertEqual(self.thevm.update_other_config.call_count, 2)
+
+    def test_burst_lists_all_containers(self, mget_ps_dict):
+        mget_ps_dict.return_value = []
+        self.thevm._update_docker_ps(full=True)
+        for index in range(docker_monitor.docker.
+                           CONTAINER_TABLE_INCREMENTAL_MAX + 1):
+            self.thevm.get_refresh_for_event({'status': 'create',
+                                              'id': str(index)})
+        self.thevm._update_docker_ps()
+
+        mget_ps_dict.assert_called_with(self.thevm.get_session(), 'vm')
+        self.assertEqual(self.thevm._container_table.reconciles, 2)
+
+    def test_periodic_reconcile(self, mget_ps_dict):
+        mget_ps_dict.return_value = [self._entry('a')]
+        self.thevm._update_docker_ps(full=True)
+        self.assertFalse(self.thevm.request_reconcile_if_due())
+
+        self.thevm._container_table.last_reconcile = 0
+        mget_ps_dict.return_value = [self._entry('a'), self._entry('b')]
+        self.assertTrue(self.thevm.request_reconcile_if_due())
+        self.thevm._update_docker_ps()
+
+        self.assertEqual(self.thevm._container_table.drift, 1)
+
+
+class TestRefreshScheduler(unittest.TestCase):
+
+    """
+    Test that bursts of Docker events lead to few refreshes.
+    """
+
+    def test_burst_is_coalesced(self):
+        scheduler = RefreshScheduler(window=1, max_staleness=10)
+        for now in [100.0, 100.5, 101.0]:
+            scheduler.request('ps', now)
+            self.assertEqual(scheduler.pop_due(now), [])
+        # One trailing refresh after the burst
+        self.assertEqual(scheduler.get_next_due(), 102.0)
+        self.assertEqual(scheduler.pop_due(102.0), ['ps'])
+        self.assertEqual(scheduler.get_next_due(), None)
+        self.assertEqual(scheduler.refreshes_saved, 2)
+
+    def test_max_staleness(self):
+        scheduler = RefreshScheduler(window=1, max_staleness=2)
+        for now in [100.0, 100.5, 101.0, 101.5]:
+            scheduler.request('ps', now)
+        self.assertEqual(scheduler.pop_due(102.0), ['ps'])
+        # A new burst starts a new refresh
+        scheduler.request('ps', 102.5)
+        self.assertEqual(scheduler.get_next_due(), 103.5)
+
+    def test_refreshes_are_independent(self):
+        scheduler = RefreshScheduler(window=1, max_staleness=10)
+        scheduler.request('ps', 100.0)
+        scheduler.request('info', 100.5)
+        self.assertEqual(scheduler.pop_due(101.0), ['ps'])
+        self.assertEqual(scheduler.pop_due(101.5), ['info'])
+
+
+class TestReconnectPolicy(unittest.TestCase):
+
+    """
+    Test the delays between reconnects of a VM's monitoring loop.
+    """
+
+    def _assert_delay(self, policy, maximum):
+        delay = policy.get_delay()
+        self.assertTrue(maximum / 2.0 <= delay <= maximum)
+
+    def test_exponential_backoff(self):
+        policy = ReconnectPolicy()
+        policy.failed()
+        self._assert_delay(policy, docker_monitor.MONITORRETRYSLEEPINS)
+        policy.failed()
+        self._assert_delay(policy, 2 * docker_monitor.MONITORRETRYSLEEPINS)
+        for _ in range(20):
+            policy.failed()
+        self._assert_delay(policy, docker_monitor.MONITOR_RETRY_MAX_S)
+        policy.succeeded()
+        self._assert_delay(policy, docker_monitor.MONITORRETRYSLEEPINS)
+
+    def test_persistent_failure(self):
+        policy = ReconnectPolicy()
+        policy.failed(persistent=True)
+        self._assert_delay(policy, docker_monitor.MONITOR_RETRY_PERSISTENT_S)
+        policy.reset()
+        self._assert_delay(policy, docker_monitor.MONITORRETRYSLEEPINS)
+
+    def test_fast_connect_window(self):
+        policy = ReconnectPolicy(fast_connect=True)
+        for _ in range(5):
+            policy.failed()
+        self._assert_delay(policy,
+                           docker_monitor.MONITOR_FAST_CONNECT_RETRY_S)
+        policy.fast_connect_until = 0
+        self._assert_delay(policy, docker_monitor.MONITOR_RETRY_MAX_S)
+
+    def test_config_change_retries_now(self):
+        thevm = MonitoredVM(MagicMock(), ref=MagicMock())
+        thevm._reconnect_policy = ReconnectPolicy()
+        thevm._reconnect_policy.failed(persistent=True)
+
+        thevm.update_config({'xscontainer-username': 'core'})
+        self.assertFalse(thevm._retry_now)
+        thevm.update_config({'xscontainer-username': 'root'})
+        self.assertTrue(thevm._retry_now)
+        self.assertFalse(thevm._reconnect_policy.persistent_failure)
+
+
+class TestWriteBehind(unittest.TestCase):
+
+    def test_writes_are_queued(self):
+        thevm = MonitoredVM(MagicMock(), ref=MagicMock(), uuid='vm')
+        thevm.api_call = MagicMock()
+        thevm._write_queue = MagicMock()
+
+        thevm.update_other_config_if_changed('docker_ps', '<ps/>')
+        thevm.remove_from_other_config('docker_ps')
+
+        self.assertEqual(thevm._write_queue.put.call_args_list,
+                         [call(thevm, 'docker_ps', '<ps/>'),
+                          call(thevm, 'docker_ps', None)])
+        self.assertFalse(thevm.api_call.called)
+
+        thevm.write_other_config('docker_ps', '<ps/>')
+        thevm.write_other_config('docker_ps', '<ps/>')
+        self.assertEqual(thevm.other_config_writes, 1)
+        self.assertEqual(thevm.other_config_writes_skipped, 1)
+
+
+@patch("xscontainer.docker.get_info_xml")
+class TestInfoRefresh(unittest.TestCase):
+
+    def setUp(self):
+        self.thevm = MonitoredVM(MagicMock(), ref=MagicMock(), uuid='vm')
+        self.thevm.update_other_config_if_changed = MagicMock()
+        self.thevm._refresh_scheduler = RefreshScheduler(window=0)
+
+    def test_reconnect_reuses_recent_info(self, mget_info_xml):
+        mget_info_xml.return_value = '<info/>'
+        self.thevm._update_docker_info(reuse=True)
+        self.thevm._update_docker_info(reuse=True)
+
+        self.assertEqual(mget_info_xml.call_count, 1)
+        self.assertEqual(self.thevm.update_other_config_if_changed.call_count,
+                         2)
+
+        self.thevm._info_fetched = (
+            self.thevm._info_fetched - docker_monitor.INFO_MIN_INTERVAL_S)
+        self.thevm._update_docker_info(reuse=True)
+        self.assertEqual(mget_info_xml.call_count, 2)
+
+    def test_info_events_wait_for_min_interval(self, mget_info_xml):
+        self.thevm._update_docker_info()
+        self.thevm.request_refresh('info')
+
+        self.assertEqual(self.thevm._refresh_scheduler.pop_due(), [])
+        due = self.thevm._refresh_scheduler.get_next_due()
+        self.assertEqual(due, self.thevm._info_fetched +
+                         docker_monitor.INFO_MIN_INTERVAL_S)
+
+    def test_periodic_refresh(self, mget_info_xml):
+        self.assertFalse(self.thevm.request_info_if_due())
+        self.thevm._update_docker_info()
+        self.assertTrue(self.thevm._info_due - self.thevm._info_fetched <=
+                        docker_monitor.INFO_REFRESH_INTERVAL_S)
+        self.assertFalse(self.thevm.request_info_if_due())
+
+        self.thevm._info_fetched = 0
+        self.thevm._info_due = 0
+        self.assertTrue(self.thevm.request_info_if_due())
+        self.assertEqual(self.thevm._refresh_scheduler.pop_due(), ['info'])
+        # Only requested once until it is refreshed
+        self.assertFalse(self.thevm.request_info_if_due())
+
+
+class TestMonitorErrorMessage(unittest.TestCase):
+
+    @patch("xscontainer.api_helper.send_message")
+    @patch("xscontainer.remote_helper.determine_error_cause")
+    def test_undetermined_cause_is_tolerated(self, mdetermine_error_cause,
+                                             msend_message):
+        thevm = MonitoredVM(MagicMock(), ref=MagicMock(), uuid='vm')
+        mdetermine_error_cause.side_effect = (
+            docker_monitor.util.XSContainerException("Connect failed"))
+
+        thevm._send_monitor_error_message()
+
+        self.assertFalse(msend_message.called)
+
+
+class TestVmEvents(unittest.TestCase):
+
+    def _record(self, **fields):
+        # Not running, so that processing it doesn't start monitoring
+        record = {'power_state': 'Halted', 'resident_on': 'host',
+                  'guest_metrics': 'metrics', 'is_control_domain': False,
+                  'other_config': {docker_monitor.REGISTRATION_KEY: 'True'}}
+        record.update(fields)
+        return record
+
+    def test_own_writes_are_suppressed(self):
+        dm = DockerMonitor(MagicMock())
+        record = self._record()
+
+        self.assertTrue(dm.process_vm_event('vm', record))
+        record['other_config']['docker_ps'] = '<ps/>'
+        self.assertFalse(dm.process_vm_event('vm', record))
+        record['other_config']['xscontainer-ipv4'] = '10.0.0.2'
+        self.assertTrue(dm.process_vm_event('vm', record))
+        self.assertTrue(dm.process_vm_event(
+            'vm', self._record(resident_on='other')))
+
+        self.assertEqual(dm.vm_events_processed, 3)
+        self.assertEqual(dm.vm_events_suppressed, 1)
+
+    def test_docker_ps_is_checked(self):
+        dm = DockerMonitor(MagicMock())
+        thevm = MagicMock()
+        dm.vms['vm'] = thevm
+        record = self._record(uuid='vm')
+        record['other_config']['docker_ps'] = '<ps/>'
+
+        dm.process_vm_event('vm', record)
+
+        thevm.check_docker_ps_digest.assert_called_once_with(
+            docker_monitor.api_helper.get_digest('<ps/>'))
+
+    def test_deleted_vm_is_forgotten(self):
+        dm = DockerMonitor(MagicMock())
+        dm.process_vmrecord('vm', self._record())
+        dm.process_vm_del('vm')
+
+        self.assertTrue(dm.process_vm_event('vm', self._record()))
+
+
+@patch("xscontainer.remote_helper.forget_vm")
+class TestForgetConnections(unittest.TestCase):
+
+    def setUp(self):
+        self.thevm = MonitoredVM(MagicMock(), ref=MagicMock(), uuid='vm')
+        self.thevm._reconnect_policy = ReconnectPolicy()
+
+    def test_config_change(self, mforget_vm):
+        self.thevm.update_config({'xscontainer-mode': 'ssh'})
+        self.thevm.update_config({'xscontainer-mode': 'ssh'})
+        self.assertFalse(mforget_vm.called)
+
+        self.thevm.update_config({'xscontainer-mode': 'tls'})
+
+        mforget_vm.assert_called_once_with('vm')
+
+    def test_finished_monitoring(self, mforget_vm):
+        self.thevm._finish_monitoring()
+
+        mforget_vm.assert_called_once_with('vm')
+
+
+@patch("xscontainer.docker.wipe_docker_other_config")
+class TestWarmRestart(unittest.TestCase):
+
+    def setUp(self):
+        self.thevm = MonitoredVM(MagicMock(), ref=MagicMock(), uuid='vm')
+        self.thevm.get_other_config = MagicMock()
+        self.thevm._reconnect_policy = ReconnectPolicy()
+        self.thevm._refresh_scheduler = RefreshScheduler()
+        self.thevm._container_table = docker_monitor.docker.ContainerTable()
+        self.thevm._dirty_containers = set()
+        self.thevm._start_time = time.time()
+
+    def test_cold_start_wipes(self, mwipe_docker_other_config):
+        self.thevm._prepare_monitoring()
+
+        mwipe_docker_other_config.assert_called_once_with(self.thevm)
+
+    def test_warm_start_keeps_other_config(self, mwipe_docker_other_config):
+        self.thevm.get_other_config.return_value = {'docker_ps': '<ps/>'}
+        self.thevm._warm_state = {'digests': {
+            'docker_ps': docker_monitor.api_helper.get_digest('<ps/>')}}
+
+        self.thevm._prepare_monitoring()
+
+        self.assertFalse(mwipe_docker_other_config.called)
+        self.assertEqual(self.thevm.get_written_digests().keys(),
+                         ['docker_ps'])
+        # Until Docker confirms it, it goes if connecting fails
+        self.thevm._connection_failed(Exception("No route"))
+        mwipe_docker_other_config.assert_called_once_with(self.thevm)
+
+    def test_wipe_after_failed_reconnect(self, mwipe_docker_other_config):
+        self.thevm._disconnected()
+        self.assertFalse(mwipe_docker_other_config.called)
+
+        self.thevm._connection_failed(Exception("No route"))
+        self.thevm._connection_failed(Exception("No route"))
+        mwipe_docker_other_config.assert_called_once_with(self.thevm)
+
+    def test_stop_for_restart_keeps_other_config(self,
+                                                 mwipe_docker_other_config):
+        self.thevm._disconnected()
+        self.thevm._keep_other_config = True
+
+        self.thevm._finish_monitoring()
+
+        self.assertFalse(mwipe_docker_other_config.called)
@@ -0,0 +1,196 @@
+import socket
+import threading
+import time
+import unittest
+from mock import MagicMock, patch
+
+from xscontainer.docker_monitor import reactor, RefreshScheduler
+from xscontainer.docker_monitor.admission import AdmissionController
+
+HEADER = "HTTP/1.0 200 OK\r\nContent-Type: application/json\r\n\r\n"
+
+
+class SocketConnection(object):
+
+    """A connector byte stream on top of a socket."""
+
+    def __init__(self, asocket):
+        self._socket = asocket
+        self.closed = threading.Event()
+
+    def recv(self, size):
+        return self._socket.recv(size)
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def pending(self):
+        return False
+
+    def setblocking(self, blocking):
+        self._socket.setblocking(blocking)
+
+    def close(self):
+        self._socket.close()
+        self.closed.set()
+
+
+class RecordConnection(SocketConnection):
+
+    """
+    Like TLS, only delivers data once a whole record has arrived. A record
+    is the length of its payload as 4 digits and the payload.
+    """
+
+    def __init__(self, asocket):
+        SocketConnection.__init__(self, asocket)
+        self._buffer = ''
+        self._blocking = True
+
+    def recv(self, size):
+        while True:
+            if (len(self._buffer) >= 4 and
+                    len(self._buffer) >= 4 + int(self._buffer[:4])):
+                end = 4 + int(self._buffer[:4])
+                data = self._buffer[4:end]
+                self._buffer = self._buffer[end:]
+                return data
+            try:
+                data = self._socket.recv(size)
+            except socket.error:
+                if self._blocking:
+                    raise
+                return None
+            if data == '':
+                return ''
+            self._buffer = self._buffer + data
+
+    def setblocking(self, blocking):
+        self._blocking = blocking
+        SocketConnection.setblocking(self, blocking)
+
+
+def _record(data):
+    return '%04d%s' % (len(data), data)
+
+
+def _wait_for(condition):
+    deadline = time.time() + 5
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("Timed out")
+        time.sleep(0.01)
+
+
+class TestMonitorReactor(unittest.TestCase):
+
+    def setUp(self):
+        self.thevm = MagicMock()
+        self.thevm._refresh_all.return_value = '/events'
+        self.thevm._reconnect_policy.get_delay.return_value = 100
+        self.thevm.get_refresh_for_event.side_effect = (
+            lambda event: 'ps' if event['status'] == 'die' else None)
+        self.thevm._refresh_scheduler = RefreshScheduler(window=0.05)
+        self.thevm.request_refresh.side_effect = (
+            self.thevm._refresh_scheduler.request)
+        self.thevm._admission = None
+        self.reactor = reactor.MonitorReactor(workers=2)
+        self.reactor.start()
+
+    def tearDown(self):
+        self.reactor.stop(timeout=5)
+
+    @patch("xscontainer.remote_helper.open_docker_event_stream")
+    def test_events_lead_to_refresh(self, mopen_docker_event_stream):
+        ours, theirs = socket.socketpair()
+        connection = SocketConnection(ours)
+        mopen_docker_event_stream.return_value = connection
+
+        self.reactor.add_vm(self.thevm)
+        _wait_for(lambda: mopen_docker_event_stream.called)
+        theirs.sendall(HEADER + '{"status": "exec_start: sh"}\n'
+                       '{"status": "die"}\n')
+        theirs.sendall('{"status": "die"}\n')
+        _wait_for(lambda: self.thevm.refresh.called)
+        # Both die events are handled by one refresh
+        self.thevm.refresh.assert_called_once_with('ps')
+        self.assertEqual(self.thevm._refresh_scheduler.refreshes_saved, 1)
+        self.thevm._prepare_monitoring.assert_called_once_with()
+
+        # Docker goes away - a reconnect is scheduled
+        theirs.close()
+        _wait_for(connection.closed.is_set)
+        _wait_for(lambda: self.thevm._disconnected.called)
+        _wait_for(lambda: self.thevm._reconnect_policy.get_delay.called)
+        self.assertFalse(self.thevm._connection_failed.called)
+
+    @patch("xscontainer.remote_helper.open_docker_event_stream")
+    def test_partial_record_does_not_block(self, mopen_docker_event_stream):
+        ours, theirs = socket.socketpair()
+        other_ours, other_theirs = socket.socketpair()
+        other_vm = MagicMock()
+        other_vm._refresh_all.return_value = '/events'
+        other_vm._admission = None
+        other_vm.get_refresh_for_event.return_value = None
+        mopen_docker_event_stream.side_effect = [RecordConnection(ours),
+                                                 SocketConnection(other_ours)]
+
+        self.reactor.add_vm(self.thevm)
+        _wait_for(lambda: mopen_docker_event_stream.call_count == 1)
+        self.reactor.add_vm(other_vm)
+        _wait_for(lambda: mopen_docker_event_stream.call_count == 2)
+        record = _record(HEADER + '{"status": "die"}\n')
+        theirs.sendall(record[:10])
+        other_theirs.sendall(HEADER + '{"status": "start"}\n')
+
+        # The half record doesn't keep the reactor from serving the other VM
+        _wait_for(lambda: other_vm.get_refresh_for_event.called)
+        theirs.sendall(record[10:])
+        _wait_for(lambda: self.thevm.refresh.called)
+        self.thevm.refresh.assert_called_once_with('ps')
+        self.assertFalse(self.thevm._connection_failed.called)
+        theirs.close()
+        other_theirs.close()
+
+    @patch("xscontainer.remote_helper.open_docker_event_stream")
+    def test_remove_vm(self, mopen_docker_event_stream):
+        ours, theirs = socket.socketpair()
+        connection = SocketConnection(ours)
+        mopen_docker_event_stream.return_value = connection
+
+        self.reactor.add_vm(self.thevm)
+        _wait_for(lambda: mopen_docker_event_stream.called)
+        self.reactor.remove_vm(self.thevm)
+
+        _wait_for(lambda: self.thevm._finish_monitoring.called)
+        _wait_for(connection.closed.is_set)
+        _wait_for(lambda: self.thevm._disconnected.called)
+        theirs.close()
+
+    @patch("xscontainer.remote_helper.open_docker_event_stream")
+    def test_failed_connect_is_retried_later(self, mopen_docker_event_stream):
+        exception = reactor.util.XSContainerException("No route")
+        self.thevm._refresh_all.side_effect = exception
+
+        self.reactor.add_vm(self.thevm)
+
+        _wait_for(lambda: self.thevm._reconnect_policy.get_delay.called)
+        self.thevm._connection_failed.assert_called_once_with(exception)
+        self.assertFalse(mopen_docker_event_stream.called)
+
+    @patch("xscontainer.remote_helper.open_docker_event_stream")
+    def test_connecting_is_admitted(self, mopen_docker_event_stream):
+        ours, theirs = socket.socketpair()
+        mopen_docker_event_stream.return_value = SocketConnection(ours)
+        admission = AdmissionController(limit=1)
+        admission.request('other', lambda: None)
+        self.thevm._admission = admission
+
+        self.reactor.add_vm(self.thevm)
+        time.sleep(0.1)
+        self.assertFalse(self.thevm._refresh_all.called)
+
+        admission.release('other')
+        _wait_for(lambda: mopen_docker_event_stream.called)
+        _wait_for(lambda: admission.get_stats()['connecting'] == 0)
+        theirs.close()
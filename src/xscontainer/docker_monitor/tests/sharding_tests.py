@@ -0,0 +1,141 @@
+import multiprocessing
+import threading
+import time
+import unittest
+from mock import MagicMock, patch
+
+from xscontainer import api_helper
+from xscontainer.docker_monitor import sharding
+from xscontainer.util import log
+
+
+def _echo_shard(shard, pipe, results):
+    while True:
+        message = pipe.recv()
+        results.put((shard,) + message)
+        if message[0] == 'exit':
+            return
+
+
+def _use_locks_shard(shard, pipe):
+    # Like _run_monitor_shard does first thing
+    api_helper.RECORD_CACHE.clear()
+    log.debug("Monitor shard %d started" % (shard))
+
+
+class TestHashRing(unittest.TestCase):
+
+    def test_keys_are_spread(self):
+        ring = sharding.HashRing(range(4))
+        counts = {}
+        for index in range(1000):
+            shard = ring.get_shard("OpaqueRef:%d" % (index))
+            counts[shard] = counts.get(shard, 0) + 1
+        self.assertEqual(sorted(counts.keys()), [0, 1, 2, 3])
+        self.assertTrue(min(counts.values()) > 100)
+
+    def test_only_keys_of_removed_shard_move(self):
+        ring = sharding.HashRing(range(4))
+        keys = ["OpaqueRef:%d" % (index) for index in range(1000)]
+        before = dict((key, ring.get_shard(key)) for key in keys)
+        ring.remove(2)
+        for key in keys:
+            if before[key] != 2:
+                self.assertEqual(ring.get_shard(key), before[key])
+            else:
+                self.assertNotEqual(ring.get_shard(key), 2)
+
+
+@patch("xscontainer.docker_monitor.sharding.ShardWorker")
+class TestShardSupervisor(unittest.TestCase):
+
+    def _sent(self, supervisor, shard):
+        return [args[0][0] for args in
+                supervisor._workers[shard].send.call_args_list]
+
+    def test_forwarding(self, mshard_worker):
+        mshard_worker.side_effect = lambda *args: MagicMock()
+        supervisor = sharding.ShardSupervisor(2, None)
+
+        supervisor.start('vm', True, 5)
+        supervisor.update_config('vm', {'xscontainer-mode': 'ssh'})
+        supervisor.check_docker_ps_digest('vm', 'digest')
+        supervisor.stop('vm')
+
+        self.assertEqual(self._sent(supervisor,
+                                    supervisor._ring.get_shard('vm')),
+                         [('start', 'vm', True, 5),
+                          ('config', 'vm', {'xscontainer-mode': 'ssh'}),
+                          ('ps', 'vm', 'digest'),
+                          ('stop', 'vm')])
+
+    def test_dead_worker_is_replaced(self, mshard_worker):
+        mshard_worker.side_effect = lambda *args: MagicMock()
+        supervisor = sharding.ShardSupervisor(2, None)
+        supervisor.start('vm')
+        shard = supervisor.get_shard('vm')
+        supervisor._workers[shard].is_alive.return_value = False
+
+        supervisor.check_workers()
+
+        self.assertEqual(mshard_worker.call_count, 3)
+        self.assertEqual(self._sent(supervisor, shard),
+                         [('start', 'vm', False, 0)])
+
+    def test_crashing_worker_is_taken_out(self, mshard_worker):
+        mshard_worker.side_effect = lambda *args: MagicMock(started=0)
+        supervisor = sharding.ShardSupervisor(2, None)
+        vm_refs = ["OpaqueRef:%d" % (index) for index in range(20)]
+        for vm_ref in vm_refs:
+            supervisor.start(vm_ref)
+        supervisor._crashes[0] = sharding.SHARD_MAX_CRASHES
+        supervisor._workers[0].is_alive.return_value = False
+        supervisor._workers[0].started = time.time()
+
+        supervisor.check_workers()
+
+        self.assertEqual(supervisor._ring.get_shards(), [1])
+        for vm_ref in vm_refs:
+            self.assertEqual(supervisor.get_shard(vm_ref), 1)
+
+
+class TestShardWorker(unittest.TestCase):
+
+    def test_commands_reach_the_process(self):
+        results = multiprocessing.Queue()
+        worker = sharding.ShardWorker(3, _echo_shard, (results,))
+        try:
+            self.assertTrue(worker.send(('start', 'vm', False, 0)))
+            self.assertEqual(results.get(timeout=5), (3, 'start', 'vm',
+                                                      False, 0))
+        finally:
+            worker.stop()
+        self.assertEqual(results.get(timeout=5), (3, 'exit'))
+        self.assertFalse(worker.is_alive())
+
+    def test_respawn_while_a_lock_is_held(self):
+        supervisor = sharding.ShardSupervisor(1, _use_locks_shard)
+        supervisor._workers[0].process.join(5)
+        locked = threading.Event()
+        release = threading.Event()
+
+        def hold_lock():
+            api_helper.RECORD_CACHE._lock.acquire()
+            locked.set()
+            release.wait()
+            api_helper.RECORD_CACHE._lock.release()
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        locked.wait()
+        try:
+            supervisor.check_workers()
+            worker = supervisor._workers[0]
+            worker.process.join(5)
+            alive = worker.is_alive()
+            if alive:
+                worker.process.terminate()
+        finally:
+            release.set()
+            holder.join()
+        self.assertFalse(alive)
+        self.assertEqual(worker.process.exitcode, 0)
@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from xscontainer.docker_monitor import state
+
+
+class TestState(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'monitor.state')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_saved_state_is_loaded_once(self):
+        saved = {'vms': {'OpaqueRef:1': {'digests': {'docker_ps': 'abc'}}}}
+        self.assertTrue(state.save(self.path, saved))
+
+        loaded = state.load(self.path)
+
+        self.assertEqual(loaded['vms'], saved['vms'])
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(state.load(self.path), None)
+
+    def test_broken_state_is_ignored(self):
+        filehandler = open(self.path, 'w')
+        filehandler.write('{"vms": ')
+        filehandler.close()
+
+        self.assertEqual(state.load(self.path), None)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_other_version_is_ignored(self):
+        filehandler = open(self.path, 'w')
+        filehandler.write('{"version": 0, "vms": {}}')
+        filehandler.close()
+
+        self.assertEqual(state.load(self.path), None)
@@ -0,0 +1,60 @@
+import unittest
+from mock import MagicMock, call
+
+from xscontainer.docker_monitor import writer
+
+
+class TestWriteBehindQueue(unittest.TestCase):
+
+    def test_latest_value_is_written(self):
+        thevm = MagicMock()
+        queue = writer.WriteBehindQueue(rate=1000)
+        queue.start()
+        queue.put(thevm, 'docker_info', '<old/>')
+        queue.put(thevm, 'docker_info', '<new/>')
+        queue.stop(timeout=5)
+
+        # The first value may have been written before the second came in
+        self.assertEqual(thevm.write_other_config.call_args_list[-1],
+                         call('docker_info', '<new/>'))
+        self.assertEqual(queue.writes + queue.superseded, 2)
+        self.assertEqual(queue.get_stats()['depth'], 0)
+
+    def test_user_visible_keys_come_first(self):
+        thevm = MagicMock()
+        queue = writer.WriteBehindQueue()
+        queue.put(thevm, 'docker_info', '<info/>')
+        queue.put(thevm, 'docker_version', '<version/>')
+        queue.put(thevm, 'docker_ps', '<ps/>')
+        queue.put(thevm, 'docker_info', None)
+
+        self.assertEqual([queue._pop()[1:3] for _ in range(3)],
+                         [['docker_ps', '<ps/>'], ['docker_info', None],
+                          ['docker_version', '<version/>']])
+        self.assertEqual(queue._pop(), None)
+
+    def test_budget(self):
+        queue = writer.WriteBehindQueue(rate=2)
+        queue._last_refill = 100.0
+        for index in range(4):
+            queue.put(MagicMock(), 'docker_ps', '<ps/>')
+
+        self.assertEqual(queue._get_wait(100.0), 0)
+        queue._pop()
+        self.assertEqual(queue._get_wait(100.0), 0)
+        queue._pop()
+        # The burst is used up - the next write is due in half a second
+        self.assertEqual(queue._get_wait(100.0), 0.5)
+        self.assertEqual(queue._get_wait(100.5), 0)
+
+    def test_failed_write_is_counted(self):
+        thevm = MagicMock()
+        thevm.write_other_config.side_effect = writer.XenAPI.Failure(
+            ['HANDLE_INVALID'])
+        queue = writer.WriteBehindQueue(rate=1000)
+        queue.start()
+        queue.put(thevm, 'docker_ps', '<ps/>')
+        queue.stop(timeout=5)
+
+        self.assertEqual(queue.failures, 1)
+        self.assertEqual(queue.writes, 0)
@@ -0,0 +1,185 @@
+"""
+Writes the other_config changes of all monitored VMs to XAPI from a single
+thread at a bounded rate, so that a mass VM boot or a XAPI restart doesn't
+flood the pool master with calls. Only the latest value of a pending key is
+written.
+"""
+from xscontainer.util import log
+
+import collections
+import threading
+import time
+import XenAPI
+
+# other_config writes per second, with a burst of up to one second's worth
+WRITE_BUDGET_PER_S = 10
+# Keys that users see change, written before all others
+HIGH_PRIORITY_KEYS = ['docker_ps']
+REPORT_INTERVAL_S = 300
+
+
+class WriteBehindQueue(object):
+
+    """
+    Queues other_config writes and carries them out at no more than rate
+    writes per second. thevm.write_other_config(key, value) is called for
+    each write, where a value of None stands for removing the key.
+    """
+
+    def __init__(self, rate=WRITE_BUDGET_PER_S,
+                 report_interval=REPORT_INTERVAL_S):
+        self.rate = float(rate)
+        self.report_interval = report_interval
+        self._condition = threading.Condition()
+        # _pending[(id(thevm), key)] = [thevm, key, value, time first queued]
+        self._pending = {}
+        # The keys of _pending in the order they are to be written, high
+        # priority first
+        self._queues = (collections.deque(), collections.deque())
+        self._tokens = max(self.rate, 1.0)
+        self._last_refill = time.time()
+        self._running = False
+        self._thread = None
+        self.writes = 0
+        self.superseded = 0
+        self.failures = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def start(self):
+        """ The thread that writes is only started with the first write """
+        self._running = True
+
+    def stop(self, timeout=None):
+        """ Writes what is still pending, without regard to the budget, and
+            waits up to timeout for that to finish. """
+        self._condition.acquire()
+        try:
+            self._running = False
+            self._condition.notify()
+        finally:
+            self._condition.release()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def put(self, thevm, key, value):
+        """ Queues writing value to key, replacing a value that is still
+            pending for the key. """
+        entry_key = (id(thevm), key)
+        self._condition.acquire()
+        try:
+            entry = self._pending.get(entry_key)
+            if entry:
+                entry[2] = value
+                self.superseded = self.superseded + 1
+                return
+            if self._running and not self._thread:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._pending[entry_key] = [thevm, key, value, time.time()]
+            if key in HIGH_PRIORITY_KEYS:
+                self._queues[0].append(entry_key)
+            else:
+                self._queues[1].append(entry_key)
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def get_stats(self):
+        self._condition.acquire()
+        try:
+            oldest = 0.0
+            if self._pending:
+                oldest = time.time() - min(entry[3] for entry
+                                           in self._pending.itervalues())
+            average = 0.0
+            if self.writes:
+                average = self.latency_total / self.writes
+            return {'depth': len(self._pending),
+                    'oldest_s': oldest,
+                    'writes': self.writes,
+                    'superseded': self.superseded,
+                    'failures': self.failures,
+                    'latency_average_s': average,
+                    'latency_max_s': self.latency_max}
+        finally:
+            self._condition.release()
+
+    def _get_wait(self, now):
+        """ Returns how long to wait before the next write is within the
+            budget, or None if there is nothing to write """
+        if not self._pending:
+            return None
+        self._tokens = min(max(self.rate, 1.0),
+                           self._tokens + (now - self._last_refill) *
+                           self.rate)
+        self._last_refill = now
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def _pop(self):
+        for queue in self._queues:
+            if queue:
+                self._tokens = self._tokens - 1
+                return self._pending.pop(queue.popleft())
+        return None
+
+    def _run(self):
+        next_report = time.time() + self.report_interval
+        while True:
+            entry = None
+            self._condition.acquire()
+            try:
+                wait = self._get_wait(time.time())
+                while wait != 0 and self._running:
+                    timeout = max(next_report - time.time(), 0)
+                    if wait is not None:
+                        timeout = min(wait, timeout)
+                    if timeout == 0:
+                        break
+                    self._condition.wait(timeout)
+                    wait = self._get_wait(time.time())
+                if not self._running and not self._pending:
+                    return
+                if wait == 0 or not self._running:
+                    entry = self._pop()
+            finally:
+                self._condition.release()
+            if entry:
+                self._write(entry)
+            if time.time() >= next_report:
+                self._report()
+                next_report = time.time() + self.report_interval
+
+    def _write(self, entry):
+        thevm, key, value, queued = entry
+        try:
+            thevm.write_other_config(key, value)
+        except XenAPI.Failure as exception:
+            # E.g. the VM has been destroyed in the meantime
+            log.info("Failed to write %s of VM %s: %s"
+                     % (key, thevm.get_uuid(), exception))
+            self.failures = self.failures + 1
+            return
+        except Exception:
+            log.exception("Failed to write %s of VM %s"
+                          % (key, thevm.get_uuid()))
+            self.failures = self.failures + 1
+            return
+        latency = time.time() - queued
+        self.writes = self.writes + 1
+        self.latency_total = self.latency_total + latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def _report(self):
+        stats = self.get_stats()
+        if not stats['writes'] and not stats['depth']:
+            return
+        log.info("other_config write-behind: %d writes, %d superseded, %d "
+                 "failed, %d queued, oldest queued %.1fs, latency %.1fs "
+                 "average and %.1fs max"
+                 % (stats['writes'], stats['superseded'], stats['failures'],
+                    stats['depth'], stats['oldest_s'],
+                    stats['latency_average_s'], stats['latency_max_s']))
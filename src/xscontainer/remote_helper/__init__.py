@@ -1,13 +1,17 @@
-import json
-
-from xscontainer import api_helper
 from xscontainer import util
+from xscontainer.util import json_stream
+from xscontainer.util import log
+import connection_profile
+import constants
+import http_client
 import ssh
 import tls
 
+import select
+
 
 def _get_connector(session, vmuuid):
-    connectionmode = api_helper.get_vm_xscontainer_mode(session, vmuuid)
+    connectionmode = connection_profile.get_profile(session, vmuuid).mode
     if connectionmode == 'ssh':
         return ssh
     elif connectionmode == 'tls':
@@ -16,38 +20,119 @@ def _get_connector(session, vmuuid):
         assert 0
 
 
-def execute_docker(session, vmuuid, request):
+def execute_docker(session, vmuuid, method, path, body_sink=None):
+    """ Sends an HTTP request to the Docker API of the VM, reusing an
+        existing connection if possible. Returns a HttpResponse. """
     connector = _get_connector(session, vmuuid)
-    return connector.execute_docker(session, vmuuid, request)
+    return http_client.DOCKER_CONNECTION_POOL.request(session, vmuuid,
+                                                      connector, method, path,
+                                                      body_sink)
+
+
+class DockerEventsRefused(util.XSContainerException):
+
+    def __init__(self, message, status=None):
+        util.XSContainerException.__init__(self, message)
+        self.status = status
+
+
+class DockerEventDecoder(object):
+
+    """
+    Decodes the response to an HTTP/1.0 GET /events in linear time. The
+    response header is skipped once, then complete events are extracted from
+    the buffered data with JSONDecoder.raw_decode.
+    """
 
+    def __init__(self):
+        self._header = ''
+        self._decoder = None
 
-def execute_docker_event_listen(session, vmuuid, stoprequest):
-    skippedheader = False
-    data = ""
-    openbrackets = 0
-    request = "GET /events HTTP/1.0\r\n\r\n"
+    def feed(self, data):
+        if self._decoder is None:
+            self._header = self._header + data
+            headerend = self._header.find('\r\n\r\n')
+            if headerend < 0:
+                if len(self._header) > http_client.MAX_HEADER_LINE:
+                    raise util.XSContainerException(
+                        "The event stream header is too long")
+                return []
+            statusline = self._header.split('\r\n', 1)[0]
+            splits = statusline.split(' ', 2)
+            if len(splits) < 2 or not splits[1].startswith('2'):
+                status = None
+                if len(splits) >= 2 and splits[1].isdigit():
+                    status = int(splits[1])
+                raise DockerEventsRefused(
+                    "Docker refused to stream events: %s" % (statusline),
+                    status)
+            data = self._header[headerend + 4:]
+            self._header = ''
+            self._decoder = json_stream.JsonStreamDecoder(
+                max_value_size=constants.MAX_EVENT_SIZE)
+        return [util.convert_dict_to_ascii(event)
+                for event in self._decoder.feed(data)]
+
+
+def open_docker_event_stream(session, vmuuid, path='/events'):
+    """ Returns a connection that has asked Docker to stream events. Its
+        data is to be fed into a DockerEventDecoder. """
     connector = _get_connector(session, vmuuid)
-    for read_data in connector.execute_docker_data_listen(session,
-                                                          vmuuid,
-                                                          request,
-                                                          stoprequest):
-        for character in read_data:
-            data = data + character
-            if (not skippedheader and character == "\n" and
-                    len(data) >= 4 and data[-4:] == "\r\n\r\n"):
-                data = ""
-                skippedheader = True
-            elif character == '{':
-                openbrackets = openbrackets + 1
-            elif character == '}':
-                openbrackets = openbrackets - 1
-                if openbrackets == 0:
-                    event = util.convert_dict_to_ascii(json.loads(data))
-                    yield event
-                    data = ""
-            if len(read_data) >= 2048:
-                raise util.XSContainerException('execute_docker_event_listen' +
-                                                'is full')
+    connection = http_client.open_timed(connector, session, vmuuid)
+    try:
+        # The event stream isn't framed with HTTP/1.0 - it ends on close
+        connection.settimeout(constants.DOCKER_REQUEST_TIMEOUT_S)
+        connection.sendall("GET %s HTTP/1.0\r\n\r\n" % (path))
+    except Exception:
+        connection.close()
+        raise
+    return connection
+
+
+def execute_docker_event_listen(session, vmuuid, stoprequest, path='/events',
+                                yield_idle=False):
+    """ Yields the events streamed by Docker, until stoprequest is non-empty
+        or the stream ends. path may carry filters for the events. With
+        yield_idle, None is yielded when no data arrived for
+        MONITOR_EVENTS_POLL_INTERVAL. """
+    connection = open_docker_event_stream(session, vmuuid, path)
+    try:
+        decoder = DockerEventDecoder()
+        while not stoprequest:
+            if not connection.pending():
+                rlist, _, _ = select.select(
+                    [connection.fileno()], [], [],
+                    constants.MONITOR_EVENTS_POLL_INTERVAL)
+                if not rlist:
+                    if yield_idle:
+                        yield None
+                    continue
+            read_data = connection.recv(http_client.RECV_SIZE)
+            if read_data == "":
+                break
+            for event in decoder.feed(read_data):
+                yield event
+    finally:
+        connection.close()
+        log.info("execute_docker_event_listen for VM %s exited" % (vmuuid))
+
+
+def is_persistent_failure(exception):
+    """ Returns True for failures that are unlikely to go away without the
+        VM's configuration being changed, e.g. a rejected key """
+    return isinstance(exception, (ssh.AuthenticationException,
+                                  ssh.VmHostKeyException,
+                                  ssh.DockerSocketException))
+
+
+def forget_vm(vmuuid):
+    """ Drops the connections that are kept open to the VM and what is
+        cached to open them, when it isn't monitored anymore or its
+        connection settings changed """
+    ssh.SSH_TRANSPORT_POOL.invalidate(vmuuid)
+    http_client.DOCKER_CONNECTION_POOL.invalidate(vmuuid)
+    tls.TLS_CONTEXT_CACHE.invalidate(vmuuid)
+    connection_profile.CONNECTION_PROFILE_CACHE.invalidate(vmuuid)
 
 
 def determine_error_cause(session, vmuuid):
@@ -0,0 +1,96 @@
+from xscontainer import api_helper
+from xscontainer import util
+from xscontainer.util import log
+from xscontainer.util import tls_secret
+
+import threading
+
+# The fields of the other_config of a VM that a profile is loaded from
+PROFILE_KEYS = ([api_helper.XSCONTAINER_MODE,
+                 api_helper.XSCONTAINER_USERNAME,
+                 api_helper.XSCONTAINER_SSH_HOSTKEY] +
+                tls_secret.XSCONTAINER_TLS_KEYS)
+
+
+class ConnectionProfile(object):
+
+    """What it takes to connect to the Docker daemon of a VM."""
+
+    def __init__(self, vm_uuid, source, other_config, identity_uuid=None,
+                 identity_key=None):
+        self.vm_uuid = vm_uuid
+        # What the profile has been loaded from, to tell when it changed
+        self.source = source
+        self.mode = api_helper.get_xscontainer_mode(other_config)
+        self.username = api_helper.get_xscontainer_username(other_config)
+        # The SSH host key on record, or None if it isn't known yet
+        self.hostkey = other_config.get(api_helper.XSCONTAINER_SSH_HOSTKEY)
+        self.tls_secret_uuids = tls_secret.get_secret_uuids(other_config)
+        # The private key of the pool that SSH authenticates with, which is
+        # only loaded in ssh mode
+        self.identity_uuid = identity_uuid
+        self.identity_key = identity_key
+
+
+class ConnectionProfileCache(object):
+
+    """
+    Keeps a ConnectionProfile per VM, so that connecting doesn't look up the
+    mode, username, host key and identity key one by one. A profile is
+    checked against the other_config of the VM whenever it is used, which
+    api_helper.RECORD_CACHE answers without a call while it holds the VM.
+    When an other_config event or a write changes one of PROFILE_KEYS, the
+    profile is loaded again, but the identity key is only fetched again when
+    the pool has a new one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        util.recreate_lock_after_fork(self)
+        # _profiles[vm_uuid] = ConnectionProfile
+        self._profiles = {}
+
+    def get(self, session, vm_uuid):
+        other_config = api_helper.get_vm_other_config(session, vm_uuid)
+        identity_uuid = None
+        if api_helper.get_xscontainer_mode(other_config) == 'ssh':
+            identity_uuid = api_helper.get_idrsa_secret_uuid(
+                session, api_helper.XSCONTAINER_PRIVATE_SECRET_UUID)
+        source = tuple([identity_uuid] +
+                       [other_config.get(key) for key in PROFILE_KEYS])
+        self._lock.acquire()
+        try:
+            cached = self._profiles.get(vm_uuid)
+        finally:
+            self._lock.release()
+        if cached and cached.source == source:
+            return cached
+        log.info("Loading connection profile for VM %s" % (vm_uuid))
+        identity_key = None
+        if cached and identity_uuid and cached.identity_uuid == identity_uuid:
+            identity_key = cached.identity_key
+        elif identity_uuid:
+            identity_key = api_helper.get_secret_values(
+                session, [identity_uuid])[identity_uuid]
+        profile = ConnectionProfile(vm_uuid, source, other_config,
+                                    identity_uuid, identity_key)
+        self._lock.acquire()
+        try:
+            self._profiles[vm_uuid] = profile
+        finally:
+            self._lock.release()
+        return profile
+
+    def invalidate(self, vm_uuid):
+        self._lock.acquire()
+        try:
+            self._profiles.pop(vm_uuid, None)
+        finally:
+            self._lock.release()
+
+
+CONNECTION_PROFILE_CACHE = ConnectionProfileCache()
+
+
+def get_profile(session, vm_uuid):
+    return CONNECTION_PROFILE_CACHE.get(session, vm_uuid)
@@ -1,5 +1,22 @@
 MONITOR_EVENTS_POLL_INTERVAL = 1
-# The heavy weight is docker ps with plenty of containers.
-# Assume 283 bytes per container.
-# 300KB should be enough for 1085 containers.
-MAX_BUFFER_SIZE = 300 * 1024
+# A single Docker event is a few hundred bytes
+MAX_EVENT_SIZE = 1024 * 1024
+# The heavy weight is docker ps with plenty of containers. Responses are
+# read incrementally, so this only caps the memory a single response may use.
+# Assuming 283 bytes per container, 64MB fit about 237000 containers.
+MAX_RESPONSE_SIZE = 64 * 1024 * 1024
+# Authenticated SSH transports are kept open and shared between requests to
+# the same VM, so that a request only needs to open a new channel.
+SSH_TRANSPORT_IDLE_TIMEOUT_S = 300
+SSH_TRANSPORTS_PER_VM_MAX = 2
+# OpenSSH defaults to MaxSessions 10 - stay below that
+SSH_CHANNELS_PER_TRANSPORT_MAX = 8
+SSH_KEEPALIVE_INTERVAL_S = 30
+# How to reach /var/run/docker.sock over SSH. 'streamlocal' forwards to the
+# socket using sshd itself and falls back to 'ncat', which needs ncat to be
+# installed in the VM.
+SSH_DOCKER_TRANSPORT = 'streamlocal'
+# Docker API connections are kept alive for further requests to the VM
+DOCKER_CONNECTION_IDLE_TIMEOUT_S = 60
+DOCKER_CONNECTIONS_IDLE_PER_VM_MAX = 2
+DOCKER_REQUEST_TIMEOUT_S = 120
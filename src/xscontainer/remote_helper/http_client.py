@@ -0,0 +1,377 @@
+"""
+A small HTTP/1.1 client for talking to the Docker Engine API over the byte
+streams provided by the ssh and tls connectors. Connections are kept alive
+and reused for further requests to the same VM.
+"""
+from xscontainer import util
+from xscontainer.util import log
+from xscontainer.util import metrics
+import constants
+
+import errno
+import select
+import socket
+import ssl
+import threading
+import time
+
+HTTP_VERSION = 'HTTP/1.1'
+RECV_SIZE = 16 * 1024
+MAX_HEADER_LINE = 64 * 1024
+MAX_HEADERS = 100
+
+
+class HttpException(util.XSContainerException):
+    pass
+
+
+class HttpResponse(object):
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        # header names are lower case
+        self.headers = headers
+        # None, if the body was handed to a body_sink
+        self.body = body
+
+
+def prepare_request(method, path, keep_alive=True):
+    lines = ["%s %s %s" % (method, path, HTTP_VERSION),
+             "Host: docker",
+             "User-Agent: xscontainer"]
+    if method in ('POST', 'PUT'):
+        lines.append("Content-Length: 0")
+    if not keep_alive:
+        lines.append("Connection: close")
+    return "\r\n".join(lines) + "\r\n\r\n"
+
+
+class ResponseReader(object):
+
+    """
+    Buffered reads of lines and bodies from a connection. Bodies are handed
+    to a sink piece by piece, so they never need to be concatenated here.
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._buffer = ''
+        self.received = 0
+
+    def _recv(self, size):
+        data = self._connection.recv(size)
+        self.received = self.received + len(data)
+        return data
+
+    def readline(self):
+        while True:
+            index = self._buffer.find('\r\n')
+            if index >= 0:
+                line = self._buffer[:index]
+                self._buffer = self._buffer[index + 2:]
+                return line
+            if len(self._buffer) > MAX_HEADER_LINE:
+                raise HttpException("HTTP header line is too long")
+            data = self._recv(RECV_SIZE)
+            if data == '':
+                raise HttpException("Connection closed by Docker")
+            self._buffer = self._buffer + data
+
+    def read_into(self, length, sink):
+        if self._buffer:
+            piece = self._buffer[:length]
+            self._buffer = self._buffer[length:]
+            length = length - len(piece)
+            sink(piece)
+        while length > 0:
+            data = self._recv(min(length, RECV_SIZE))
+            if data == '':
+                raise HttpException("Connection closed by Docker")
+            length = length - len(data)
+            sink(data)
+
+    def read_until_close_into(self, sink):
+        if self._buffer:
+            piece = self._buffer
+            self._buffer = ''
+            sink(piece)
+        while True:
+            data = self._recv(RECV_SIZE)
+            if data == '':
+                break
+            sink(data)
+
+    def read_chunked_into(self, sink):
+        while True:
+            line = self.readline()
+            try:
+                chunk_length = int(line.split(';', 1)[0].strip(), 16)
+            except ValueError:
+                raise HttpException("Invalid chunk size %r" % (line))
+            if chunk_length == 0:
+                break
+            self.read_into(chunk_length, sink)
+            if self.readline() != '':
+                raise HttpException("Missing CRLF after chunk")
+        # Skip the trailer
+        while self.readline() != '':
+            pass
+
+
+class LimitedSink(object):
+
+    """Passes body pieces on, but fails once max_size is exceeded."""
+
+    def __init__(self, sink, max_size):
+        self._sink = sink
+        self._max_size = max_size
+        self.length = 0
+
+    def __call__(self, data):
+        self.length = self.length + len(data)
+        if self.length > self._max_size:
+            raise response_too_large(self._max_size)
+        self._sink(data)
+
+
+def response_too_large(max_size):
+    return HttpException("The response from Docker exceeds the limit of %d "
+                         "bytes (MAX_RESPONSE_SIZE)" % (max_size))
+
+
+def read_response_head(reader):
+    statusline = reader.readline()
+    splits = statusline.split(' ', 2)
+    if len(splits) < 2 or not splits[0].startswith('HTTP/'):
+        raise HttpException("Invalid HTTP status line %r" % (statusline))
+    try:
+        status = int(splits[1])
+    except ValueError:
+        raise HttpException("Invalid HTTP status line %r" % (statusline))
+    reason = ''
+    if len(splits) > 2:
+        reason = splits[2]
+    headers = {}
+    while True:
+        line = reader.readline()
+        if line == '':
+            break
+        if len(headers) >= MAX_HEADERS:
+            raise HttpException("Too many HTTP headers")
+        if ':' not in line:
+            raise HttpException("Invalid HTTP header %r" % (line))
+        name, value = line.split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    return (splits[0], status, reason, headers)
+
+
+class HttpConnection(object):
+
+    """An HTTP/1.1 connection on top of a connector's byte stream."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.reader = ResponseReader(connection)
+        self.reusable = True
+        self.last_used = time.time()
+
+    def request(self, method, path, body_sink=None):
+        """ Sends a request and returns the HttpResponse. If body_sink is
+            set, it is called with each piece of a 2xx response body, rather
+            than the body being collected in HttpResponse.body. When this
+            raises, the connection must not be used anymore. """
+        self.reusable = False
+        self.connection.sendall(prepare_request(method, path))
+        protocol, status, reason, headers = read_response_head(self.reader)
+        chunks = None
+        if body_sink is None or not 200 <= status < 300:
+            # Error bodies are always collected, to report them
+            chunks = []
+            body_sink = chunks.append
+        sink = LimitedSink(body_sink, constants.MAX_RESPONSE_SIZE)
+        framed = True
+        if (method == 'HEAD' or status in (204, 304) or
+                100 <= status < 200):
+            pass
+        elif 'chunked' in headers.get('transfer-encoding', '').lower():
+            self.reader.read_chunked_into(sink)
+        elif 'content-length' in headers:
+            try:
+                length = int(headers['content-length'])
+            except ValueError:
+                raise HttpException("Invalid Content-Length %r"
+                                    % (headers['content-length']))
+            if length > constants.MAX_RESPONSE_SIZE:
+                # Fail before reading anything
+                raise response_too_large(constants.MAX_RESPONSE_SIZE)
+            self.reader.read_into(length, sink)
+        else:
+            # Without framing, the body ends when the connection is closed
+            self.reader.read_until_close_into(sink)
+            framed = False
+        body = None
+        if chunks is not None:
+            body = ''.join(chunks)
+        connection_header = headers.get('connection', '').lower()
+        self.reusable = (framed and protocol == HTTP_VERSION and
+                         'close' not in connection_header)
+        self.last_used = time.time()
+        return HttpResponse(status, reason, headers, body)
+
+    def is_dropped(self):
+        """ An idle connection must not have anything to read - if it does,
+            Docker has closed it or sent something unexpected. """
+        try:
+            rlist, _, _ = select.select([self.connection.fileno()], [], [],
+                                        0)
+        except (select.error, ValueError):
+            return True
+        return bool(rlist) or self.connection.pending()
+
+    def close(self):
+        try:
+            self.connection.close()
+        except Exception:
+            log.exception("Failed to close Docker connection. Moving on.")
+
+
+class DockerConnectionPool(object):
+
+    """
+    Keeps idle HTTP connections to the Docker daemons of VMs. Connections
+    are keyed by VM uuid and connector, so that a mode change of the VM
+    doesn't reuse a connection of the old mode.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        util.recreate_lock_after_fork(self)
+        # _idle[(vmuuid, connector name)] = [HttpConnection, ...]
+        self._idle = {}
+
+    def request(self, session, vmuuid, connector, method, path,
+                body_sink=None):
+        labels = {'vm': vmuuid, 'endpoint': get_endpoint(path)}
+        try:
+            with metrics.Timer('xscontainer_docker_request_seconds', labels):
+                return self._request(session, vmuuid, connector, method,
+                                     path, body_sink)
+        except util.XSContainerException:
+            metrics.METRICS.inc('xscontainer_docker_request_failures_total',
+                                labels)
+            raise
+
+    def _request(self, session, vmuuid, connector, method, path,
+                 body_sink):
+        key = (vmuuid, connector.__name__)
+        connection, reused = self._get(session, vmuuid, connector, key)
+        try:
+            response = connection.request(method, path, body_sink)
+        except util.XSContainerException:
+            connection.close()
+            # A reused connection may have been closed by Docker just now.
+            # Only retry if it certainly didn't process the request.
+            if not reused or connection.reader.received or method != 'GET':
+                raise
+            log.info("Reused Docker connection for VM %s failed, "
+                     "reconnecting" % (vmuuid))
+            connection, _ = self._open(session, vmuuid, connector)
+            try:
+                response = connection.request(method, path, body_sink)
+            except util.XSContainerException:
+                connection.close()
+                raise
+        if connection.reusable:
+            self._put(key, connection)
+        else:
+            connection.close()
+        return response
+
+    def _open(self, session, vmuuid, connector):
+        connection = open_timed(connector, session, vmuuid)
+        connection.settimeout(constants.DOCKER_REQUEST_TIMEOUT_S)
+        return (HttpConnection(connection), False)
+
+    def _get(self, session, vmuuid, connector, key):
+        deadline = time.time() - constants.DOCKER_CONNECTION_IDLE_TIMEOUT_S
+        found = None
+        to_close = []
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(key, [])
+            while idle:
+                connection = idle.pop()
+                if connection.last_used < deadline:
+                    to_close.append(connection)
+                else:
+                    found = connection
+                    break
+        finally:
+            self._lock.release()
+        for connection in to_close:
+            connection.close()
+        if found and not found.is_dropped():
+            found.reader.received = 0
+            return (found, True)
+        if found:
+            found.close()
+        return self._open(session, vmuuid, connector)
+
+    def _put(self, key, connection):
+        to_close = None
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < constants.DOCKER_CONNECTIONS_IDLE_PER_VM_MAX:
+                idle.append(connection)
+            else:
+                to_close = connection
+        finally:
+            self._lock.release()
+        if to_close:
+            to_close.close()
+
+    def invalidate(self, vmuuid):
+        self._lock.acquire()
+        try:
+            to_close = []
+            for key in self._idle.keys():
+                if key[0] == vmuuid:
+                    to_close.extend(self._idle.pop(key))
+        finally:
+            self._lock.release()
+        for connection in to_close:
+            connection.close()
+
+
+DOCKER_CONNECTION_POOL = DockerConnectionPool()
+
+
+def is_would_block(exception):
+    """ Returns True, if a recv on a non-blocking connection failed only as
+        there is nothing to read yet, e.g. as just part of a TLS record or
+        no data at all has arrived """
+    if isinstance(exception, (socket.timeout, ssl.SSLWantReadError)):
+        return True
+    return (isinstance(exception, socket.error) and
+            exception.errno in (errno.EAGAIN, errno.EWOULDBLOCK))
+
+
+def open_timed(connector, session, vmuuid):
+    """ Opens a connection to Docker and observes how long that took """
+    mode = connector.__name__.rsplit('.', 1)[-1]
+    with metrics.Timer('xscontainer_docker_connect_seconds',
+                       {'vm': vmuuid, 'mode': mode}):
+        return connector.open_docker_connection(session, vmuuid)
+
+
+def get_endpoint(path):
+    """ Returns path without the query and with object ids replaced, so
+        that requests can be told apart by what they ask for """
+    parts = path.split('?', 1)[0].split('/')
+    # ['', 'containers', '<id>', 'json'], but not ['', 'containers', 'json']
+    if (len(parts) > 2 and parts[1] in ('containers', 'images', 'exec') and
+            (len(parts) > 3 or parts[2] not in ('json', 'create'))):
+        parts[2] = '{id}'
+    return '/'.join(parts)
@@ -1,20 +1,28 @@
 from xscontainer import api_helper
 from xscontainer import util
 from xscontainer.util import log
+import connection_profile
 import constants
+import http_client
 
-import fcntl
-import errno
-import os
 import paramiko
 import paramiko.rsakey
-import select
 import socket
 import StringIO
+import struct
 import sys
+import threading
+import time
 
 DOCKER_SOCKET_PATH = '/var/run/docker.sock'
 SSH_PORT = 22
+STREAMLOCAL_CHANNEL = 'direct-streamlocal@openssh.com'
+# The reasons for refusing a streamlocal channel that won't go away on a
+# retry: AllowStreamLocalForwarding is off, or the sshd is too old to know
+# the channel type
+STREAMLOCAL_UNSUPPORTED_CODES = [
+    paramiko.common.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED,
+    paramiko.common.OPEN_FAILED_UNKNOWN_CHANNEL_TYPE]
 
 ERROR_CAUSE_NETWORK = (
     "Error: Cannot find a valid IP that allows SSH connections to "
@@ -35,26 +43,55 @@ class AuthenticationException(SshException):
     pass
 
 
+class DockerSocketException(SshException):
+    pass
+
+
 def prepare_request_cmd():
     return ("ncat -U %s" % (DOCKER_SOCKET_PATH))
 
 
+def _enable_streamlocal(transport):
+    """
+    Paramiko can't open direct-streamlocal@openssh.com channels on its own,
+    as it only knows how to add the arguments of the channel types it
+    supports. Complete the CHANNEL_OPEN message for streamlocal channels
+    with the socket path before it is sent (see OpenSSH's PROTOCOL file).
+    """
+    prefix = (chr(paramiko.common.MSG_CHANNEL_OPEN) +
+              struct.pack('>I', len(STREAMLOCAL_CHANNEL)) +
+              STREAMLOCAL_CHANNEL)
+    # kind is followed by channel id, window size and max packet size
+    bare_length = len(prefix) + 12
+    send_user_message = transport._send_user_message
+
+    def _send_user_message(message):
+        content = message.asbytes()
+        if len(content) == bare_length and content.startswith(prefix):
+            message.add_string(DOCKER_SOCKET_PATH)
+            # reserved string and uint32
+            message.add_string('')
+            message.add_int(0)
+        return send_user_message(message)
+    transport._send_user_message = _send_user_message
+
+
 class MyHostKeyPolicy(paramiko.MissingHostKeyPolicy):
 
     _session = None
     _vm_uuid = None
+    _remembered_hostkey = None
 
-    def __init__(self, session, vm_uuid):
+    def __init__(self, session, vm_uuid, remembered_hostkey):
         self._session = session
         self._vm_uuid = vm_uuid
+        self._remembered_hostkey = remembered_hostkey
 
     def missing_host_key(self, client, hostname, key):
         hostkey = key.get_base64()
-        remembered_hostkey = api_helper.get_ssh_hostkey(self._session,
-                                                        self._vm_uuid)
-        if remembered_hostkey:
+        if self._remembered_hostkey:
             # We have a key on record
-            if hostkey == remembered_hostkey:
+            if hostkey == self._remembered_hostkey:
                 # all good - continue
                 return
             else:
@@ -73,16 +110,19 @@ class MyHostKeyPolicy(paramiko.MissingHostKeyPolicy):
             return
 
 
-def prepare_ssh_client(session, vmuuid):
-    username = api_helper.get_vm_xscontainer_username(session, vmuuid)
-    host = api_helper.get_suitable_vm_ip(session, vmuuid, SSH_PORT)
+def prepare_ssh_client(session, vmuuid, host=None):
+    profile = connection_profile.get_profile(session, vmuuid)
+    username = profile.username
+    if host is None:
+        host = api_helper.get_suitable_vm_ip(session, vmuuid, SSH_PORT)
     log.info("prepare_ssh_client for vm %s, via %s@%s"
              % (vmuuid, username, host))
     client = paramiko.SSHClient()
     pkey = paramiko.rsakey.RSAKey.from_private_key(
-        StringIO.StringIO(api_helper.get_idrsa_secret_private(session)))
+        StringIO.StringIO(profile.identity_key))
     client.get_host_keys().clear()
-    client.set_missing_host_key_policy(MyHostKeyPolicy(session, vmuuid))
+    client.set_missing_host_key_policy(MyHostKeyPolicy(session, vmuuid,
+                                                       profile.hostkey))
     try:
         client.connect(host, port=SSH_PORT, username=username,
                        pkey=pkey, look_for_keys=False, banner_timeout=300)
@@ -95,21 +135,314 @@ def prepare_ssh_client(session, vmuuid):
         log.info(message)
         raise AuthenticationException(message)
     except (paramiko.SSHException, socket.error) as exception:
+        if isinstance(exception, socket.error):
+            # The VM may have got a different IP
+            api_helper.forget_suitable_vm_ip(vmuuid, SSH_PORT)
         # reraise as SshException
         raise SshException("prepare_ssh_client: %s" % exception,
                            (sys.exc_info()[2]))
     return client
 
 
-def execute_docker(session, vmuuid, request):
-    return execute_ssh(session, vmuuid, prepare_request_cmd(), request)
+class PooledSshClient(object):
+
+    """An authenticated SSH client that is shared between requests."""
+
+    def __init__(self, client, host):
+        self.client = client
+        self.host = host
+        self.hostkey = client.get_transport().get_remote_server_key(
+        ).get_base64()
+        self.channels = 0
+        self.last_used = time.time()
+        self.pooled = True
+        # None until we know whether sshd forwards to the Docker socket
+        self.streamlocal = None
+
+    def is_active(self):
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def close(self):
+        try:
+            self.client.close()
+        except Exception:
+            log.exception("Error when closing ssh client to %s" % (self.host))
+
+
+class SshTransportPool(object):
+
+    """
+    Keeps authenticated SSH transports to VMs open, so that a request only
+    needs to open a new channel instead of doing a TCP connect, key exchange
+    and authentication. Transports are keyed by VM uuid and are dropped when
+    they are idle for too long, or when the IP or host key of the VM changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        util.recreate_lock_after_fork(self)
+        # _clients[vmuuid] = [PooledSshClient, ...]
+        self._clients = {}
+
+    def acquire(self, session, vmuuid):
+        """
+        Returns a tuple (PooledSshClient, reused), where reused tells whether
+        the transport had already been established by an earlier request.
+        The client must be handed back using release().
+        """
+        host = api_helper.get_suitable_vm_ip(session, vmuuid, SSH_PORT)
+        hostkey = connection_profile.get_profile(session, vmuuid).hostkey
+        to_close = []
+        self._lock.acquire()
+        try:
+            to_close.extend(self._pop_idle())
+            to_close.extend(self._pop_stale(vmuuid, host, hostkey))
+            found = None
+            for pooled in self._clients.get(vmuuid, []):
+                if (pooled.channels <
+                        constants.SSH_CHANNELS_PER_TRANSPORT_MAX):
+                    pooled.channels = pooled.channels + 1
+                    found = pooled
+                    break
+        finally:
+            self._lock.release()
+        for pooled in to_close:
+            pooled.close()
+        if found:
+            return (found, True)
+        client = prepare_ssh_client(session, vmuuid, host)
+        client.get_transport().set_keepalive(
+            constants.SSH_KEEPALIVE_INTERVAL_S)
+        _enable_streamlocal(client.get_transport())
+        pooled = PooledSshClient(client, host)
+        pooled.channels = 1
+        self._lock.acquire()
+        try:
+            clients = self._clients.setdefault(vmuuid, [])
+            if len(clients) < constants.SSH_TRANSPORTS_PER_VM_MAX:
+                clients.append(pooled)
+            else:
+                # Over the cap - use the transport for this request only
+                pooled.pooled = False
+        finally:
+            self._lock.release()
+        return (pooled, False)
+
+    def release(self, vmuuid, pooled, broken=False):
+        self._lock.acquire()
+        try:
+            pooled.channels = pooled.channels - 1
+            pooled.last_used = time.time()
+            close = broken or not pooled.pooled or not pooled.is_active()
+            if close:
+                self._remove(vmuuid, pooled)
+        finally:
+            self._lock.release()
+        if close:
+            pooled.close()
+
+    def invalidate(self, vmuuid):
+        """ Close all idle transports of a VM and stop handing out the busy
+            ones. Busy transports are closed once they are released. """
+        self._lock.acquire()
+        try:
+            clients = self._clients.pop(vmuuid, [])
+            for pooled in clients:
+                pooled.pooled = False
+            to_close = [pooled for pooled in clients if pooled.channels <= 0]
+        finally:
+            self._lock.release()
+        for pooled in to_close:
+            pooled.close()
+
+    def _remove(self, vmuuid, pooled):
+        clients = self._clients.get(vmuuid, [])
+        if pooled in clients:
+            clients.remove(pooled)
+        if not clients:
+            self._clients.pop(vmuuid, None)
+
+    def _pop_stale(self, vmuuid, host, hostkey):
+        stale = []
+        for pooled in list(self._clients.get(vmuuid, [])):
+            if (pooled.host != host or pooled.hostkey != hostkey or
+                    not pooled.is_active()):
+                log.info("Dropping ssh transport to VM %s via %s"
+                         % (vmuuid, pooled.host))
+                pooled.pooled = False
+                self._remove(vmuuid, pooled)
+                if pooled.channels <= 0:
+                    stale.append(pooled)
+        return stale
+
+    def _pop_idle(self):
+        idle = []
+        deadline = time.time() - constants.SSH_TRANSPORT_IDLE_TIMEOUT_S
+        for vmuuid, clients in self._clients.items():
+            for pooled in list(clients):
+                if pooled.channels <= 0 and pooled.last_used < deadline:
+                    self._remove(vmuuid, pooled)
+                    idle.append(pooled)
+        return idle
+
+
+SSH_TRANSPORT_POOL = SshTransportPool()
+
+
+def _open_on_pooled_transport(session, vmuuid, open_function):
+    """ Calls open_function with a pooled transport. Retries once on a new
+        transport, if a reused one turns out to have gone away. Returns a
+        tuple of the PooledSshClient and what open_function returned. """
+    pooled, reused = SSH_TRANSPORT_POOL.acquire(session, vmuuid)
+    try:
+        return (pooled, open_function(pooled))
+    except (paramiko.SSHException, socket.error, EOFError):
+        SSH_TRANSPORT_POOL.release(vmuuid, pooled, broken=True)
+        if not reused:
+            raise
+        sys.exc_clear()
+    except Exception:
+        # The transport itself is fine
+        SSH_TRANSPORT_POOL.release(vmuuid, pooled)
+        raise
+    log.info("Reused ssh transport for VM %s failed, reconnecting" % (vmuuid))
+    pooled, _ = SSH_TRANSPORT_POOL.acquire(session, vmuuid)
+    try:
+        return (pooled, open_function(pooled))
+    except Exception:
+        SSH_TRANSPORT_POOL.release(vmuuid, pooled, broken=True)
+        raise
+
+
+def _exec_command(session, vmuuid, cmd):
+    """ Runs cmd in a new channel. Returns pooled, stdin, stdout, stderr """
+    pooled, streams = _open_on_pooled_transport(
+        session, vmuuid, lambda pooled: pooled.client.exec_command(cmd))
+    return (pooled,) + streams
+
+
+def _open_docker_channel_on(pooled, vmuuid):
+    """ Returns a tuple of a channel that is connected to the Docker socket
+        and whether ncat is used for the channel """
+    if (constants.SSH_DOCKER_TRANSPORT == 'streamlocal' and
+            pooled.streamlocal is not False):
+        try:
+            channel = pooled.client.get_transport().open_channel(
+                STREAMLOCAL_CHANNEL)
+            pooled.streamlocal = True
+            return (channel, False)
+        except paramiko.ChannelException as exception:
+            if exception.code not in STREAMLOCAL_UNSUPPORTED_CODES:
+                # E.g. the Docker socket isn't there yet while the VM boots
+                raise SshException("Can't connect to %s on VM %s: %s"
+                                   % (DOCKER_SOCKET_PATH, vmuuid,
+                                      exception), (sys.exc_info()[2]))
+            log.info("Can't open %s on VM %s - falling back to ncat: %s"
+                     % (STREAMLOCAL_CHANNEL, vmuuid, exception))
+            pooled.streamlocal = False
+            sys.exc_clear()
+    channel = pooled.client.get_transport().open_session()
+    channel.exec_command(prepare_request_cmd())
+    return (channel, True)
+
+
+def _open_docker_channel(session, vmuuid):
+    """ Returns a tuple pooled, channel, via_ncat """
+    pooled, (channel, via_ncat) = _open_on_pooled_transport(
+        session, vmuuid,
+        lambda pooled: _open_docker_channel_on(pooled, vmuuid))
+    return (pooled, channel, via_ncat)
+
+
+class SshDockerConnection(object):
+
+    """A byte stream to the Docker socket of a VM over SSH."""
+
+    def __init__(self, vmuuid, pooled, channel, via_ncat):
+        self._vmuuid = vmuuid
+        self._pooled = pooled
+        self._channel = channel
+        self._via_ncat = via_ncat
+        self._blocking = True
+
+    def sendall(self, data):
+        try:
+            self._channel.sendall(data)
+        except (socket.error, paramiko.SSHException) as exception:
+            raise SshException("Failed to send to Docker on VM %s: %s"
+                               % (self._vmuuid, exception),
+                               (sys.exc_info()[2]))
+
+    def recv(self, size):
+        """ Returns None, if the connection is non-blocking and there is
+            nothing to read yet """
+        try:
+            data = self._channel.recv(size)
+        except (socket.error, paramiko.SSHException) as exception:
+            if not self._blocking and http_client.is_would_block(exception):
+                sys.exc_clear()
+                return None
+            raise SshException("Failed to receive from Docker on VM %s: %s"
+                               % (self._vmuuid, exception),
+                               (sys.exc_info()[2]))
+        if (data == "" and self._via_ncat and
+                self._channel.exit_status_ready()):
+            returncode = self._channel.recv_exit_status()
+            if returncode != 0:
+                # ncat couldn't reach the Docker socket
+                raise DockerSocketException("Returncode for '%s' is not 0"
+                                            % (prepare_request_cmd()))
+        return data
+
+    def fileno(self):
+        return self._channel.fileno()
+
+    def pending(self):
+        return self._channel.recv_ready()
+
+    def settimeout(self, timeout):
+        self._channel.settimeout(timeout)
+
+    def setblocking(self, blocking):
+        self._blocking = blocking
+        self._channel.setblocking(blocking)
+
+    def close(self):
+        try:
+            self._channel.close()
+        finally:
+            SSH_TRANSPORT_POOL.release(self._vmuuid, self._pooled)
+
+
+def open_docker_connection(session, vmuuid):
+    pooled, channel, via_ncat = _open_docker_channel(session, vmuuid)
+    log.info("Opened Docker connection to VM %s via %s"
+             % (vmuuid, 'ncat' if via_ncat else STREAMLOCAL_CHANNEL))
+    return SshDockerConnection(vmuuid, pooled, channel, via_ncat)
+
+
+def _read_limited(stdout, cmd):
+    chunks = []
+    length = 0
+    while True:
+        chunk = stdout.read(http_client.RECV_SIZE)
+        if chunk == "":
+            break
+        length = length + len(chunk)
+        if length > constants.MAX_RESPONSE_SIZE:
+            raise SshException("too much data was returned when executing"
+                               "'%s'" % (cmd))
+        chunks.append(chunk)
+    return ''.join(chunks)
 
 
 def execute_ssh(session, vmuuid, cmd, stdin_input=None):
-    client = None
+    pooled = None
+    stdout = None
+    broken = False
     try:
         try:
-            client = prepare_ssh_client(session, vmuuid)
             if isinstance(cmd, list):
                 cmd = ' '.join(cmd)
             stripped_stdin_input = stdin_input
@@ -117,14 +450,11 @@ def execute_ssh(session, vmuuid, cmd, stdin_input=None):
                 stripped_stdin_input = stripped_stdin_input.strip()
             log.info("execute_ssh will run '%s' with stdin '%s' on vm %s"
                      % (cmd, stripped_stdin_input, vmuuid))
-            stdin, stdout, _ = client.exec_command(cmd)
+            pooled, stdin, stdout, _ = _exec_command(session, vmuuid, cmd)
             if stdin_input:
                 stdin.write(stdin_input)
                 stdin.channel.shutdown_write()
-            output = stdout.read(constants.MAX_BUFFER_SIZE)
-            if stdout.read(1) != "":
-                raise SshException("too much data was returned when executing"
-                                   "'%s'" % (cmd))
+            output = _read_limited(stdout, cmd)
             returncode = stdout.channel.recv_exit_status()
             if returncode != 0:
                 log.info("execute_ssh '%s' on vm %s exited with rc %d: Stdout:"
@@ -135,51 +465,33 @@ def execute_ssh(session, vmuuid, cmd, stdin_input=None):
             # This exception is already improved - leave it as it is
             raise
         except Exception as exception:
+            broken = True
             # reraise as SshException
             raise SshException("execute_ssh: %s" % exception,
                                (sys.exc_info()[2]))
     finally:
-        if client:
-            client.close()
+        if stdout:
+            stdout.channel.close()
+        if pooled:
+            SSH_TRANSPORT_POOL.release(vmuuid, pooled, broken)
 
 
-def execute_docker_data_listen(session, vmuuid, request,
-                               stop_monitoring_request):
-    ssh_client = prepare_ssh_client(session, vmuuid)
+def _can_open_streamlocal(session, vmuuid):
+    if constants.SSH_DOCKER_TRANSPORT != 'streamlocal':
+        return False
     try:
-        cmd = prepare_request_cmd()
-        log.info("execute_docker_listen_charbychar is running '%s' on VM '%s'"
-                 % (cmd, vmuuid))
-        stdin, stdout, _ = ssh_client.exec_command(cmd)
-        stdin.write(request)
-        # set unblocking io for select.select
-        stdout_fd = stdout.channel.fileno()
-        fcntl.fcntl(stdout_fd,
-                    fcntl.F_SETFL,
-                    os.O_NONBLOCK | fcntl.fcntl(stdout_fd, fcntl.F_GETFL))
-        while not stop_monitoring_request:
-            rlist, _, _ = select.select([stdout_fd], [], [],
-                                        constants.MONITOR_EVENTS_POLL_INTERVAL)
-            if not rlist:
-                continue
-            try:
-                read_data = stdout.read(1)
-                if read_data == "":
-                    break
-                yield read_data
-            except IOError as exception:
-                log.info("IOError")
-                if exception[0] not in (errno.EAGAIN, errno.EINTR):
-                    log.info("Cleared")
-                    raise
-                sys.exc_clear()
-    finally:
-        try:
-            ssh_client.close()
-        except Exception:
-            util.log.exception("Error when closing ssh_client for %r"
-                               % ssh_client)
-            log.info('execute_docker_listen_charbychar (%s) exited' % cmd)
+        pooled, (channel, via_ncat) = _open_on_pooled_transport(
+            session, vmuuid,
+            lambda pooled: _open_docker_channel_on(pooled, vmuuid))
+    except (paramiko.SSHException, socket.error, EOFError):
+        return False
+    except util.XSContainerException:
+        # sshd forwards to the socket, which isn't there - that is checked
+        # next
+        return True
+    channel.close()
+    SSH_TRANSPORT_POOL.release(vmuuid, pooled)
+    return not via_ncat
 
 
 def determine_error_cause(session, vmuuid):
@@ -211,13 +523,16 @@ def determine_error_cause(session, vmuuid):
                  "check the logs inside the VM and also try manually.")
         # No reason to continue, if there is no SSH connection
         return cause
+    # ncat is only needed, if sshd can't forward to the Docker socket
     # @todo: we could alternatively support socat
     # @todo: we could probably prepare this as part of xscontainer-prepare-vm
-    try:
-        execute_ssh(session, vmuuid, ['command -v ncat'])
-    except util.XSContainerException:
-        cause = (cause + "Unable to find ncat inside the VM. Please install "
-                 "ncat. ")
+    if not _can_open_streamlocal(session, vmuuid):
+        try:
+            execute_ssh(session, vmuuid, ['command -v ncat'])
+        except util.XSContainerException:
+            cause = (cause + "Unable to find ncat inside the VM. Please "
+                     "install ncat, or allow StreamLocalForwarding in "
+                     "sshd_config. ")
     try:
         execute_ssh(session, vmuuid, ['test', '-S', DOCKER_SOCKET_PATH])
     except util.XSContainerException:
@@ -0,0 +1,77 @@
+import unittest
+from mock import MagicMock, patch
+
+from xscontainer import api_helper
+from xscontainer.remote_helper import connection_profile
+
+SSH_OTHER_CONFIG = {api_helper.XSCONTAINER_MODE: 'ssh',
+                    api_helper.XSCONTAINER_USERNAME: 'docker'}
+
+
+@patch("xscontainer.api_helper.get_secret_values",
+       return_value={'identity-uuid': 'identity-key'})
+@patch("xscontainer.api_helper.get_idrsa_secret_uuid",
+       return_value='identity-uuid')
+@patch("xscontainer.api_helper.get_vm_other_config")
+class TestConnectionProfileCache(unittest.TestCase):
+
+    def test_profile_is_reused(self, get_other_config, get_identity_uuid,
+                               get_secret_values):
+        get_other_config.return_value = dict(SSH_OTHER_CONFIG)
+        cache = connection_profile.ConnectionProfileCache()
+
+        first = cache.get(MagicMock(), 'vm')
+        second = cache.get(MagicMock(), 'vm')
+
+        self.assertEqual(first, second)
+        self.assertEqual(first.mode, 'ssh')
+        self.assertEqual(first.username, 'docker')
+        self.assertEqual(first.hostkey, None)
+        self.assertEqual(first.identity_key, 'identity-key')
+        self.assertEqual(get_secret_values.call_count, 1)
+
+    def test_changed_other_config_reloads_profile(self, get_other_config,
+                                                  get_identity_uuid,
+                                                  get_secret_values):
+        remembered = dict(SSH_OTHER_CONFIG)
+        remembered[api_helper.XSCONTAINER_SSH_HOSTKEY] = 'hostkey'
+        get_other_config.side_effect = [dict(SSH_OTHER_CONFIG), remembered]
+        cache = connection_profile.ConnectionProfileCache()
+
+        first = cache.get(MagicMock(), 'vm')
+        second = cache.get(MagicMock(), 'vm')
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(second.hostkey, 'hostkey')
+        # The identity key of the pool is still the same
+        self.assertEqual(second.identity_key, 'identity-key')
+        self.assertEqual(get_secret_values.call_count, 1)
+
+    def test_invalidate(self, get_other_config, get_identity_uuid,
+                        get_secret_values):
+        get_other_config.return_value = dict(SSH_OTHER_CONFIG)
+        cache = connection_profile.ConnectionProfileCache()
+
+        first = cache.get(MagicMock(), 'vm')
+        cache.invalidate('vm')
+        second = cache.get(MagicMock(), 'vm')
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(get_secret_values.call_count, 2)
+
+    def test_tls_mode_needs_no_identity_key(self, get_other_config,
+                                            get_identity_uuid,
+                                            get_secret_values):
+        get_other_config.return_value = {
+            api_helper.XSCONTAINER_MODE: 'tls',
+            'xscontainer-tls-ca-cert': 'ca-uuid'}
+        cache = connection_profile.ConnectionProfileCache()
+
+        profile = cache.get(MagicMock(), 'vm')
+
+        self.assertEqual(profile.mode, 'tls')
+        self.assertEqual(profile.tls_secret_uuids,
+                         {'xscontainer-tls-ca-cert': 'ca-uuid'})
+        self.assertEqual(profile.identity_key, None)
+        self.assertFalse(get_identity_uuid.called)
+        self.assertFalse(get_secret_values.called)
@@ -0,0 +1,99 @@
+import json
+import unittest
+from mock import MagicMock, patch
+
+from xscontainer import remote_helper
+from xscontainer import util
+
+HEADER = ("HTTP/1.0 200 OK\r\nContent-Type: application/json\r\n"
+          "Server: Docker/1.12.6 (linux)\r\n\r\n")
+EVENTS = [{"status": "start", "id": "8dfafdbc3a40", "from": "busybox",
+           "Actor": {"Attributes": {"name": "web", "label": "{not}"}}},
+          {"status": "exec_start: /bin/sh -c \"echo }\"",
+           "id": "8dfafdbc3a40"}]
+
+
+def _stream():
+    return HEADER + "".join(json.dumps(event) + "\n" for event in EVENTS)
+
+
+class TestDockerEventDecoder(unittest.TestCase):
+
+    def test_events_in_pieces(self):
+        data = _stream()
+        for size in [1, 3, 16, len(data)]:
+            decoder = remote_helper.DockerEventDecoder()
+            events = []
+            for index in range(0, len(data), size):
+                events.extend(decoder.feed(data[index:index + size]))
+            self.assertEqual(events, EVENTS)
+
+    def test_events_are_ascii(self):
+        decoder = remote_helper.DockerEventDecoder()
+        event = decoder.feed(_stream())[0]
+        self.assertTrue(isinstance(event['status'], str))
+
+    def test_error_status(self):
+        decoder = remote_helper.DockerEventDecoder()
+        self.assertRaises(util.XSContainerException, decoder.feed,
+                          "HTTP/1.0 404 Not Found\r\n\r\n")
+
+
+class TestExecuteDockerEventListen(unittest.TestCase):
+
+    @patch("select.select")
+    @patch("xscontainer.remote_helper._get_connector")
+    def test_listen_until_closed(self, get_connector, mselect):
+        data = [_stream()[:50], _stream()[50:], ""]
+        connection = MagicMock()
+        connection.pending.return_value = False
+        connection.recv.side_effect = data
+        get_connector.return_value.__name__ = 'ssh'
+        get_connector.return_value.open_docker_connection.return_value = (
+            connection)
+        mselect.return_value = ([connection.fileno()], [], [])
+
+        events = list(remote_helper.execute_docker_event_listen(
+            MagicMock(), 'vm', []))
+
+        self.assertEqual(events, EVENTS)
+        connection.close.assert_called_once_with()
+
+    @patch("select.select")
+    @patch("xscontainer.remote_helper._get_connector")
+    def test_listen_with_filters(self, get_connector, mselect):
+        connection = MagicMock()
+        connection.pending.return_value = False
+        connection.recv.side_effect = ["HTTP/1.0 400 Bad Request\r\n\r\n"]
+        get_connector.return_value.__name__ = 'ssh'
+        get_connector.return_value.open_docker_connection.return_value = (
+            connection)
+        mselect.return_value = ([connection.fileno()], [], [])
+
+        try:
+            list(remote_helper.execute_docker_event_listen(
+                MagicMock(), 'vm', [], '/events?filters=x'))
+            self.fail("DockerEventsRefused expected")
+        except remote_helper.DockerEventsRefused as exception:
+            self.assertEqual(exception.status, 400)
+
+        connection.sendall.assert_called_once_with(
+            "GET /events?filters=x HTTP/1.0\r\n\r\n")
+        connection.close.assert_called_once_with()
+
+    @patch("select.select")
+    @patch("xscontainer.remote_helper._get_connector")
+    def test_listen_yields_idle(self, get_connector, mselect):
+        connection = MagicMock()
+        connection.pending.return_value = False
+        connection.recv.side_effect = [_stream(), ""]
+        get_connector.return_value.__name__ = 'ssh'
+        get_connector.return_value.open_docker_connection.return_value = (
+            connection)
+        mselect.side_effect = [([], [], []), ([connection.fileno()], [], []),
+                               ([connection.fileno()], [], [])]
+
+        events = list(remote_helper.execute_docker_event_listen(
+            MagicMock(), 'vm', [], yield_idle=True))
+
+        self.assertEqual(events, [None] + EVENTS)
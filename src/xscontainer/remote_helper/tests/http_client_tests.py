@@ -0,0 +1,194 @@
+import unittest
+from mock import MagicMock, patch
+
+from xscontainer.remote_helper import http_client
+
+
+class FakeConnection(object):
+
+    """Replays canned response data in small pieces."""
+
+    def __init__(self, data, piece=7):
+        self.data = data
+        self.piece = piece
+        self.sent = []
+        self.closed = False
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+    def recv(self, size):
+        size = min(size, self.piece)
+        result = self.data[:size]
+        self.data = self.data[size:]
+        return result
+
+    def fileno(self):
+        return 0
+
+    def pending(self):
+        return False
+
+    def settimeout(self, timeout):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def _response(body, headers=None):
+    headers = headers or ["Content-Length: %d" % (len(body))]
+    return ("HTTP/1.1 200 OK\r\n" + "\r\n".join(headers) +
+            "\r\n\r\n" + body)
+
+
+def _chunked(body, size=5):
+    result = ""
+    for index in range(0, len(body), size):
+        chunk = body[index:index + size]
+        result = result + "%x\r\n%s\r\n" % (len(chunk), chunk)
+    return result + "0\r\n\r\n"
+
+
+class TestHttpConnection(unittest.TestCase):
+
+    def test_content_length(self):
+        connection = http_client.HttpConnection(
+            FakeConnection(_response('{"a": 1}') + _response('[]')))
+
+        first = connection.request('GET', '/info')
+        second = connection.request('GET', '/containers/json')
+
+        self.assertEqual(first.status, 200)
+        self.assertEqual(first.body, '{"a": 1}')
+        self.assertEqual(second.body, '[]')
+        self.assertTrue(connection.reusable)
+
+    def test_chunked(self):
+        body = '{"Containers": 12, "Images": 3}'
+        connection = http_client.HttpConnection(
+            FakeConnection(_response(_chunked(body),
+                                     ["Transfer-Encoding: chunked"])))
+
+        response = connection.request('GET', '/info')
+
+        self.assertEqual(response.body, body)
+        self.assertTrue(connection.reusable)
+
+    def test_no_body_for_304(self):
+        connection = http_client.HttpConnection(FakeConnection(
+            "HTTP/1.1 304 Not Modified\r\n\r\n"))
+
+        response = connection.request('POST', '/containers/abc/start')
+
+        self.assertEqual(response.status, 304)
+        self.assertEqual(response.body, '')
+        self.assertTrue("Content-Length: 0" in
+                        connection.connection.sent[0])
+
+    def test_connection_close(self):
+        connection = http_client.HttpConnection(FakeConnection(
+            _response('[]', ["Content-Length: 2", "Connection: close"])))
+
+        connection.request('GET', '/containers/json')
+
+        self.assertFalse(connection.reusable)
+
+    def test_unframed_body_reads_until_close(self):
+        connection = http_client.HttpConnection(FakeConnection(
+            "HTTP/1.0 200 OK\r\n\r\n{}"))
+
+        response = connection.request('GET', '/version')
+
+        self.assertEqual(response.body, '{}')
+        self.assertFalse(connection.reusable)
+
+    @patch("xscontainer.remote_helper.constants.MAX_RESPONSE_SIZE", 10)
+    def test_limit_content_length(self):
+        connection = http_client.HttpConnection(
+            FakeConnection(_response('x' * 11)))
+
+        self.assertRaises(http_client.HttpException,
+                          connection.request, 'GET', '/containers/json')
+        self.assertFalse(connection.reusable)
+
+    @patch("xscontainer.remote_helper.constants.MAX_RESPONSE_SIZE", 10)
+    def test_limit_chunked(self):
+        connection = http_client.HttpConnection(
+            FakeConnection(_response(_chunked('x' * 11),
+                                     ["Transfer-Encoding: chunked"])))
+
+        self.assertRaises(http_client.HttpException,
+                          connection.request, 'GET', '/containers/json')
+
+    def test_body_sink(self):
+        pieces = []
+        connection = http_client.HttpConnection(FakeConnection(
+            _response(_chunked('[1, 2, 3]'), ["Transfer-Encoding: chunked"])))
+
+        response = connection.request('GET', '/containers/json',
+                                      pieces.append)
+
+        self.assertEqual(response.body, None)
+        self.assertEqual(''.join(pieces), '[1, 2, 3]')
+
+
+@patch("xscontainer.remote_helper.http_client.HttpConnection.is_dropped")
+class TestDockerConnectionPool(unittest.TestCase):
+
+    def test_connection_is_reused(self, is_dropped):
+        is_dropped.return_value = False
+        connector = MagicMock()
+        connector.__name__ = 'ssh'
+        connector.open_docker_connection.return_value = FakeConnection(
+            _response('{}') * 3)
+        pool = http_client.DockerConnectionPool()
+
+        for path in ['/info', '/version', '/containers/json']:
+            response = pool.request(MagicMock(), 'vm', connector, 'GET',
+                                    path)
+            self.assertEqual(response.body, '{}')
+
+        self.assertEqual(connector.open_docker_connection.call_count, 1)
+
+    def test_retry_when_reused_connection_was_closed(self, is_dropped):
+        is_dropped.return_value = False
+        connector = MagicMock()
+        connector.__name__ = 'tls'
+        first = FakeConnection(_response('{}'))
+        connector.open_docker_connection.side_effect = [
+            first, FakeConnection(_response('[]'))]
+        pool = http_client.DockerConnectionPool()
+        pool.request(MagicMock(), 'vm', connector, 'GET', '/info')
+
+        response = pool.request(MagicMock(), 'vm', connector, 'GET',
+                                '/containers/json')
+
+        self.assertEqual(response.body, '[]')
+        self.assertTrue(first.closed)
+
+    def test_invalidate(self, is_dropped):
+        is_dropped.return_value = False
+        connector = MagicMock()
+        connector.__name__ = 'ssh'
+        first = FakeConnection(_response('{}'))
+        connector.open_docker_connection.side_effect = [
+            first, FakeConnection(_response('{}'))]
+        pool = http_client.DockerConnectionPool()
+        pool.request(MagicMock(), 'vm', connector, 'GET', '/info')
+
+        pool.invalidate('vm')
+        pool.request(MagicMock(), 'vm', connector, 'GET', '/info')
+
+        self.assertTrue(first.closed)
+        self.assertEqual(connector.open_docker_connection.call_count, 2)
+
+
+class TestGetEndpoint(unittest.TestCase):
+
+    def test_ids_and_query_are_dropped(self):
+        self.assertEqual(http_client.get_endpoint('/info'), '/info')
+        self.assertEqual(http_client.get_endpoint(
+            '/containers/json?all=1&size=0'), '/containers/json')
+        self.assertEqual(http_client.get_endpoint(
+            '/containers/8dfafdbc3a40/top'), '/containers/{id}/top')
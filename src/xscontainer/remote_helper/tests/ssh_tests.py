@@ -0,0 +1,267 @@
+import unittest
+from mock import MagicMock, patch
+
+from xscontainer.remote_helper import constants
+from xscontainer.remote_helper import is_persistent_failure
+from xscontainer.remote_helper import ssh
+
+
+def _mock_client(hostkey='hostkey'):
+    client = MagicMock()
+    transport = client.get_transport.return_value
+    transport.get_remote_server_key.return_value.get_base64.return_value = (
+        hostkey)
+    transport.is_active.return_value = True
+    return client
+
+
+def _profile(hostkey='hostkey'):
+    return MagicMock(hostkey=hostkey)
+
+
+@patch("xscontainer.remote_helper.connection_profile.get_profile")
+@patch("xscontainer.api_helper.get_suitable_vm_ip")
+@patch("xscontainer.remote_helper.ssh.prepare_ssh_client")
+class TestSshTransportPool(unittest.TestCase):
+
+    def test_transport_is_reused(self, prepare_ssh_client, get_ip,
+                                 get_profile):
+        prepare_ssh_client.return_value = _mock_client()
+        get_ip.return_value = '10.0.0.1'
+        get_profile.return_value = _profile()
+        pool = ssh.SshTransportPool()
+
+        first, reused = pool.acquire(MagicMock(), 'vm')
+        self.assertFalse(reused)
+        pool.release('vm', first)
+        second, reused = pool.acquire(MagicMock(), 'vm')
+
+        self.assertTrue(reused)
+        self.assertEqual(first, second)
+        self.assertEqual(prepare_ssh_client.call_count, 1)
+
+    def test_ip_change_invalidates(self, prepare_ssh_client, get_ip,
+                                   get_profile):
+        old_client = _mock_client()
+        prepare_ssh_client.side_effect = [old_client, _mock_client()]
+        get_ip.side_effect = ['10.0.0.1', '10.0.0.2']
+        get_profile.return_value = _profile()
+        pool = ssh.SshTransportPool()
+
+        first, _ = pool.acquire(MagicMock(), 'vm')
+        pool.release('vm', first)
+        second, reused = pool.acquire(MagicMock(), 'vm')
+
+        self.assertFalse(reused)
+        self.assertEqual(second.host, '10.0.0.2')
+        old_client.close.assert_called_once_with()
+
+    def test_hostkey_change_invalidates(self, prepare_ssh_client, get_ip,
+                                        get_profile):
+        prepare_ssh_client.side_effect = [_mock_client(), _mock_client()]
+        get_ip.return_value = '10.0.0.1'
+        get_profile.side_effect = [_profile(), _profile(None)]
+        pool = ssh.SshTransportPool()
+
+        first, _ = pool.acquire(MagicMock(), 'vm')
+        pool.release('vm', first)
+        _, reused = pool.acquire(MagicMock(), 'vm')
+
+        self.assertFalse(reused)
+        self.assertEqual(prepare_ssh_client.call_count, 2)
+
+    @patch("time.time")
+    def test_idle_transport_is_evicted(self, mtime, prepare_ssh_client,
+                                       get_ip, get_profile):
+        old_client = _mock_client()
+        prepare_ssh_client.side_effect = [old_client, _mock_client()]
+        get_ip.return_value = '10.0.0.1'
+        get_profile.return_value = _profile()
+        mtime.return_value = 1000.0
+        pool = ssh.SshTransportPool()
+
+        first, _ = pool.acquire(MagicMock(), 'vm')
+        pool.release('vm', first)
+        mtime.return_value = 1001.0 + constants.SSH_TRANSPORT_IDLE_TIMEOUT_S
+        _, reused = pool.acquire(MagicMock(), 'vm')
+
+        self.assertFalse(reused)
+        old_client.close.assert_called_once_with()
+
+    def test_transports_per_vm_are_capped(self, prepare_ssh_client, get_ip,
+                                          get_profile):
+        prepare_ssh_client.side_effect = lambda *args: _mock_client()
+        get_ip.return_value = '10.0.0.1'
+        get_profile.return_value = _profile()
+        pool = ssh.SshTransportPool()
+        channels = (constants.SSH_CHANNELS_PER_TRANSPORT_MAX *
+                    constants.SSH_TRANSPORTS_PER_VM_MAX)
+
+        for _ in range(channels):
+            pool.acquire(MagicMock(), 'vm')
+        extra, _ = pool.acquire(MagicMock(), 'vm')
+        pool.release('vm', extra)
+
+        self.assertEqual(prepare_ssh_client.call_count,
+                         constants.SSH_TRANSPORTS_PER_VM_MAX + 1)
+        self.assertFalse(extra.pooled)
+        extra.client.close.assert_called_once_with()
+
+    def test_invalidate(self, prepare_ssh_client, get_ip, get_profile):
+        idle_client = _mock_client()
+        busy_client = _mock_client()
+        prepare_ssh_client.side_effect = [idle_client, busy_client,
+                                          _mock_client()]
+        get_ip.return_value = '10.0.0.1'
+        get_profile.return_value = _profile()
+        pool = ssh.SshTransportPool()
+        idle, _ = pool.acquire(MagicMock(), 'vm')
+        idle.channels = constants.SSH_CHANNELS_PER_TRANSPORT_MAX
+        busy, _ = pool.acquire(MagicMock(), 'vm')
+        idle.channels = 1
+        pool.release('vm', idle)
+
+        pool.invalidate('vm')
+
+        idle_client.close.assert_called_once_with()
+        self.assertFalse(busy_client.close.called)
+        _, reused = pool.acquire(MagicMock(), 'vm')
+        self.assertFalse(reused)
+        pool.release('vm', busy)
+        busy_client.close.assert_called_once_with()
+
+    def test_failed_open_releases_transport(self, prepare_ssh_client,
+                                            get_ip, get_profile):
+        prepare_ssh_client.return_value = _mock_client()
+        get_ip.return_value = '10.0.0.1'
+        get_profile.return_value = _profile()
+        pool = ssh.SshTransportPool()
+
+        with patch.object(ssh, 'SSH_TRANSPORT_POOL', pool):
+            self.assertRaises(
+                ssh.SshException, ssh._open_on_pooled_transport,
+                MagicMock(), 'vm',
+                MagicMock(side_effect=ssh.SshException("Connect failed")))
+        pooled, reused = pool.acquire(MagicMock(), 'vm')
+
+        self.assertTrue(reused)
+        self.assertEqual(pooled.channels, 1)
+
+
+class TestStreamlocal(unittest.TestCase):
+
+    def _channel_open_message(self, kind):
+        message = ssh.paramiko.Message()
+        message.add_byte(chr(ssh.paramiko.common.MSG_CHANNEL_OPEN))
+        message.add_string(kind)
+        message.add_int(0)
+        message.add_int(2097152)
+        message.add_int(32768)
+        return message
+
+    def test_socket_path_is_added(self):
+        transport = MagicMock()
+        send_user_message = transport._send_user_message
+        ssh._enable_streamlocal(transport)
+
+        transport._send_user_message(
+            self._channel_open_message(ssh.STREAMLOCAL_CHANNEL))
+
+        sent = send_user_message.call_args[0][0]
+        sent.rewind()
+        sent.get_byte()
+        self.assertEqual(sent.get_string(), ssh.STREAMLOCAL_CHANNEL)
+        sent.get_int()
+        sent.get_int()
+        sent.get_int()
+        self.assertEqual(sent.get_string(), ssh.DOCKER_SOCKET_PATH)
+        self.assertEqual(sent.get_string(), '')
+        self.assertEqual(sent.get_int(), 0)
+
+    def test_other_channels_are_untouched(self):
+        transport = MagicMock()
+        send_user_message = transport._send_user_message
+        ssh._enable_streamlocal(transport)
+        message = self._channel_open_message('session')
+        content = message.asbytes()
+
+        transport._send_user_message(message)
+
+        sent = send_user_message.call_args[0][0]
+        self.assertEqual(sent.asbytes(), content)
+
+    def test_fallback_to_ncat(self):
+        pooled = MagicMock()
+        pooled.streamlocal = None
+        transport = pooled.client.get_transport.return_value
+        transport.open_channel.side_effect = ssh.paramiko.ChannelException(
+            1, 'Administratively prohibited')
+
+        channel, via_ncat = ssh._open_docker_channel_on(pooled, 'vm')
+
+        self.assertTrue(via_ncat)
+        self.assertEqual(pooled.streamlocal, False)
+        channel.exec_command.assert_called_once_with(
+            ssh.prepare_request_cmd())
+        # Once known to be unsupported, streamlocal isn't tried again
+        ssh._open_docker_channel_on(pooled, 'vm')
+        self.assertEqual(transport.open_channel.call_count, 1)
+
+    def test_unknown_channel_type_falls_back_to_ncat(self):
+        pooled = MagicMock()
+        pooled.streamlocal = None
+        transport = pooled.client.get_transport.return_value
+        transport.open_channel.side_effect = ssh.paramiko.ChannelException(
+            3, 'Unknown channel type')
+
+        _, via_ncat = ssh._open_docker_channel_on(pooled, 'vm')
+
+        self.assertTrue(via_ncat)
+        self.assertEqual(pooled.streamlocal, False)
+
+    def test_connect_failure_is_retryable(self):
+        pooled = MagicMock()
+        pooled.streamlocal = None
+        transport = pooled.client.get_transport.return_value
+        transport.open_channel.side_effect = ssh.paramiko.ChannelException(
+            2, 'Connect failed')
+
+        try:
+            ssh._open_docker_channel_on(pooled, 'vm')
+            self.fail("No exception")
+        except ssh.util.XSContainerException as exception:
+            self.assertFalse(is_persistent_failure(exception))
+
+        # streamlocal is tried again next time
+        self.assertEqual(pooled.streamlocal, None)
+        self.assertFalse(transport.open_session.called)
+        transport.open_channel.side_effect = None
+        channel, via_ncat = ssh._open_docker_channel_on(pooled, 'vm')
+        self.assertFalse(via_ncat)
+        self.assertEqual(pooled.streamlocal, True)
+
+
+@patch("xscontainer.remote_helper.ssh.execute_ssh")
+@patch("xscontainer.api_helper.get_suitable_vm_ip")
+class TestDetermineErrorCause(unittest.TestCase):
+
+    def test_missing_docker_socket(self, get_ip, execute_ssh):
+        get_ip.return_value = '10.0.0.1'
+
+        def fail_socket_test(session, vmuuid, cmd):
+            if cmd[0] == 'test':
+                raise ssh.SshException("Returncode for 'test' is not 0")
+        execute_ssh.side_effect = fail_socket_test
+        pool = MagicMock()
+        pooled = MagicMock()
+        pooled.streamlocal = None
+        pooled.client.get_transport.return_value.open_channel.side_effect = (
+            ssh.paramiko.ChannelException(2, 'Connect failed'))
+        pool.acquire.return_value = (pooled, False)
+
+        with patch.object(ssh, 'SSH_TRANSPORT_POOL', pool):
+            cause = ssh.determine_error_cause(MagicMock(), 'vm')
+
+        self.assertTrue("Unable to find the Docker unix socket" in cause)
+        self.assertTrue("ncat" not in cause)
+        pool.release.assert_called_once_with('vm', pooled)
@@ -0,0 +1,76 @@
+import unittest
+from mock import MagicMock, patch
+
+from xscontainer.remote_helper import tls
+
+SECRET_UUIDS = {'xscontainer-tls-client-cert': 'cert-uuid',
+                'xscontainer-tls-client-key': 'key-uuid',
+                'xscontainer-tls-ca-cert': 'ca-uuid'}
+
+
+def _profile(secret_uuids):
+    return MagicMock(tls_secret_uuids=dict(secret_uuids))
+
+
+@patch("xscontainer.remote_helper.tls._create_context")
+@patch("xscontainer.remote_helper.connection_profile.get_profile")
+class TestTlsContextCache(unittest.TestCase):
+
+    def test_context_is_reused(self, get_profile, create_context):
+        get_profile.return_value = _profile(SECRET_UUIDS)
+        cache = tls.TlsContextCache()
+
+        first = cache.get_context(MagicMock(), 'vm')
+        second = cache.get_context(MagicMock(), 'vm')
+
+        self.assertEqual(first, second)
+        self.assertEqual(create_context.call_count, 1)
+
+    def test_changed_secrets_reload_context(self, get_profile,
+                                            create_context):
+        changed_uuids = dict(SECRET_UUIDS)
+        changed_uuids['xscontainer-tls-client-key'] = 'new-key-uuid'
+        get_profile.side_effect = [_profile(SECRET_UUIDS),
+                                   _profile(changed_uuids)]
+        create_context.side_effect = [MagicMock(), MagicMock()]
+        cache = tls.TlsContextCache()
+
+        first = cache.get_context(MagicMock(), 'vm')
+        second = cache.get_context(MagicMock(), 'vm')
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(create_context.call_args[0][2], changed_uuids)
+        self.assertEqual(create_context.call_count, 2)
+
+    def test_invalidate(self, get_profile, create_context):
+        get_profile.return_value = _profile(SECRET_UUIDS)
+        create_context.side_effect = [MagicMock(), MagicMock()]
+        cache = tls.TlsContextCache()
+
+        first = cache.get_context(MagicMock(), 'vm')
+        cache.invalidate('vm')
+        second = cache.get_context(MagicMock(), 'vm')
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(create_context.call_count, 2)
+
+
+class TestTlsDockerConnection(unittest.TestCase):
+
+    def test_nothing_to_read_without_blocking(self):
+        asocket = MagicMock()
+        asocket.recv.side_effect = tls.ssl.SSLWantReadError()
+        connection = tls.TlsDockerConnection('vm', asocket)
+
+        self.assertRaises(tls.TlsException, connection.recv, 10)
+        connection.setblocking(False)
+        self.assertEqual(connection.recv(10), None)
+        asocket.setblocking.assert_called_once_with(False)
+
+    def test_failure_without_blocking(self):
+        asocket = MagicMock()
+        asocket.recv.side_effect = tls.ssl.SSLError("bad record mac")
+        connection = tls.TlsDockerConnection('vm', asocket)
+        connection.setblocking(False)
+
+        self.assertRaises(tls.TlsException, connection.recv, 10)
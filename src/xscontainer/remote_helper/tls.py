@@ -2,13 +2,13 @@ from xscontainer import api_helper
 from xscontainer import util
 from xscontainer.util import tls_secret
 from xscontainer.util import log
-import constants
+import connection_profile
+import http_client
 
-import errno
-import select
 import ssl
 import socket
 import sys
+import threading
 
 DOCKER_TLS_PORT = 2376
 TLS_CIPHER = "ECDHE-RSA-AES256-GCM-SHA384"
@@ -25,9 +25,51 @@ class TlsException(util.XSContainerException):
     pass
 
 
-def _get_socket(session, vm_uuid):
-    temptlspaths = tls_secret.export_for_vm(session, vm_uuid)
-    thesocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+class TlsContextCache(object):
+
+    """
+    Keeps one SSLContext per VM, so that the TLS secrets only need to be
+    fetched and loaded when they change.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        util.recreate_lock_after_fork(self)
+        # _contexts[vm_uuid] = (secret_uuids, SSLContext)
+        self._contexts = {}
+
+    def get_context(self, session, vm_uuid):
+        secret_uuids = connection_profile.get_profile(
+            session, vm_uuid).tls_secret_uuids
+        self._lock.acquire()
+        try:
+            cached = self._contexts.get(vm_uuid)
+        finally:
+            self._lock.release()
+        if cached and cached[0] == secret_uuids:
+            return cached[1]
+        log.info("Loading TLS context for VM %s" % (vm_uuid))
+        context = _create_context(session, vm_uuid, secret_uuids)
+        self._lock.acquire()
+        try:
+            self._contexts[vm_uuid] = (secret_uuids, context)
+        finally:
+            self._lock.release()
+        return context
+
+    def invalidate(self, vm_uuid):
+        self._lock.acquire()
+        try:
+            self._contexts.pop(vm_uuid, None)
+        finally:
+            self._lock.release()
+
+
+TLS_CONTEXT_CACHE = TlsContextCache()
+
+
+def _create_context(session, vm_uuid, secret_uuids):
+    temptlspaths = tls_secret.export_for_vm(session, vm_uuid, secret_uuids)
     # Force TLSv1.2 - as it is the safest choice
     context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
     context.set_ciphers(TLS_CIPHER)
@@ -35,77 +77,86 @@ def _get_socket(session, vm_uuid):
     context.load_cert_chain(certfile=temptlspaths['client_cert'],
                             keyfile=temptlspaths['client_key'])
     context.load_verify_locations(cafile=temptlspaths['ca_cert'])
+    return context
+
+
+def _get_socket(session, vm_uuid):
+    context = TLS_CONTEXT_CACHE.get_context(session, vm_uuid)
+    thesocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     return context.wrap_socket(thesocket,
                                server_side=False,
                                do_handshake_on_connect=True)
 
 
-def execute_docker(session, vm_uuid, request):
-    host = api_helper.get_suitable_vm_ip(session, vm_uuid, DOCKER_TLS_PORT)
-    log.info("tls.execute_docker for VM %s, via %s" % (vm_uuid, host))
+def _connect(session, vm_uuid, host):
     asocket = _get_socket(session, vm_uuid)
     try:
         asocket.connect((host, DOCKER_TLS_PORT))
-        asocket.send(request)
-        result = ""
-        while len(result) < constants.MAX_BUFFER_SIZE:
-            result_iteration = asocket.recv(
-                constants.MAX_BUFFER_SIZE - len(result))
-            if result_iteration == "":
-                break
-            result += result_iteration
-    except ssl.SSLError as exception:
-        raise TlsException("Failed to communicate with Docker via TLS: %s"
-                           % exception, (sys.exc_info()[2]))
-    finally:
+    except Exception:
+        asocket.close()
+        raise
+    return asocket
+
+
+class TlsDockerConnection(object):
+
+    """A byte stream to the Docker daemon of a VM over TLS."""
+
+    def __init__(self, vm_uuid, asocket):
+        self._vm_uuid = vm_uuid
+        self._socket = asocket
+        self._blocking = True
+
+    def sendall(self, data):
         try:
-            asocket.close()
-        except Exception:
-            log.exception("Failed to close socket. Moving on.")
-    return result
+            self._socket.sendall(data)
+        except (ssl.SSLError, socket.error) as exception:
+            raise TlsException("Failed to communicate with Docker via TLS: %s"
+                               % exception, (sys.exc_info()[2]))
+
+    def recv(self, size):
+        """ Returns None, if the connection is non-blocking and there is
+            nothing to read yet """
+        try:
+            return self._socket.recv(size)
+        except (ssl.SSLError, socket.error) as exception:
+            if not self._blocking and http_client.is_would_block(exception):
+                sys.exc_clear()
+                return None
+            raise TlsException("Failed to communicate with Docker via TLS: %s"
+                               % exception, (sys.exc_info()[2]))
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def pending(self):
+        return self._socket.pending() > 0
 
+    def settimeout(self, timeout):
+        self._socket.settimeout(timeout)
 
-def execute_docker_data_listen(session, vm_uuid, request,
-                               stop_monitoring_request):
+    def setblocking(self, blocking):
+        self._blocking = blocking
+        self._socket.setblocking(blocking)
+
+    def close(self):
+        self._socket.close()
+
+
+def open_docker_connection(session, vm_uuid):
     host = api_helper.get_suitable_vm_ip(session, vm_uuid, DOCKER_TLS_PORT)
-    log.info("tls.execute_docker_listen_charbychar for VM %s, via %s"
-             % (vm_uuid, host))
-    asocket = _get_socket(session, vm_uuid)
+    log.info("tls.open_docker_connection for VM %s, via %s" % (vm_uuid, host))
     try:
-        asocket.connect((host, DOCKER_TLS_PORT))
-        if hasattr(asocket, 'version'):
-            # Newer python versions provide the TLS version
-            log.info("Connected VM %s using %s" % (vm_uuid,
-                                                   asocket.version()))
-        asocket.send(request)
-        asocket.setblocking(0)
-        while not stop_monitoring_request:
-            rlist, _, _ = select.select(
-                [asocket.fileno()], [], [],
-                constants.MONITOR_EVENTS_POLL_INTERVAL)
-            if not rlist:
-                continue
-            try:
-                read_data = asocket.recv(1024)
-                if read_data == "":
-                    break
-                yield read_data
-            except IOError as exception:
-                if exception[0] not in (errno.EAGAIN, errno.EINTR):
-                    raise
-                sys.exc_clear()
-                continue
+        asocket = _connect(session, vm_uuid, host)
     except ssl.SSLError as exception:
         raise TlsException("Failed to communicate with Docker via TLS: %s"
                            % exception, (sys.exc_info()[2]))
     except socket.error as exception:
+        # The VM may have got a different IP
+        api_helper.forget_suitable_vm_ip(vm_uuid, DOCKER_TLS_PORT)
         raise TlsException("The connection failed: %s"
                            % exception, (sys.exc_info()[2]))
-    finally:
-        try:
-            asocket.close()
-        except Exception:
-            log.exception("Failed to close socket. Moving on.")
+    return TlsDockerConnection(vm_uuid, asocket)
 
 
 def determine_error_cause(session, vm_uuid):
@@ -116,14 +167,19 @@ def determine_error_cause(session, vm_uuid):
         cause = ERROR_CAUSE_NETWORK
         # No reason to continue, if there is no network connection
         return cause
+    connection = None
     try:
-        request = "GET '/info' HTTP/1.0\r\n\r\n"
-        execute_docker(session, vm_uuid, request)
-    except TlsException:
+        connection = http_client.HttpConnection(
+            open_docker_connection(session, vm_uuid))
+        connection.request('GET', '/info')
+    except util.XSContainerException:
         cause = (cause + "Unable to connect to the VM using TLS. Please "
                  "check the logs inside the VM and also try "
                  "connecting manually. The cause may be a problem "
                  "with the TLS certificates.")
+    finally:
+        if connection:
+            connection.close()
     if cause == "":
         cause = "Unable to determine cause of failure."
     return cause
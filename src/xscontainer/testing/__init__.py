@@ -0,0 +1,5 @@
+"""
+Stand-ins for XAPI and for the Docker daemons of VMs, for benchmarks and
+tests that need real connections rather than mocks. Not installed - like
+src/scripts, this is for development only.
+"""
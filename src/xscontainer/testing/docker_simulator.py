@@ -0,0 +1,473 @@
+"""
+A stand-in for the Docker daemons of many VMs, all served by one process.
+Each VM has an address of its own on the loopback network, e.g. 127.1.0.1,
+and the simulator accepts the connections of all VMs on one port, telling
+them apart by the address a connection came in on. With certificates it
+speaks TLS like a VM that has been prepared for the tls mode.
+
+It serves /containers/json (with the id filter), /info, /version, the
+inspect, top, start, stop, restart, pause and unpause calls for a container
+and an /events stream, whose events are sent by emit or by changing
+containers. disconnect drops the connections of a VM.
+"""
+from xscontainer.util import log
+
+import json
+import os
+import random
+import re
+import select
+import signal
+import socket
+import ssl
+import threading
+import time
+import urllib
+import urlparse
+
+# Certificates in the layout of tls_cert, which are valid for a century and
+# must never be used for anything but tests
+CERT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'certs')
+ACCEPT_POLL_S = 0.5
+MAX_REQUEST_LINE = 64 * 1024
+# What the sim.event label of a container is set to by toggle_container,
+# so that the change can be recognised in other_config
+EVENT_TOKEN = 'sim-event-%d'
+EVENT_LABEL = 'sim.event'
+EVENTS_HEADER = ("HTTP/1.0 200 OK\r\nContent-Type: application/json\r\n"
+                 "Server: Docker\r\n\r\n")
+# ACTIONS[action] = (state of the container afterwards, status of the event)
+ACTIONS = {'start': ('running', 'start'),
+           'stop': ('exited', 'die'),
+           'restart': ('running', 'restart'),
+           'pause': ('paused', 'pause'),
+           'unpause': ('running', 'unpause')}
+CONTAINER_PATH_PATTERN = re.compile(r'^/containers/([^/]+)/([a-z]+)$')
+REASONS = {200: 'OK', 204: 'No Content', 404: 'Not Found'}
+
+
+def get_vm_address(index):
+    """ Returns the loopback address of the index-th simulated VM """
+    return "127.1.%d.%d" % (index // 250, index % 250 + 1)
+
+
+class SimulatedDocker(object):
+
+    """The containers and daemon details of one VM."""
+
+    def __init__(self, address):
+        self.address = address
+        self._lock = threading.Lock()
+        # _containers[id] = container as listed by /containers/json
+        self._containers = {}
+        # The write ends of the pipes that wake up the open event streams,
+        # and what is pending for them
+        self._streams = {}
+        # The sockets of all connections to this VM
+        self._sockets = set()
+        self.info = {'ID': 'SIM:%s' % (address),
+                     'Containers': 0,
+                     'Images': 10,
+                     'Driver': 'overlay2',
+                     'KernelVersion': '4.19.0',
+                     'OperatingSystem': 'Simulated Linux',
+                     'NCPU': 2,
+                     'MemTotal': 2147483648,
+                     'Name': 'sim-%s' % (address),
+                     'ServerVersion': '18.09.7'}
+        self.version = {'Version': '18.09.7',
+                        'ApiVersion': '1.39',
+                        'MinAPIVersion': '1.12',
+                        'GoVersion': 'go1.10.8',
+                        'Os': 'linux',
+                        'Arch': 'amd64'}
+
+    def add_container(self, name, running=True):
+        self._lock.acquire()
+        try:
+            container_id = "%064x" % (random.getrandbits(256))
+            self._containers[container_id] = {
+                'Id': container_id,
+                'Names': ['/%s' % (name)],
+                'Image': 'registry.example.com/%s:1.0' % (name),
+                'ImageID': 'sha256:%064x' % (random.getrandbits(256)),
+                'Command': '/bin/sh -c sleep',
+                'Created': int(time.time()),
+                'Ports': [],
+                'Labels': {EVENT_LABEL: ''},
+                'State': '',
+                'Status': '',
+                'SizeRw': 0,
+                'SizeRootFs': 1234567,
+                'HostConfig': {'NetworkMode': 'default'},
+                'Mounts': []}
+            if running:
+                self._set_state(container_id, 'running')
+            else:
+                self._set_state(container_id, 'exited')
+            self.info['Containers'] = len(self._containers)
+            return container_id
+        finally:
+            self._lock.release()
+
+    def get_container_ids(self):
+        self._lock.acquire()
+        try:
+            return self._containers.keys()
+        finally:
+            self._lock.release()
+
+    def toggle_container(self, container_id, token=''):
+        """ Starts or stops a container and emits the event for it. token
+            is stored in the sim.event label of the container. """
+        self._lock.acquire()
+        try:
+            container = self._containers[container_id]
+            running = container['State'] == 'running'
+            container['Labels'][EVENT_LABEL] = token
+        finally:
+            self._lock.release()
+        if running:
+            self.run_action(container_id, 'stop')
+        else:
+            self.run_action(container_id, 'start')
+
+    def run_action(self, name, action):
+        """ Carries out POST /containers/<name>/<action> and emits the event
+            for it. Returns False, if there is no such container. """
+        self._lock.acquire()
+        try:
+            container = self._find(name)
+            if container is None:
+                return False
+            self._set_state(container['Id'], ACTIONS[action][0])
+            container_id = container['Id']
+            image = container['Image']
+            name = container['Names'][0][1:]
+        finally:
+            self._lock.release()
+        status = ACTIONS[action][1]
+        now = time.time()
+        self.emit({'status': status,
+                   'id': container_id,
+                   'from': image,
+                   'Type': 'container',
+                   'Action': status,
+                   'Actor': {'ID': container_id,
+                             'Attributes': {'image': image, 'name': name}},
+                   'time': int(now),
+                   'timeNano': int(now * 1000000000)})
+        return True
+
+    def inspect(self, name):
+        """ Returns what GET /containers/<name>/json returns, or None """
+        self._lock.acquire()
+        try:
+            container = self._find(name)
+            if container is None:
+                return None
+            return {'Id': container['Id'],
+                    'Name': container['Names'][0],
+                    'Created': container['Created'],
+                    'Image': container['ImageID'],
+                    'State': {'Status': container['State'],
+                              'Running': container['State'] != 'exited',
+                              'Paused': container['State'] == 'paused'},
+                    'Config': {'Image': container['Image'],
+                               'Cmd': container['Command'].split(' '),
+                               'Labels': dict(container['Labels'])},
+                    'HostConfig': dict(container['HostConfig']),
+                    'Mounts': []}
+        finally:
+            self._lock.release()
+
+    def top(self, name):
+        """ Returns what GET /containers/<name>/top returns, or None """
+        if self.inspect(name) is None:
+            return None
+        return {'Titles': ['UID', 'PID', 'PPID', 'C', 'STIME', 'TTY', 'TIME',
+                           'CMD'],
+                'Processes': [['root', '1', '0', '0', '12:00', '?',
+                               '00:00:00', '/bin/sh -c sleep']]}
+
+    def emit(self, event):
+        """ Sends event to the open event streams """
+        data = json.dumps(event) + "\n"
+        self._lock.acquire()
+        try:
+            for wakeup, pending in self._streams.iteritems():
+                pending.append(data)
+                os.write(wakeup, 'x')
+        finally:
+            self._lock.release()
+
+    def get_stream_count(self):
+        self._lock.acquire()
+        try:
+            return len(self._streams)
+        finally:
+            self._lock.release()
+
+    def list_containers(self, query):
+        filters = json.loads(query.get('filters', ['{}'])[0])
+        ids = filters.get('id')
+        self._lock.acquire()
+        try:
+            return [dict(container, Labels=dict(container['Labels']))
+                    for container in self._containers.itervalues()
+                    if not ids or any(container['Id'].startswith(prefix)
+                                      for prefix in ids)]
+        finally:
+            self._lock.release()
+
+    def add_stream(self, wakeup):
+        pending = []
+        self._lock.acquire()
+        try:
+            self._streams[wakeup] = pending
+        finally:
+            self._lock.release()
+        return pending
+
+    def pop_stream_data(self, wakeup):
+        self._lock.acquire()
+        try:
+            data = "".join(self._streams[wakeup])
+            del self._streams[wakeup][:]
+            return data
+        finally:
+            self._lock.release()
+
+    def remove_stream(self, wakeup):
+        self._lock.acquire()
+        try:
+            self._streams.pop(wakeup, None)
+        finally:
+            self._lock.release()
+
+    def add_socket(self, asocket):
+        self._lock.acquire()
+        try:
+            self._sockets.add(asocket)
+        finally:
+            self._lock.release()
+
+    def remove_socket(self, asocket):
+        self._lock.acquire()
+        try:
+            self._sockets.discard(asocket)
+        finally:
+            self._lock.release()
+
+    def disconnect(self):
+        """ Drops all connections, like a restart of the Docker daemon """
+        self._lock.acquire()
+        try:
+            sockets = list(self._sockets)
+        finally:
+            self._lock.release()
+        for asocket in sockets:
+            try:
+                asocket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                # It has been closed in the meantime
+                pass
+
+    def _find(self, name):
+        """ Docker accepts ids, unique prefixes of them and names """
+        matches = [container for container in self._containers.itervalues()
+                   if container['Id'].startswith(name) or
+                   container['Names'][0] == '/' + name]
+        if len(matches) != 1:
+            return None
+        return matches[0]
+
+    def _set_state(self, container_id, state):
+        container = self._containers[container_id]
+        container['State'] = state
+        if state == 'running':
+            container['Status'] = 'Up Less than a second'
+        elif state == 'paused':
+            container['Status'] = 'Up Less than a second (Paused)'
+        else:
+            container['Status'] = 'Exited (0) Less than a second ago'
+
+
+class DockerSimulator(object):
+
+    """
+    Serves the SimulatedDocker of each VM on port. Without certdir, which
+    holds the server/ca.pem, server-cert.pem and server-key.pem made by
+    util.tls_cert, it speaks plain HTTP.
+    """
+
+    def __init__(self, certdir=None, port=0, bind='0.0.0.0'):
+        self._context = None
+        if certdir:
+            self._context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+            self._context.verify_mode = ssl.CERT_REQUIRED
+            self._context.load_cert_chain(
+                certfile=os.path.join(certdir, 'server', 'server-cert.pem'),
+                keyfile=os.path.join(certdir, 'server', 'server-key.pem'))
+            self._context.load_verify_locations(
+                cafile=os.path.join(certdir, 'server', 'ca.pem'))
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((bind, port))
+        self._listener.listen(1024)
+        self._listener.settimeout(ACCEPT_POLL_S)
+        self._running = False
+        self._thread = None
+        # vms[address] = SimulatedDocker
+        self.vms = {}
+        self.requests = 0
+
+    def get_port(self):
+        return self._listener.getsockname()[1]
+
+    def add_vm(self, address, containers=0):
+        vm = SimulatedDocker(address)
+        for index in range(containers):
+            vm.add_container('sim_%d' % (index))
+        self.vms[address] = vm
+        return vm
+
+    def start(self):
+        # xscontainer.util.log restores the default action of SIGPIPE, which
+        # would end the process when a client goes away during a response
+        signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+        self._running = True
+        self._thread = threading.Thread(target=self._accept)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread:
+            self._thread.join()
+
+    def _accept(self):
+        while self._running:
+            try:
+                asocket, _ = self._listener.accept()
+            except socket.timeout:
+                continue
+            thread = threading.Thread(target=self._serve, args=(asocket,))
+            thread.daemon = True
+            thread.start()
+        self._listener.close()
+
+    def _serve(self, rawsocket):
+        asocket = rawsocket
+        vm = self.vms.get(rawsocket.getsockname()[0])
+        if vm:
+            # The TLS socket can't be shut down while another thread reads
+            # from it, but the socket underneath can
+            vm.add_socket(rawsocket)
+        try:
+            # Accepted sockets inherit the timeout of the listener
+            asocket.settimeout(None)
+            if self._context:
+                asocket = self._context.wrap_socket(asocket,
+                                                    server_side=True)
+            reader = asocket.makefile('rb')
+            while self._serve_request(vm, asocket, reader):
+                pass
+        except (socket.error, ssl.SSLError, ValueError):
+            # E.g. the probes of api_helper.get_suitable_vm_ip, which close
+            # without saying anything
+            pass
+        except Exception:
+            log.exception("Simulated Docker failed")
+        finally:
+            if vm:
+                vm.remove_socket(rawsocket)
+            asocket.close()
+
+    def _serve_request(self, vm, asocket, reader):
+        """ Returns True, if the connection is kept alive """
+        line = reader.readline(MAX_REQUEST_LINE)
+        if not line:
+            return False
+        method, path, protocol = line.split()
+        close = protocol != 'HTTP/1.1'
+        while True:
+            line = reader.readline(MAX_REQUEST_LINE)
+            if line in ('\r\n', '\n', ''):
+                break
+            name, _, value = line.partition(':')
+            if (name.strip().lower() == 'connection' and
+                    value.strip().lower() == 'close'):
+                close = True
+        self.requests = self.requests + 1
+        url = urlparse.urlparse(path)
+        match = CONTAINER_PATH_PATTERN.match(url.path)
+        if vm is None:
+            status, body = 404, {'message': 'No such VM'}
+        elif method == 'GET' and url.path == '/events':
+            self._stream_events(vm, asocket)
+            return False
+        elif method == 'GET' and url.path == '/containers/json':
+            status, body = 200, vm.list_containers(
+                urlparse.parse_qs(url.query))
+        elif method == 'GET' and url.path == '/info':
+            status, body = 200, vm.info
+        elif method == 'GET' and url.path == '/version':
+            status, body = 200, vm.version
+        elif match:
+            status, body = self._serve_container(vm, method, *match.groups())
+        else:
+            status, body = 404, {'message': 'page not found: %s'
+                                 % (urllib.unquote(url.path))}
+        data = ''
+        if status != 204:
+            data = json.dumps(body)
+        headers = ["HTTP/1.1 %d %s" % (status, REASONS[status]),
+                   "Content-Type: application/json",
+                   "Content-Length: %d" % (len(data))]
+        if close:
+            headers.append("Connection: close")
+        asocket.sendall("\r\n".join(headers) + "\r\n\r\n" + data)
+        return not close
+
+    def _serve_container(self, vm, method, name, operation):
+        name = urllib.unquote(name)
+        body = None
+        if method == 'GET' and operation == 'json':
+            body = vm.inspect(name)
+        elif method == 'GET' and operation == 'top':
+            body = vm.top(name)
+        elif method == 'POST' and operation in ACTIONS:
+            if vm.run_action(name, operation):
+                return 204, None
+        else:
+            return 404, {'message': 'page not found'}
+        if body is None:
+            return 404, {'message': 'No such container: %s' % (name)}
+        return 200, body
+
+    def _stream_events(self, vm, asocket):
+        """ Sends the events of vm until the client closes the stream """
+        wakeup_read, wakeup_write = os.pipe()
+        try:
+            vm.add_stream(wakeup_write)
+            asocket.sendall(EVENTS_HEADER)
+            # poll, as there may be more file descriptors than select can
+            # deal with
+            poller = select.poll()
+            poller.register(asocket.fileno(), select.POLLIN)
+            poller.register(wakeup_read, select.POLLIN)
+            while True:
+                ready = [fd for (fd, _) in poller.poll()]
+                if asocket.fileno() in ready:
+                    # The client doesn't send anything on an event stream
+                    # - it has closed it
+                    return
+                os.read(wakeup_read, 4096)
+                data = vm.pop_stream_data(wakeup_write)
+                if data:
+                    asocket.sendall(data)
+        finally:
+            vm.remove_stream(wakeup_write)
+            os.close(wakeup_read)
+            os.close(wakeup_write)
@@ -0,0 +1,424 @@
+"""
+An XAPI stand-in that keeps the objects of a pool in memory and serves them
+over XML-RPC like XAPI does, so that XenAPI.Session works against it
+unchanged. Every call is counted, to see how many round trips to the pool
+master an operation takes.
+
+Objects are plain records in dicts. The generic XAPI calls - get_all,
+get_all_records, get_all_records_where, get_record, get_by_uuid, get_<field>,
+set_<field>, add_to_<field>, remove_from_<field>, create and destroy - work
+for any class, so adding objects of a class is all a scenario needs. VBDs
+and VIFs are linked into the records of their VMs, and VBDs can be plugged.
+event_from reports the changes to the objects like XAPI does.
+"""
+from xscontainer.util import log
+from xscontainer.util import tls_secret
+
+import collections
+import copy
+import httplib
+import os
+import re
+import SimpleXMLRPCServer
+import SocketServer
+import threading
+import time
+import uuid
+import XenAPI
+import xmlrpclib
+
+NULLREF = 'OpaqueRef:NULL'
+# What get_all_records_where understands: conditions joined with "and",
+# which may be joined with "or"
+CONDITION_PATTERN = re.compile(r'^field "([^"]+)"="([^"]*)"$')
+# DEVICE_CLASSES[class name] = the field of the VM record that lists them
+DEVICE_CLASSES = {'VBD': 'VBDs', 'VIF': 'VIFs'}
+
+# api_helper uses XenAPI._parse_result of the module in Dom0, which the
+# XenAPI package on PyPI only has in its XenAPI.XenAPI module
+if not hasattr(XenAPI, '_parse_result'):
+    XenAPI._parse_result = XenAPI.XenAPI._parse_result
+
+
+def _failure(*details):
+    return XenAPI.Failure(list(details))
+
+
+def _to_string(value):
+    if isinstance(value, bool):
+        return str(value).lower()
+    return str(value)
+
+
+def _matches(record, expression):
+    for alternative in expression.split(' or '):
+        matches = True
+        for condition in alternative.split(' and '):
+            match = CONDITION_PATTERN.match(condition.strip())
+            if not match:
+                raise _failure('INTERNAL_ERROR',
+                               "Unsupported expression %s" % (expression))
+            name, value = match.groups()
+            if name not in record or _to_string(record[name]) != value:
+                matches = False
+        if matches:
+            return True
+    return False
+
+
+class FakeXapi(object):
+
+    """
+    The objects of a fake pool and the calls made to them. All methods are
+    thread-safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Notified when an event has been added
+        self._changed = threading.Condition(self._lock)
+        # _objects[class name][ref] = record
+        self._objects = {}
+        self._sequence = 0
+        # _events = [(event id, class name, operation, ref), ...]
+        self._events = []
+        # calls[method name, e.g. 'VM.get_record'] = number of calls
+        self.calls = collections.defaultdict(int)
+        # Functions called with (time, method name, args) after each call
+        # that succeeded
+        self._listeners = []
+
+    def create(self, class_name, record):
+        """ Adds an object and returns its ref. A uuid is made up, if the
+            record has none. """
+        self._lock.acquire()
+        try:
+            return self._create(class_name, record)
+        finally:
+            self._lock.release()
+
+    def get_record(self, class_name, ref):
+        self._lock.acquire()
+        try:
+            return copy.deepcopy(self._get(class_name, ref))
+        finally:
+            self._lock.release()
+
+    def update(self, class_name, ref, **fields):
+        self._lock.acquire()
+        try:
+            self._get(class_name, ref).update(fields)
+            self._add_event(class_name, 'mod', ref)
+        finally:
+            self._lock.release()
+
+    def add_listener(self, listener):
+        self._lock.acquire()
+        try:
+            self._listeners.append(listener)
+        finally:
+            self._lock.release()
+
+    def remove_listener(self, listener):
+        self._lock.acquire()
+        try:
+            self._listeners.remove(listener)
+        finally:
+            self._lock.release()
+
+    def get_calls(self):
+        self._lock.acquire()
+        try:
+            return dict(self.calls)
+        finally:
+            self._lock.release()
+
+    def reset_calls(self):
+        self._lock.acquire()
+        try:
+            self.calls.clear()
+        finally:
+            self._lock.release()
+
+    def call(self, method, args):
+        """ Carries out an XAPI call. Returns its value or raises
+            XenAPI.Failure. """
+        self._lock.acquire()
+        try:
+            self.calls[method] = self.calls[method] + 1
+            if method in ['event.from', 'event_from']:
+                # Waits for events without holding up other calls
+                return copy.deepcopy(self._event_from(*args[1:]))
+            value = copy.deepcopy(self._call(method, list(args)))
+            listeners = list(self._listeners)
+        finally:
+            self._lock.release()
+        now = time.time()
+        for listener in listeners:
+            listener(now, method, args)
+        return value
+
+    def _call(self, method, args):
+        if method == 'session.login_with_password':
+            return 'OpaqueRef:%s' % (uuid.uuid4())
+        elif method == 'session.logout':
+            return ''
+        class_name, _, name = method.partition('.')
+        if not name or not args:
+            raise _failure('MESSAGE_METHOD_UNKNOWN', method)
+        # The first argument is the session, which isn't checked
+        args = args[1:]
+        objects = self._objects.get(class_name, {})
+        if name == 'get_all':
+            return objects.keys()
+        elif name == 'get_all_records':
+            return objects
+        elif name == 'get_all_records_where':
+            return dict((ref, record) for (ref, record) in objects.iteritems()
+                        if _matches(record, args[0]))
+        elif name == 'get_by_uuid':
+            for ref, record in objects.iteritems():
+                if record['uuid'] == args[0]:
+                    return ref
+            raise _failure('UUID_INVALID', class_name, args[0])
+        elif name == 'create':
+            if class_name == 'message':
+                return self._create_message(*args)
+            return self._create(class_name, args[0])
+        record = self._get(class_name, args[0])
+        if name == 'get_record':
+            return record
+        elif name == 'destroy':
+            self._unlink_device(class_name, args[0], record)
+            del objects[args[0]]
+            self._add_event(class_name, 'del', args[0])
+            return ''
+        elif name.startswith('get_') and name[4:] in record:
+            return record[name[4:]]
+        elif class_name == 'VBD' and name in ['plug', 'unplug']:
+            record['currently_attached'] = name == 'plug'
+        elif name.startswith('set_') and name[4:] in record:
+            record[name[4:]] = args[1]
+        elif name.startswith('add_to_') and name[7:] in record:
+            field = record[name[7:]]
+            if args[1] in field:
+                raise _failure('MAP_DUPLICATE_KEY', class_name, name[7:],
+                               args[0], args[1])
+            field[args[1]] = args[2]
+        elif name.startswith('remove_from_') and name[12:] in record:
+            record[name[12:]].pop(args[1], None)
+        else:
+            raise _failure('MESSAGE_METHOD_UNKNOWN', method)
+        self._add_event(class_name, 'mod', args[0])
+        return ''
+
+    def _event_from(self, classes, token, timeout):
+        """ With an empty token, all objects of classes are returned as
+            'add' events, else the changes after token, waiting up to
+            timeout seconds for one """
+        classes = [name.lower() for name in classes]
+        if not token:
+            events = [self._get_event(0, class_name, 'add', ref)
+                      for class_name in self._objects
+                      if class_name.lower() in classes
+                      for ref in self._objects[class_name]]
+        else:
+            deadline = time.time() + float(timeout)
+            while True:
+                events = [self._get_event(*event) for event in self._events
+                          if event[0] > int(token) and
+                          event[1].lower() in classes]
+                remaining = deadline - time.time()
+                if events or remaining <= 0:
+                    break
+                self._changed.wait(remaining)
+        return {'events': events, 'valid_ref_counts': {},
+                'token': str(len(self._events))}
+
+    def _add_event(self, class_name, operation, ref):
+        self._events.append((len(self._events) + 1, class_name, operation,
+                             ref))
+        self._changed.notify_all()
+
+    def _get_event(self, event_id, class_name, operation, ref):
+        event = {'id': event_id, 'timestamp': str(time.time()),
+                 'class': class_name.lower(), 'operation': operation,
+                 'ref': ref}
+        record = self._objects.get(class_name, {}).get(ref)
+        if record is not None:
+            event['snapshot'] = record
+        return event
+
+    def _create(self, class_name, record):
+        self._sequence = self._sequence + 1
+        ref = 'OpaqueRef:%s-%d' % (class_name, self._sequence)
+        record = copy.deepcopy(record)
+        record.setdefault('uuid', str(uuid.uuid4()))
+        if class_name == 'VBD':
+            record.setdefault('currently_attached', False)
+        self._objects.setdefault(class_name, {})[ref] = record
+        self._add_event(class_name, 'add', ref)
+        if class_name in DEVICE_CLASSES:
+            vm_record = self._objects.get('VM', {}).get(record.get('VM'))
+            if vm_record is not None:
+                vm_record[DEVICE_CLASSES[class_name]].append(ref)
+                self._add_event('VM', 'mod', record['VM'])
+        return ref
+
+    def _unlink_device(self, class_name, ref, record):
+        if class_name in DEVICE_CLASSES:
+            vm_record = self._objects.get('VM', {}).get(record.get('VM'))
+            if vm_record is not None:
+                vm_record[DEVICE_CLASSES[class_name]].remove(ref)
+                self._add_event('VM', 'mod', record['VM'])
+
+    def _create_message(self, name, priority, class_name, obj_uuid, body):
+        return self._create('message', {'name': name,
+                                        'priority': priority,
+                                        'cls': class_name,
+                                        'obj_uuid': obj_uuid,
+                                        'body': body})
+
+    def _get(self, class_name, ref):
+        record = self._objects.get(class_name, {}).get(ref)
+        if record is None:
+            raise _failure('HANDLE_INVALID', class_name, ref)
+        return record
+
+
+class _RequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+    # Keep the connections of XenAPI.Session alive like XAPI does
+    protocol_version = 'HTTP/1.1'
+    rpc_paths = ('/', '/RPC2')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(SocketServer.ThreadingMixIn,
+              SimpleXMLRPCServer.SimpleXMLRPCServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Dispatcher(object):
+
+    def __init__(self, xapi):
+        self._xapi = xapi
+
+    def _dispatch(self, method, params):
+        try:
+            return {'Status': 'Success',
+                    'Value': self._xapi.call(method, params)}
+        except XenAPI.Failure as exception:
+            return {'Status': 'Failure', 'ErrorDescription': exception.details}
+        except Exception as exception:
+            log.exception("Fake XAPI call %s failed" % (method))
+            return {'Status': 'Failure',
+                    'ErrorDescription': ['INTERNAL_ERROR', str(exception)]}
+
+
+class FakeXapiServer(object):
+
+    """Serves a FakeXapi over XML-RPC on a local port."""
+
+    def __init__(self, xapi, address=('127.0.0.1', 0)):
+        self.xapi = xapi
+        self._server = _Server(address, requestHandler=_RequestHandler,
+                               logRequests=False, allow_none=True)
+        self._server.register_instance(_Dispatcher(xapi))
+        self._thread = None
+
+    def get_url(self):
+        return "http://%s:%d/" % self._server.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _ThreadLocalTransport(xmlrpclib.Transport):
+
+    """
+    Keeps a connection per thread. The Transport of xmlrpclib shares one
+    connection, which breaks when the monitor calls XAPI from several
+    threads at once.
+    """
+
+    def __init__(self):
+        xmlrpclib.Transport.__init__(self)
+        self._local = threading.local()
+
+    def make_connection(self, host):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or connection[0] != host:
+            chost, self._extra_headers, _ = self.get_host_info(host)
+            connection = (host, httplib.HTTPConnection(chost))
+            self._local.connection = connection
+        return connection[1]
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection:
+            self._local.connection = None
+            connection[1].close()
+
+
+def get_session(url):
+    """ Returns a XenAPI.Session that is logged in to the fake XAPI at url
+        and may be used by many threads """
+    session = XenAPI.Session(url, transport=_ThreadLocalTransport())
+    session.login_with_password("root", "", "1.0", "xscontainer")
+    return session
+
+
+def create_pool(xapi):
+    """ Creates a pool with a single host, which is the master, and returns
+        the ref of the host """
+    host_ref = xapi.create('host', {'name_label': 'host',
+                                    'API_version_major': 2,
+                                    'API_version_minor': 9,
+                                    'other_config': {}})
+    xapi.create('pool', {'master': host_ref, 'default_SR': NULLREF,
+                         'other_config': {}})
+    return host_ref
+
+
+def create_vm(xapi, host_ref, other_config=None, ips=None, order=0):
+    """ Creates a VM that runs on host_ref, with guest metrics that report
+        ips. Returns the ref of the VM. """
+    networks = dict(('%d/ip' % (index), address)
+                    for (index, address) in enumerate(ips or []))
+    metrics_ref = xapi.create('VM_guest_metrics', {'networks': networks})
+    return xapi.create('VM', {'name_label': 'vm',
+                              'power_state': 'Running',
+                              'resident_on': host_ref,
+                              'is_a_template': False,
+                              'is_control_domain': False,
+                              'guest_metrics': metrics_ref,
+                              'order': order,
+                              'VBDs': [],
+                              'VIFs': [],
+                              'other_config': dict(other_config or {})})
+
+
+def create_tls_secrets(xapi, certdir):
+    """ Creates secrets from the client certificates in certdir and returns
+        the other_config keys that point a VM in tls mode at them """
+    other_config = {}
+    for key, filename in [(tls_secret.XSCONTAINER_TLS_CLIENT_CERT,
+                           'cert.pem'),
+                          (tls_secret.XSCONTAINER_TLS_CLIENT_KEY, 'key.pem'),
+                          (tls_secret.XSCONTAINER_TLS_CA_CERT, 'ca.pem')]:
+        filehandle = open(os.path.join(certdir, 'client', filename))
+        try:
+            secret_ref = xapi.create('secret', {'value': filehandle.read()})
+        finally:
+            filehandle.close()
+        other_config[key] = xapi.get_record('secret', secret_ref)['uuid']
+    return other_config
@@ -0,0 +1,89 @@
+import json
+import socket
+import time
+import unittest
+
+from xscontainer.remote_helper import DockerEventDecoder
+from xscontainer.remote_helper import http_client
+from xscontainer.testing import docker_simulator
+
+
+class TestDockerSimulator(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = docker_simulator.DockerSimulator(bind='127.1.0.1')
+        self.vm = self.simulator.add_vm(docker_simulator.get_vm_address(0),
+                                        containers=2)
+        self.simulator.start()
+
+    def tearDown(self):
+        self.simulator.stop()
+
+    def _connect(self):
+        return socket.create_connection((self.vm.address,
+                                         self.simulator.get_port()), 5)
+
+    def test_requests(self):
+        asocket = self._connect()
+        try:
+            connection = http_client.HttpConnection(asocket)
+            containers = json.loads(connection.request(
+                'GET', '/containers/json?all=1&size=1').body)
+            container_id = containers[0]['Id']
+            filtered = json.loads(connection.request(
+                'GET', '/containers/json?filters=%7B%22id%22%3A%5B%22'
+                + container_id[:12] + '%22%5D%7D').body)
+            info = json.loads(connection.request('GET', '/info').body)
+            missing = connection.request('GET', '/images/json')
+        finally:
+            asocket.close()
+
+        self.assertEqual(len(containers), 2)
+        self.assertEqual([entry['Id'] for entry in filtered], [container_id])
+        self.assertEqual(info['Containers'], 2)
+        self.assertEqual(missing.status, 404)
+
+    def test_events(self):
+        asocket = self._connect()
+        try:
+            asocket.sendall("GET /events HTTP/1.0\r\n\r\n")
+            deadline = time.time() + 5
+            while not self.vm.get_stream_count() and time.time() < deadline:
+                time.sleep(0.01)
+            container_id = self.vm.get_container_ids()[0]
+            self.vm.toggle_container(container_id, 'sim-event-1')
+            decoder = DockerEventDecoder()
+            events = []
+            while not events:
+                events = decoder.feed(asocket.recv(http_client.RECV_SIZE))
+        finally:
+            asocket.close()
+
+        self.assertEqual(events[0]['status'], 'die')
+        self.assertEqual(events[0]['id'], container_id)
+        container = [entry for entry in self.vm.list_containers({})
+                     if entry['Id'] == container_id][0]
+        self.assertEqual(container['State'], 'exited')
+        self.assertEqual(container['Labels'][docker_simulator.EVENT_LABEL],
+                         'sim-event-1')
+
+    def test_container_actions(self):
+        container_id = self.vm.get_container_ids()[0]
+        asocket = self._connect()
+        try:
+            connection = http_client.HttpConnection(asocket)
+            paused = connection.request(
+                'POST', '/containers/%s/pause' % (container_id[:12]))
+            inspect = json.loads(connection.request(
+                'GET', '/containers/%s/json' % (container_id)).body)
+            top = json.loads(connection.request(
+                'GET', '/containers/%s/top' % (container_id)).body)
+            missing = connection.request('POST', '/containers/none/start')
+        finally:
+            asocket.close()
+
+        self.assertEqual(paused.status, 204)
+        self.assertEqual(inspect['Id'], container_id)
+        self.assertTrue(inspect['State']['Paused'])
+        self.assertEqual(len(top['Processes'][0]), len(top['Titles']))
+        self.assertEqual(missing.status, 404)
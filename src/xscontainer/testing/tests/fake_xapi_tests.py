@@ -0,0 +1,100 @@
+import unittest
+import XenAPI
+
+from xscontainer.testing import fake_xapi
+
+
+class TestFakeXapi(unittest.TestCase):
+
+    def setUp(self):
+        self.xapi = fake_xapi.FakeXapi()
+        self.host_ref = fake_xapi.create_pool(self.xapi)
+        self.server = fake_xapi.FakeXapiServer(self.xapi)
+        self.server.start()
+        self.session = fake_xapi.get_session(self.server.get_url())
+
+    def tearDown(self):
+        self.session.xenapi.session.logout()
+        self.session.transport.close()
+        self.server.stop()
+
+    def test_records(self):
+        vm_ref = fake_xapi.create_vm(self.xapi, self.host_ref,
+                                     {'xscontainer-monitor': 'True'},
+                                     ['127.1.0.1'])
+        fake_xapi.create_vm(self.xapi, 'OpaqueRef:other-host')
+        vm_uuid = self.xapi.get_record('VM', vm_ref)['uuid']
+
+        records = self.session.xenapi.VM.get_all_records_where(
+            'field "resident_on"="%s" and field "is_a_template"="false"'
+            % (self.host_ref))
+
+        self.assertEqual(records.keys(), [vm_ref])
+        self.assertEqual(self.session.xenapi.VM.get_by_uuid(vm_uuid), vm_ref)
+        metrics_ref = self.session.xenapi.VM.get_guest_metrics(vm_ref)
+        self.assertEqual(
+            self.session.xenapi.VM_guest_metrics.get_networks(metrics_ref),
+            {'0/ip': '127.1.0.1'})
+
+    def test_other_config(self):
+        vm_ref = fake_xapi.create_vm(self.xapi, self.host_ref)
+
+        self.session.xenapi.VM.add_to_other_config(vm_ref, 'docker_ps', '1')
+        self.assertRaises(XenAPI.Failure,
+                          self.session.xenapi.VM.add_to_other_config,
+                          vm_ref, 'docker_ps', '2')
+        self.session.xenapi.VM.remove_from_other_config(vm_ref, 'docker_ps')
+        self.session.xenapi.VM.add_to_other_config(vm_ref, 'docker_ps', '3')
+
+        self.assertEqual(self.xapi.get_record('VM', vm_ref)['other_config'],
+                         {'docker_ps': '3'})
+
+    def test_devices(self):
+        vm_ref = fake_xapi.create_vm(self.xapi, self.host_ref)
+
+        vbd_ref = self.session.xenapi.VBD.create({'VM': vm_ref,
+                                                  'VDI': fake_xapi.NULLREF})
+        self.session.xenapi.VBD.plug(vbd_ref)
+        attached = self.session.xenapi.VBD.get_currently_attached(vbd_ref)
+        vbds = self.session.xenapi.VM.get_VBDs(vm_ref)
+        self.session.xenapi.VBD.destroy(vbd_ref)
+
+        self.assertTrue(attached)
+        self.assertEqual(vbds, [vbd_ref])
+        self.assertEqual(self.session.xenapi.VM.get_VBDs(vm_ref), [])
+
+    def test_event_from(self):
+        vm_ref = fake_xapi.create_vm(self.xapi, self.host_ref)
+
+        loaded = self.session.xenapi.event_from(['vm'], '', 0.0)
+        self.session.xenapi.VM.set_name_label(vm_ref, 'renamed')
+        changed = self.session.xenapi.event_from(['vm'], loaded['token'],
+                                                 1.0)
+        idle = self.session.xenapi.event_from(['vm'], changed['token'], 0.1)
+
+        self.assertEqual([(event['operation'], event['ref'])
+                          for event in loaded['events']], [('add', vm_ref)])
+        self.assertEqual(changed['events'][0]['snapshot']['name_label'],
+                         'renamed')
+        self.assertEqual(idle['events'], [])
+
+    def test_calls_are_counted(self):
+        vm_ref = fake_xapi.create_vm(self.xapi, self.host_ref)
+        written = []
+        self.xapi.add_listener(
+            lambda now, method, args: written.append((method, args[1:])))
+
+        self.session.xenapi.VM.get_record(vm_ref)
+        self.session.xenapi.VM.get_record(vm_ref)
+        self.session.xenapi.VM.set_name_label(vm_ref, 'renamed')
+        self.assertRaises(XenAPI.Failure, self.session.xenapi.VM.get_record,
+                          'OpaqueRef:missing')
+
+        calls = self.xapi.get_calls()
+        self.assertEqual(calls['VM.get_record'], 3)
+        self.assertEqual(calls['VM.set_name_label'], 1)
+        # Failed calls are counted, but not passed to listeners
+        self.assertEqual(written[-1],
+                         ('VM.set_name_label', (vm_ref, 'renamed')))
+        self.xapi.reset_calls()
+        self.assertEqual(self.xapi.get_calls(), {})
@@ -51,3 +51,348 @@ class TestLocalXenAPIClient(unittest.TestCase):
         client.get_session()
         # Make sure it get's the local session and doesn't cache it
         mget_local_api_session.assert_has_calls([call(), call()])
+
+
+@patch("xscontainer.util.probe_connections")
+@patch("xscontainer.api_helper.get_vm_ips")
+class TestGetSuitableVmIp(unittest.TestCase):
+
+    """
+    Test that the IP that worked is remembered until the VM's IPs change or
+    a connection fails.
+    """
+
+    def setUp(self):
+        api_helper.VM_IP_CACHE.invalidate('vm')
+
+    def test_prefer_host_internal_network(self, mget_vm_ips,
+                                          mprobe_connections):
+        mget_vm_ips.return_value = {'0/ip': '10.0.0.2',
+                                    '1/ip': '169.254.0.2',
+                                    '1/ipv6/0': 'fe80::1'}
+        mprobe_connections.return_value = (ip for ip in ['169.254.0.2'])
+
+        self.assertEqual(api_helper.get_suitable_vm_ip(None, 'vm', 22),
+                         '169.254.0.2')
+        mprobe_connections.assert_called_once_with(
+            ['169.254.0.2', '10.0.0.2'], 22)
+
+    def test_ip_is_cached(self, mget_vm_ips, mprobe_connections):
+        mget_vm_ips.return_value = {'0/ip': '10.0.0.2'}
+        mprobe_connections.side_effect = lambda ips, port: (
+            ip for ip in ips)
+
+        api_helper.get_suitable_vm_ip(None, 'vm', 22)
+        api_helper.get_suitable_vm_ip(None, 'vm', 22)
+        self.assertEqual(mprobe_connections.call_count, 1)
+
+        # A different port is probed separately
+        api_helper.get_suitable_vm_ip(None, 'vm', 2376)
+        self.assertEqual(mprobe_connections.call_count, 2)
+
+    def test_cache_invalidation(self, mget_vm_ips, mprobe_connections):
+        mget_vm_ips.return_value = {'0/ip': '10.0.0.2'}
+        mprobe_connections.side_effect = lambda ips, port: (
+            ip for ip in ips)
+
+        api_helper.get_suitable_vm_ip(None, 'vm', 22)
+        api_helper.forget_suitable_vm_ip('vm', 22)
+        api_helper.get_suitable_vm_ip(None, 'vm', 22)
+        self.assertEqual(mprobe_connections.call_count, 2)
+
+        # The guest metrics report a new IP
+        mget_vm_ips.return_value = {'0/ip': '10.0.0.3'}
+        self.assertEqual(api_helper.get_suitable_vm_ip(None, 'vm', 22),
+                         '10.0.0.3')
+        self.assertEqual(mprobe_connections.call_count, 3)
+
+    def test_no_ip_found(self, mget_vm_ips, mprobe_connections):
+        mget_vm_ips.return_value = {'0/ip': '10.0.0.2'}
+        mprobe_connections.return_value = (ip for ip in [])
+
+        self.assertRaises(api_helper.util.XSContainerException,
+                          api_helper.get_suitable_vm_ip, None, 'vm', 22)
+
+
+class TestUpdateOtherConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.thevm = api_helper.VM(MagicMock(), ref='ref', uuid='vm')
+        self.thevm.api_call = MagicMock()
+
+    def test_only_the_key_is_written(self):
+        self.thevm.update_other_config('docker_ps', '<ps/>')
+        self.assertEqual(self.thevm.api_call.call_args_list,
+                         [call("remove_from_other_config", 'docker_ps'),
+                          call("add_to_other_config", 'docker_ps', '<ps/>')])
+
+    def test_unchanged_value_is_skipped(self):
+        self.assertTrue(self.thevm.update_other_config_if_changed(
+            'docker_ps', '<ps/>'))
+        self.assertFalse(self.thevm.update_other_config_if_changed(
+            'docker_ps', '<ps/>'))
+        self.assertTrue(self.thevm.update_other_config_if_changed(
+            'docker_info', '<ps/>'))
+        self.assertTrue(self.thevm.update_other_config_if_changed(
+            'docker_ps', '<ps><a/></ps>'))
+        self.assertEqual(self.thevm.other_config_writes, 3)
+        self.assertEqual(self.thevm.other_config_writes_skipped, 1)
+
+    def test_removed_value_is_written_again(self):
+        self.thevm.update_other_config_if_changed('docker_ps', '<ps/>')
+        self.thevm.remove_from_other_config('docker_ps')
+        self.assertTrue(self.thevm.update_other_config_if_changed(
+            'docker_ps', '<ps/>'))
+
+    def test_failed_write_is_retried(self):
+        self.thevm.api_call.side_effect = [None, Exception("Failed"),
+                                           None, None]
+        self.assertRaises(Exception,
+                          self.thevm.update_other_config_if_changed,
+                          'docker_ps', '<ps/>')
+        self.assertTrue(self.thevm.update_other_config_if_changed(
+            'docker_ps', '<ps/>'))
+
+    def test_written_by_others(self):
+        digest = api_helper.get_digest('<ps/>')
+        self.assertFalse(self.thevm.is_written_by_others('docker_ps', digest))
+
+        self.thevm.update_other_config_if_changed('docker_ps', '<ps/>')
+        self.thevm.update_other_config_if_changed('docker_ps', '<ps><a/></ps>')
+
+        self.assertFalse(self.thevm.is_written_by_others('docker_ps', digest))
+        self.assertTrue(self.thevm.is_written_by_others(
+            'docker_ps', api_helper.get_digest('<ps><b/></ps>')))
+
+    def test_digests_are_adopted_if_unchanged(self):
+        self.thevm.update_other_config_if_changed('docker_ps', '<ps/>')
+        self.thevm.update_other_config_if_changed('docker_info', '<info/>')
+        digests = self.thevm.get_written_digests()
+
+        restarted = api_helper.VM(MagicMock(), ref='ref', uuid='vm')
+        restarted.api_call = MagicMock()
+        self.assertEqual(restarted.adopt_written_digests(
+            digests, {'docker_ps': '<ps/>', 'docker_info': '<other/>'}),
+            ['docker_ps'])
+        self.assertFalse(restarted.update_other_config_if_changed(
+            'docker_ps', '<ps/>'))
+        self.assertTrue(restarted.update_other_config_if_changed(
+            'docker_info', '<info/>'))
+
+
+class TestVmIpCache(unittest.TestCase):
+
+    def test_state(self):
+        cache = api_helper.VmIpCache()
+        cache.remember('vm', 22, '10.0.0.2', ['10.0.0.2', '10.0.0.3'])
+
+        restarted = api_helper.VmIpCache()
+        restarted.load_state(cache.get_state())
+
+        self.assertEqual(restarted.get('vm', 22, ['10.0.0.2', '10.0.0.3']),
+                         '10.0.0.2')
+        self.assertEqual(restarted.get('vm', 22, ['10.0.0.3']), None)
+
+
+class TestRecordCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = api_helper.RecordCache()
+        self.session = MagicMock()
+        self.record = {'uuid': 'vm', 'other_config': {'key': 'value'}}
+        self.session.xenapi.VM.get_by_uuid.return_value = 'ref'
+        self.session.xenapi.VM.get_record.return_value = self.record
+
+    def _load(self, records):
+        self.session.xenapi.event_from.return_value = {
+            'token': '1', 'events': [
+                {'class': 'vm', 'operation': 'add', 'ref': ref,
+                 'snapshot': record} for ref, record in records.items()]}
+        return self.cache.load(self.session)
+
+    def test_without_opting_in_xapi_is_asked(self):
+        self.session.xenapi.VM.get_other_config.return_value = {}
+
+        self.cache.get_record(self.session, 'VM', 'ref')
+        self.cache.get_record(self.session, 'VM', 'ref')
+        self.cache.get_field(self.session, 'VM', 'ref', 'other_config')
+
+        self.assertEqual(self.session.xenapi.VM.get_record.call_count, 2)
+        self.session.xenapi.VM.get_other_config.assert_called_once_with(
+            'ref')
+
+    def test_ttl(self):
+        self.cache.set_ttl(5)
+
+        self.assertEqual(self.cache.get_field(self.session, 'VM', 'ref',
+                                              'other_config'),
+                         {'key': 'value'})
+        self.assertEqual(self.cache.get_ref(self.session, 'VM', 'vm'), 'ref')
+        self.cache.get_record(self.session, 'VM', 'ref')['uuid'] = 'changed'
+        self.assertEqual(
+            self.cache.get_record(self.session, 'VM', 'ref')['uuid'], 'vm')
+        self.cache.invalidate('VM', 'ref')
+        self.cache.get_record(self.session, 'VM', 'ref')
+
+        self.assertEqual(self.session.xenapi.VM.get_record.call_count, 2)
+        self.assertFalse(self.session.xenapi.VM.get_by_uuid.called)
+
+    def test_writes_do_not_change_returned_records(self):
+        self.cache.set_ttl(5)
+
+        fetched = self.cache.get_record(self.session, 'VM', 'ref')
+        cached = self.cache.get_field(self.session, 'VM', 'ref',
+                                      'other_config')
+        self.cache.update_map('VM', 'ref', 'other_config', 'added', 'value')
+
+        self.assertEqual(fetched['other_config'], {'key': 'value'})
+        self.assertEqual(cached, {'key': 'value'})
+        self.assertEqual(self.record['other_config'], {'key': 'value'})
+        self.assertEqual(
+            self.cache.get_field(self.session, 'VM', 'ref', 'other_config'),
+            {'key': 'value', 'added': 'value'})
+
+    @patch("xscontainer.api_helper.time.time")
+    def test_ttl_expires(self, mtime):
+        self.cache.set_ttl(5)
+        mtime.return_value = 100
+        self.cache.get_record(self.session, 'VM', 'ref')
+        mtime.return_value = 106
+        self.cache.get_record(self.session, 'VM', 'ref')
+
+        self.assertEqual(self.session.xenapi.VM.get_record.call_count, 2)
+
+    def test_replica_follows_events(self):
+        self.assertEqual(self._load({'ref': self.record}), '1')
+        self.assertEqual(self.cache.get_ref(self.session, 'VM', 'vm'), 'ref')
+
+        self.cache.apply_events([
+            {'class': 'vm', 'operation': 'mod', 'ref': 'ref',
+             'snapshot': {'uuid': 'vm', 'other_config': {}}},
+            {'class': 'vm', 'operation': 'add', 'ref': 'new',
+             'snapshot': {'uuid': 'new', 'other_config': {}}},
+            {'class': 'vm', 'operation': 'del', 'ref': 'new'}])
+
+        self.assertEqual(self.cache.get_field(self.session, 'VM', 'ref',
+                                              'other_config'), {})
+        self.assertEqual(self.cache.lookup_ref('VM', 'new'), None)
+        self.assertFalse(self.session.xenapi.VM.get_record.called)
+
+    def test_writes_do_not_change_event_snapshots(self):
+        self._load({'ref': self.record})
+        snapshot = {'uuid': 'vm', 'other_config': {'a': '1', 'b': '2'}}
+        self.cache.apply_events([{'class': 'vm', 'operation': 'mod',
+                                  'ref': 'ref', 'snapshot': snapshot}])
+
+        for key in snapshot['other_config']:
+            self.cache.update_map('VM', 'ref', 'other_config', key + '2',
+                                  'value')
+            self.cache.update_map('VM', 'ref', 'other_config', 'a')
+
+        self.assertEqual(snapshot['other_config'], {'a': '1', 'b': '2'})
+        self.assertEqual(
+            self.cache.get_field(self.session, 'VM', 'ref', 'other_config'),
+            {'b': '2', 'a2': 'value', 'b2': 'value'})
+
+    def test_writes_are_applied(self):
+        self._load({'ref': self.record})
+        thevm = api_helper.VM(MagicMock(), ref='ref')
+        thevm.api_call = MagicMock()
+
+        with patch("xscontainer.api_helper.RECORD_CACHE", self.cache):
+            thevm.update_other_config('docker_ps', '<ps/>')
+            thevm.remove_from_other_config('key')
+
+        self.assertEqual(self.cache.get_field(self.session, 'VM', 'ref',
+                                              'other_config'),
+                         {'docker_ps': '<ps/>'})
+
+    def test_invalidated_record_is_fetched_again(self):
+        self._load({'ref': self.record})
+        self.cache.invalidate('VM', 'ref')
+
+        self.cache.get_record(self.session, 'VM', 'ref')
+        self.cache.get_record(self.session, 'VM', 'ref')
+
+        self.assertEqual(self.session.xenapi.VM.get_record.call_count, 1)
+        self.assertEqual(self.cache.lookup_ref('VM', 'vm'), 'ref')
+
+    def test_replica_only_loads_the_pool(self):
+        self.session.xenapi.event_from.return_value = {
+            'token': '1', 'events': [
+                {'class': 'pool', 'operation': 'add', 'ref': 'pool',
+                 'snapshot': {'uuid': 'pool', 'other_config': {}}}]}
+        self.cache.load(self.session)
+
+        self.session.xenapi.event_from.assert_called_once_with(
+            api_helper.RECORD_CACHE_LOAD_CLASSES, '', 0.0)
+        self.assertEqual(self.cache.get_all_records(self.session, 'pool'),
+                         {'pool': {'uuid': 'pool', 'other_config': {}}})
+        self.cache.get_record(self.session, 'VM', 'ref')
+        self.cache.get_record(self.session, 'VM', 'ref')
+        self.assertFalse(self.session.xenapi.pool.get_all_records.called)
+        self.assertEqual(self.session.xenapi.VM.get_record.call_count, 1)
+
+    def test_replica_keeps_events_newer_than_a_fetch(self):
+        self._load({})
+        changed = {'uuid': 'vm', 'other_config': {'key': 'changed'}}
+
+        def get_record(ref):
+            # An event arrives while the record is fetched
+            self.cache.apply_events([{'class': 'vm', 'operation': 'mod',
+                                      'ref': ref, 'snapshot': changed}])
+            return self.record
+        self.session.xenapi.VM.get_record.side_effect = get_record
+
+        self.assertEqual(self.cache.get_record(self.session, 'VM', 'ref'),
+                         self.record)
+        self.assertEqual(self.cache.get_record(self.session, 'VM', 'ref'),
+                         changed)
+        self.assertEqual(self.session.xenapi.VM.get_record.call_count, 1)
+
+    def test_all_records_of_a_replica(self):
+        self._load({})
+        self.session.xenapi.network.get_all_records.return_value = {
+            'net': {'uuid': 'net', 'bridge': 'xenapi'}}
+
+        with patch("xscontainer.api_helper.RECORD_CACHE", self.cache):
+            self.assertEqual(api_helper.get_hi_mgmtnet_ref(self.session),
+                             'net')
+            self.assertEqual(api_helper.get_hi_mgmtnet_ref(self.session),
+                             'net')
+        self.session.xenapi.network.get_all_records.assert_called_once_with()
+        self.cache.clear()
+        self.session.xenapi.network.get_all_records.return_value = {}
+        self.assertEqual(self.cache.get_all_records(self.session, 'network'),
+                         {})
+
+
+class TestPluginRedirect(unittest.TestCase):
+
+    @patch("xscontainer.api_helper.get_vm_record_by_uuid")
+    def test_vm_calls_go_to_its_host(self, mget_vm_record_by_uuid):
+        mget_vm_record_by_uuid.return_value = {'resident_on': 'other-host'}
+
+        # e.g. get_stats, which only the host running the VM can answer
+        self.assertEqual(
+            api_helper.get_host_ref_for_plugin_args(MagicMock(),
+                                                    {'vmuuid': 'vm'}),
+            ('other-host', 'vmuuid vm'))
+
+    @patch("xscontainer.api_helper.get_vm_record_by_uuid")
+    def test_halted_vm_calls_stay(self, mget_vm_record_by_uuid):
+        mget_vm_record_by_uuid.return_value = {
+            'resident_on': api_helper.NULLREF}
+
+        self.assertEqual(
+            api_helper.get_host_ref_for_plugin_args(MagicMock(),
+                                                    {'vmuuid': 'vm'}),
+            (None, None))
+
+    @patch("xscontainer.api_helper.get_host_ref_for_sr_uuid",
+           return_value='sr-host')
+    def test_sr_calls_go_to_a_host_with_access(self, _):
+        self.assertEqual(
+            api_helper.get_host_ref_for_plugin_args(MagicMock(),
+                                                    {'sruuid': 'sr'}),
+            ('sr-host', 'sruuid sr'))
@@ -1,4 +1,8 @@
+import json
 import unittest
+import urllib
+from mock import MagicMock, patch
+
 from xscontainer import docker
 
 
@@ -13,3 +17,63 @@ class TestPatchPsStatus(unittest.TestCase):
         test_dict = {"Status": "exit 0"}
         docker.patch_docker_ps_status(test_dict)
         self.assertEqual(test_dict["Status"], "exit 0")
+
+
+class TestGetEventsPath(unittest.TestCase):
+
+    def test_no_filters_without_version(self):
+        self.assertEqual(docker.get_events_path(), '/events')
+        self.assertEqual(docker.get_events_path({'ApiVersion': 'x'}),
+                         '/events')
+        self.assertEqual(docker.get_events_path({'ApiVersion': '1.15'}),
+                         '/events')
+
+    def _get_filters(self, api_version):
+        path = docker.get_events_path({'ApiVersion': api_version})
+        self.assertTrue(path.startswith('/events?filters='))
+        return json.loads(urllib.unquote(path.split('=', 1)[1]))
+
+    def test_event_filter(self):
+        filters = self._get_filters('1.18')
+        self.assertEqual(filters, {'event': docker.PS_EVENTS +
+                                   docker.INFO_EVENTS})
+
+    def test_type_filter(self):
+        filters = self._get_filters('1.24')
+        self.assertEqual(filters['type'], ['container', 'image'])
+        self.assertTrue('exec_start' not in filters['event'])
+
+
+class TestGetPsDict(unittest.TestCase):
+
+    @patch("xscontainer.docker._get_api_json_array")
+    def test_single_container(self, get_api_json_array):
+        get_api_json_array.return_value = [
+            {"Id": "8dfafdbc3a40aaaa", "Names": ["/web"], "Status": "Up"},
+            {"Id": "8dfafdbc3a40aaaabbbb", "Names": ["/db"], "Status": "Up"}]
+
+        result = docker.get_ps_dict(MagicMock(), 'vm', '8dfafdbc3a40aaaa')
+
+        self.assertEqual([entry['entry']['names'] for entry in result],
+                         ['web'])
+        request = get_api_json_array.call_args[0][2]
+        self.assertEqual(json.loads(urllib.unquote(request.split(
+            '&filters=')[1])), {'id': ['8dfafdbc3a40aaaa']})
+
+    @patch("xscontainer.remote_helper.execute_docker")
+    def test_containers_are_decoded_while_streaming(self, execute_docker):
+        body = json.dumps([{"Id": "8dfafdbc3a40aaaa", "Names": ["/web"],
+                            "Status": "Up 3 hours"}])
+
+        def _execute_docker(session, vmuuid, method, path, body_sink):
+            for index in range(0, len(body), 5):
+                body_sink(body[index:index + 5])
+            return MagicMock(status=200)
+        execute_docker.side_effect = _execute_docker
+
+        result = docker.get_ps_dict(MagicMock(), 'vm')
+
+        self.assertEqual(result, [{'entry': {'id': '8dfafdbc3a40aaaa',
+                                             'names': 'web',
+                                             'status': 'Up',
+                                             'container': '8dfafdbc3a'}}])
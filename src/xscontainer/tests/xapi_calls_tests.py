@@ -0,0 +1,231 @@
+"""
+Counts the XAPI calls of common operations against a fake XAPI and a
+simulated Docker daemon, and fails when an operation takes more calls than
+its budget in CALL_BUDGETS. Each call is a round trip to the pool master,
+which every VM and every plugin invocation pays for.
+
+When a change saves calls, lower the budget to the new count, so that the
+saving can't be lost again unnoticed.
+"""
+from xscontainer import api_helper
+from xscontainer import coreos
+from xscontainer import docker
+from xscontainer import docker_monitor
+from xscontainer.remote_helper import connection_profile
+from xscontainer.remote_helper import http_client
+from xscontainer.remote_helper import tls
+from xscontainer.testing import docker_simulator
+from xscontainer.testing import fake_xapi
+from xscontainer.util import metrics
+from xscontainer.util import tls_secret
+
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from mock import patch
+
+# CALL_BUDGETS[scenario] = the most XAPI calls that the scenario may take
+CALL_BUDGETS = {
+    # What the plugin does to start, stop or inspect a container, including
+    # the lookups that decide whether to redirect it to another host
+    'plugin_start': 5,
+    'plugin_stop': 5,
+    'plugin_inspect': 5,
+    # Loading and connecting to a VM, until docker_ps has been written and
+    # the event stream is open
+    'monitor_connect': 14,
+    # Reconnecting after the connection to Docker dropped
+    'monitor_reconnect': 11,
+    'create_config_drive': 25,
+}
+# The monitor follows the events of the whole host, which isn't a cost of
+# an operation
+UNCOUNTED_CALLS = ['event_from']
+WAIT_TIMEOUT_S = 20
+# Lets calls that are under way when a scenario completes be counted
+SETTLE_S = 0.2
+VM_ADDRESS = docker_simulator.get_vm_address(0)
+SSH_PUBLIC_KEY = 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQC0 xscontainer'
+
+
+class TestXapiCalls(unittest.TestCase):
+
+    def setUp(self):
+        self.xapi = fake_xapi.FakeXapi()
+        self.host_ref = fake_xapi.create_pool(self.xapi)
+        other_config = {api_helper.XSCONTAINER_MODE: 'tls'}
+        other_config.update(fake_xapi.create_tls_secrets(
+            self.xapi, docker_simulator.CERT_DIR))
+        self.vm_ref = fake_xapi.create_vm(self.xapi, self.host_ref,
+                                          other_config, [VM_ADDRESS])
+        self.vm_uuid = self.xapi.get_record('VM', self.vm_ref)['uuid']
+        self.server = fake_xapi.FakeXapiServer(self.xapi)
+        self.server.start()
+        self.session = fake_xapi.get_session(self.server.get_url())
+        self.simulator = docker_simulator.DockerSimulator(
+            docker_simulator.CERT_DIR, bind=VM_ADDRESS)
+        self.docker = self.simulator.add_vm(VM_ADDRESS, containers=2)
+        self.simulator.start()
+        self.tempdir = tempfile.mkdtemp()
+        for target, attribute, value in [
+                (tls, 'DOCKER_TLS_PORT', self.simulator.get_port()),
+                (tls_secret, 'TEMP_FILE_PATH', self.tempdir),
+                (docker_monitor, 'MONITORRETRYSLEEPINS', 0.1),
+                (api_helper, 'RECORD_CACHE', api_helper.RecordCache())]:
+            patcher = patch.object(target, attribute, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.monitor = None
+        self._following = None
+        self._forget_vm()
+
+    def tearDown(self):
+        if self.monitor:
+            self.monitor.tear_down_all()
+        if self._following:
+            self._following.set()
+            self._follower.join()
+        self._forget_vm()
+        self.session.xenapi.session.logout()
+        self.session.transport.close()
+        self.simulator.stop()
+        self.server.stop()
+        shutil.rmtree(self.tempdir)
+
+    def _forget_vm(self):
+        """ Like a new plugin process, which has nothing cached yet """
+        tls.TLS_CONTEXT_CACHE.invalidate(self.vm_uuid)
+        connection_profile.CONNECTION_PROFILE_CACHE.invalidate(self.vm_uuid)
+        api_helper.VM_IP_CACHE.invalidate(self.vm_uuid)
+        http_client.DOCKER_CONNECTION_POOL.invalidate(self.vm_uuid)
+
+    def _assert_within_budget(self, scenario):
+        calls = dict((method, count) for (method, count)
+                     in self.xapi.get_calls().iteritems()
+                     if method not in UNCOUNTED_CALLS)
+        count = sum(calls.values())
+        self.assertTrue(
+            count <= CALL_BUDGETS[scenario],
+            "%s took %d XAPI calls, but its budget is %d: %s"
+            % (scenario, count, CALL_BUDGETS[scenario],
+               ", ".join("%s %d" % (method, calls[method])
+                         for method in sorted(calls))))
+
+    def _wait_for(self, check):
+        deadline = time.time() + WAIT_TIMEOUT_S
+        while not check():
+            if time.time() > deadline:
+                self.fail("Timed out")
+            time.sleep(0.01)
+        time.sleep(SETTLE_S)
+
+    def _is_connected(self):
+        other_config = self.xapi.get_record('VM', self.vm_ref)['other_config']
+        return ('docker_ps' in other_config and
+                self.docker.get_stream_count() == 1)
+
+    def _get_connects(self):
+        return metrics.METRICS.get_value('xscontainer_monitor_connects_total',
+                                         vm=self.vm_uuid)
+
+    def _run_plugin_call(self, function, *args):
+        """ Does what the plugin does for a call about a VM """
+        api_helper.RECORD_CACHE.set_ttl(api_helper.PLUGIN_RECORD_CACHE_TTL_S)
+        with patch('xscontainer.api_helper.get_this_host_uuid',
+                   return_value=self.xapi.get_record('host',
+                                                     self.host_ref)['uuid']):
+            self.xapi.reset_calls()
+            api_helper.get_host_ref_for_vm_uuid(self.session, self.vm_uuid)
+            api_helper.get_this_host_ref(self.session)
+            return function(self.session, self.vm_uuid, *args)
+
+    def test_plugin_start(self):
+        container_id = self.docker.get_container_ids()[0]
+        self.docker.toggle_container(container_id)
+
+        self._run_plugin_call(docker.start, container_id)
+
+        self._assert_within_budget('plugin_start')
+
+    def test_plugin_stop(self):
+        self._run_plugin_call(docker.stop, self.docker.get_container_ids()[0])
+
+        self._assert_within_budget('plugin_stop')
+
+    def test_plugin_inspect(self):
+        xml = self._run_plugin_call(docker.get_inspect_xml,
+                                    self.docker.get_container_ids()[0])
+
+        self.assertTrue('<docker_inspect>' in xml)
+        self._assert_within_budget('plugin_inspect')
+
+    def _follow_events(self, token):
+        """ What monitor_host does to keep the records current """
+        while not self._following.is_set():
+            result = self.session.xenapi.event_from(
+                api_helper.RECORD_CACHE_CLASSES, token, SETTLE_S)
+            token = result['token']
+            api_helper.RECORD_CACHE.apply_events(result['events'])
+
+    def _start_monitor(self):
+        self.xapi.update('VM', self.vm_ref, other_config=dict(
+            self.xapi.get_record('VM', self.vm_ref)['other_config'],
+            **{docker_monitor.REGISTRATION_KEY:
+               docker_monitor.REGISTRATION_KEY_ON}))
+        self.xapi.reset_calls()
+        self._following = threading.Event()
+        self._follower = threading.Thread(
+            target=self._follow_events,
+            args=(api_helper.RECORD_CACHE.load(self.session),))
+        self._follower.start()
+        client = api_helper.XenAPIClient(self.session)
+        self.monitor = docker_monitor.DockerMonitor(
+            api_helper.Host(client, self.host_ref), 'threaded', 0)
+        self.monitor.refresh()
+        self._wait_for(self._is_connected)
+
+    def test_monitor_connect(self):
+        self._start_monitor()
+
+        self._assert_within_budget('monitor_connect')
+
+    def test_monitor_reconnect(self):
+        self._start_monitor()
+        connects = self._get_connects()
+        self.xapi.reset_calls()
+
+        self.docker.disconnect()
+        self._wait_for(lambda: (self._get_connects() > connects and
+                                self._is_connected()))
+
+        self._assert_within_budget('monitor_reconnect')
+
+    @patch('xscontainer.util.runlocal', return_value=(0, '', ''))
+    @patch('xscontainer.util.make_iso')
+    @patch('xscontainer.coreos.shutil.copy')
+    @patch('xscontainer.coreos.find_latest_tools_iso_path',
+           return_value='/tools.iso')
+    def test_create_config_drive(self, *_):
+        pool_ref = self.session.xenapi.pool.get_all()[0]
+        secrets = {}
+        for key, value in [
+                (api_helper.XSCONTAINER_PRIVATE_SECRET_UUID, 'private'),
+                (api_helper.XSCONTAINER_PUBLIC_SECRET_UUID, SSH_PUBLIC_KEY)]:
+            secret_ref = self.xapi.create('secret', {'value': value})
+            secrets[key] = self.xapi.get_record('secret', secret_ref)['uuid']
+        secrets['xscontainer-use-hostinternalnetwork'] = 'true'
+        self.xapi.update('pool', pool_ref, other_config=secrets)
+        self.xapi.create('network', {'bridge': 'xenapi', 'other_config': {}})
+        sr_uuid = self.xapi.get_record(
+            'SR', self.xapi.create('SR', {'name_label': 'sr'}))['uuid']
+        self.xapi.reset_calls()
+        api_helper.RECORD_CACHE.set_ttl(api_helper.PLUGIN_RECORD_CACHE_TTL_S)
+
+        coreos.create_config_drive(self.session, self.vm_uuid, sr_uuid,
+                                   coreos.load_cloud_config_template())
+
+        self.assertEqual(len(self.xapi.get_record('VM', self.vm_ref)['VBDs']),
+                         1)
+        self._assert_within_budget('create_config_drive')
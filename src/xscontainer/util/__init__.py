@@ -1,9 +1,13 @@
 import log
 
+import errno
+import multiprocessing.util
 import os
+import select
 import socket
 import subprocess
 import tempfile
+import threading
 import time
 import xml.dom.minidom
 import xml.sax.saxutils
@@ -17,6 +21,14 @@ class XSContainerException(Exception):
         pass
 
 
+def recreate_lock_after_fork(instance):
+    """ Gives instance a new _lock in the processes that multiprocessing
+        forks, as another thread may have held the lock at fork time """
+    multiprocessing.util.register_after_fork(
+        instance, lambda instance: setattr(instance, '_lock',
+                                           threading.Lock()))
+
+
 def runlocal(cmd, shell=False, canfail=False):
     log.debug('Running: %s' % (cmd))
     process = subprocess.Popen(cmd,
@@ -127,6 +139,48 @@ def test_connection(address, port):
         return False
 
 
+def probe_connections(addresses, port, timeout=2):
+    """
+    Connects to all addresses at the same time and yields each address as
+    soon as its connection succeeded. Gives up on the others after timeout
+    seconds.
+    """
+    pending = {}
+    try:
+        for address in addresses:
+            asocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            asocket.setblocking(0)
+            returncode = asocket.connect_ex((address, port))
+            if returncode in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                pending[asocket] = address
+            else:
+                asocket.close()
+        deadline = time.time() + timeout
+        while pending:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                _, writable, _ = select.select([], pending.keys(), [],
+                                               remaining)
+            except select.error as exception:
+                if exception.args[0] == errno.EINTR:
+                    continue
+                raise
+            # Keep the order of addresses for those that succeeded at once
+            writable.sort(key=lambda asocket: addresses.index(
+                pending[asocket]))
+            for asocket in writable:
+                address = pending.pop(asocket)
+                error = asocket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                asocket.close()
+                if error == 0:
+                    yield address
+    finally:
+        for asocket in pending.keys():
+            asocket.close()
+
+
 def make_iso(label, sourcedirectory, targetiso):
     cmd = ['mkisofs', '-R', '-J', '-V', label,
            '-o', targetiso, sourcedirectory]
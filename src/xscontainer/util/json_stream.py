@@ -0,0 +1,103 @@
+"""
+Incremental decoding of JSON values that arrive in pieces, e.g. from the
+Docker API. Only the not yet decoded tail is kept in memory.
+"""
+from xscontainer import util
+
+import json
+
+WHITESPACE = ' \t\r\n'
+# Closing characters of values that can't continue with the next piece
+COMPLETE_ENDINGS = '}]"'
+
+
+class JsonStreamException(util.XSContainerException):
+    pass
+
+
+class JsonStreamDecoder(object):
+
+    """
+    Decodes a stream of concatenated JSON values (as in Docker's event
+    stream), or with array=True the elements of one top level JSON array
+    (as in /containers/json). Call feed() with every piece of data - it
+    returns the values that have been completed - and close() at the end.
+    """
+
+    def __init__(self, array=False, max_value_size=16 * 1024 * 1024):
+        self._decoder = json.JSONDecoder()
+        self._array = array
+        self._max_value_size = max_value_size
+        self._buffer = ''
+        # For arrays: 'start', 'first', 'value', 'next' or 'end'
+        self._state = 'start'
+
+    def feed(self, data):
+        values = []
+        if self._buffer:
+            data = self._buffer + data
+        length = len(data)
+        position = 0
+        while True:
+            while position < length and data[position] in WHITESPACE:
+                position = position + 1
+            if position == length:
+                break
+            if self._array and self._handle_delimiter(data[position]):
+                position = position + 1
+                continue
+            try:
+                value, end = self._decoder.raw_decode(data, position)
+            except ValueError:
+                # Incomplete - wait for more data
+                break
+            if end == length and data[end - 1] not in COMPLETE_ENDINGS:
+                # A number or literal may continue in the next piece
+                break
+            values.append(value)
+            position = end
+            self._state = 'next'
+        self._buffer = data[position:]
+        if len(self._buffer) > self._max_value_size:
+            raise JsonStreamException("JSON value exceeds %d bytes"
+                                      % (self._max_value_size))
+        return values
+
+    def _handle_delimiter(self, character):
+        """ Returns True, if character was an array delimiter """
+        if self._state == 'start':
+            if character != '[':
+                raise JsonStreamException("Expected a JSON array")
+            self._state = 'first'
+            return True
+        elif self._state == 'end':
+            raise JsonStreamException("Unexpected data after JSON array")
+        elif character == ']' and self._state in ('first', 'next'):
+            self._state = 'end'
+            return True
+        elif self._state == 'next':
+            if character != ',':
+                raise JsonStreamException("Expected ',' in JSON array")
+            self._state = 'value'
+            return True
+        return False
+
+    def close(self):
+        """ Returns the last values and raises if the data was truncated """
+        values = []
+        remainder = self._buffer.strip()
+        self._buffer = ''
+        if remainder:
+            if self._array and self._state not in ('first', 'value'):
+                raise JsonStreamException("Unexpected data in JSON array")
+            try:
+                value, end = self._decoder.raw_decode(remainder)
+            except ValueError:
+                raise JsonStreamException("Truncated JSON data")
+            if end != len(remainder):
+                raise JsonStreamException("Unexpected data after JSON value")
+            values.append(value)
+            self._state = 'next'
+        if self._array and self._state != 'end':
+            raise JsonStreamException("Truncated JSON array")
+        return values
@@ -1,8 +1,10 @@
 import logging
 import logging.handlers
+import multiprocessing.util
 import os
 import signal
 import sys
+import threading
 import traceback
 
 ENABLE_DEV_LOGGING_FILE = ("/opt/xensource/packages/files/xscontainer/"
@@ -40,6 +42,14 @@ def configurelogging():
     signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
 
+def _recreate_locks(logger):
+    """ Another thread may have held a logging lock when multiprocessing
+        forked this process """
+    logging._lock = threading.RLock()
+    for handler in logger.handlers:
+        handler.createLock()
+
+
 def debug(message):
     _LOGGER.debug(message)
 
@@ -84,4 +94,5 @@ def handle_unhandled_exceptions(exception_type, exception_value,
 
 _LOGGER = logging.getLogger()
 configurelogging()
+multiprocessing.util.register_after_fork(_LOGGER, _recreate_locks)
 sys.excepthook = handle_unhandled_exceptions
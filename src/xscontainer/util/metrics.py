@@ -0,0 +1,343 @@
+"""
+Counters, gauges and latency histograms of the monitor, labelled e.g. by
+VM. The monitor writes them in the Prometheus text format to a file under
+/var/run, which the get_stats call of the XAPI plugin returns.
+"""
+from xscontainer import util
+from xscontainer.util import log
+
+import errno
+import glob
+import os
+import threading
+import time
+
+METRICS_PATH = '/var/run/xscontainer-monitor.prom'
+EXPORT_INTERVAL_S = 30
+# A file that hasn't been written for this long is left over by a process
+# that died, and isn't read anymore
+STALE_AFTER_S = 3 * EXPORT_INTERVAL_S
+# Upper bounds of the histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+# Stored as a timestamp and reported as the seconds since then
+AGE = 'age'
+
+
+def _get_labels_key(labels):
+    return tuple(sorted(labels.iteritems()))
+
+
+def _format_labels(labels_key, extra=()):
+    labels = list(labels_key) + list(extra)
+    if not labels:
+        return ''
+    return '{%s}' % (','.join('%s="%s"' % (name, str(value).replace(
+        '\\', '\\\\').replace('"', '\\"')) for (name, value) in labels))
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] = self.counts[index] + 1
+                break
+        self.count = self.count + 1
+        self.sum = self.sum + value
+
+
+class MetricsRegistry(object):
+
+    """Keeps the metrics of this process. All methods are thread-safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        util.recreate_lock_after_fork(self)
+        # _metrics[name] = (kind, {labels key: value or Histogram})
+        self._metrics = {}
+        # Functions that return [(name, kind, labels, value), ...] when
+        # rendering, for values that are kept elsewhere
+        self._collectors = []
+
+    def inc(self, name, labels, amount=1):
+        self._update(name, COUNTER, labels,
+                     lambda value: (value or 0) + amount)
+
+    def set(self, name, labels, value):
+        self._update(name, GAUGE, labels, lambda _: value)
+
+    def touch(self, name, labels):
+        now = time.time()
+        self._update(name, AGE, labels, lambda _: now)
+
+    def observe(self, name, labels, value):
+        def add(histogram):
+            if histogram is None:
+                histogram = Histogram()
+            histogram.observe(value)
+            return histogram
+        self._update(name, HISTOGRAM, labels, add)
+
+    def add_collector(self, collector):
+        self._lock.acquire()
+        try:
+            self._collectors.append(collector)
+        finally:
+            self._lock.release()
+
+    def remove(self, **labels):
+        """ Drops the series that have all of labels, e.g. of a VM that
+            isn't monitored anymore """
+        match = set(labels.iteritems())
+        self._lock.acquire()
+        try:
+            for _, series in self._metrics.itervalues():
+                for labels_key in series.keys():
+                    if match.issubset(labels_key):
+                        del series[labels_key]
+        finally:
+            self._lock.release()
+
+    def get_value(self, name, **labels):
+        """ Returns the value of a counter or gauge, or the Histogram """
+        self._lock.acquire()
+        try:
+            if name not in self._metrics:
+                return None
+            return self._metrics[name][1].get(_get_labels_key(labels))
+        finally:
+            self._lock.release()
+
+    def render(self, host_labels=None):
+        """ Returns the metrics in the Prometheus text format. host_labels
+            are added to the series that aren't labelled by VM, to tell
+            apart those of several processes. """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            metrics = {}
+            for name, (kind, series) in self._metrics.iteritems():
+                metrics[name] = (kind, series.items())
+            collectors = list(self._collectors)
+        finally:
+            self._lock.release()
+        for collector in collectors:
+            try:
+                for name, kind, labels, value in collector():
+                    metrics.setdefault(name, (kind, []))[1].append(
+                        (_get_labels_key(labels), value))
+            except Exception:
+                log.exception("Failed to collect metrics")
+        if host_labels:
+            for _, series in metrics.itervalues():
+                for index, (labels_key, value) in enumerate(series):
+                    if 'vm' not in dict(labels_key):
+                        labels = dict(host_labels)
+                        labels.update(labels_key)
+                        series[index] = (_get_labels_key(labels), value)
+        lines = []
+        for name in sorted(metrics.keys()):
+            kind, series = metrics[name]
+            if kind == AGE:
+                lines.append("# TYPE %s gauge" % (name))
+            else:
+                lines.append("# TYPE %s %s" % (name, kind))
+            for labels_key, value in sorted(series):
+                if kind == HISTOGRAM:
+                    lines.extend(self._render_histogram(name, labels_key,
+                                                        value))
+                elif kind == AGE:
+                    lines.append("%s%s %.3f" % (name,
+                                                _format_labels(labels_key),
+                                                now - value))
+                else:
+                    lines.append("%s%s %s" % (name,
+                                              _format_labels(labels_key),
+                                              value))
+        return "\n".join(lines) + "\n"
+
+    def _render_histogram(self, name, labels_key, histogram):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative = cumulative + count
+            lines.append("%s_bucket%s %d"
+                         % (name, _format_labels(labels_key,
+                                                 [('le', bound)]),
+                            cumulative))
+        lines.append("%s_bucket%s %d"
+                     % (name, _format_labels(labels_key, [('le', '+Inf')]),
+                        histogram.count))
+        lines.append("%s_sum%s %.6f"
+                     % (name, _format_labels(labels_key), histogram.sum))
+        lines.append("%s_count%s %d"
+                     % (name, _format_labels(labels_key), histogram.count))
+        return lines
+
+    def _update(self, name, kind, labels, function):
+        labels_key = _get_labels_key(labels)
+        self._lock.acquire()
+        try:
+            series = self._metrics.setdefault(name, (kind, {}))[1]
+            series[labels_key] = function(series.get(labels_key))
+        finally:
+            self._lock.release()
+
+
+METRICS = MetricsRegistry()
+
+
+class Timer(object):
+
+    """Observes how long the with block took, also if it raised."""
+
+    def __init__(self, name, labels, registry=None):
+        self.name = name
+        self.labels = labels
+        self.registry = registry or METRICS
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.registry.observe(self.name, self.labels,
+                              time.time() - self.start)
+        return False
+
+
+def write_file(path, registry=None, host_labels=None):
+    registry = registry or METRICS
+    temppath = path + '.tmp'
+    try:
+        filehandler = open(temppath, 'w')
+        try:
+            filehandler.write(registry.render(host_labels))
+        finally:
+            filehandler.close()
+        os.rename(temppath, path)
+    except (IOError, OSError) as exception:
+        log.warning("Failed to write the metrics to %s: %s"
+                    % (path, exception))
+        return False
+    return True
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError as exception:
+        if exception.errno != errno.ENOENT:
+            log.warning("Failed to remove the metrics in %s: %s"
+                        % (path, exception))
+
+
+class Exporter(object):
+
+    """Writes the metrics of this process to a file until it is stopped."""
+
+    def __init__(self, path, host_labels=None, interval=EXPORT_INTERVAL_S,
+                 registry=None):
+        self.path = path
+        self.host_labels = host_labels
+        self.interval = interval
+        self.registry = registry or METRICS
+        # Held while writing, so that no write recreates a removed file
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def start(self):
+        exporter = threading.Thread(target=self._run)
+        exporter.daemon = True
+        exporter.start()
+
+    def stop(self, remove=False):
+        """ remove deletes the file, for the metrics of a process that
+            exits not to be read anymore """
+        self._lock.acquire()
+        try:
+            self._stopped.set()
+            if remove:
+                remove_file(self.path)
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while True:
+            self._lock.acquire()
+            try:
+                if self._stopped.is_set():
+                    return
+                write_file(self.path, self.registry, self.host_labels)
+            finally:
+                self._lock.release()
+            self._stopped.wait(self.interval)
+
+
+def start_exporter(path, host_labels=None, interval=EXPORT_INTERVAL_S):
+    """ Writes the metrics of this process to path every interval """
+    exporter = Exporter(path, host_labels, interval)
+    exporter.start()
+    return exporter
+
+
+def _read_file(filename, families):
+    """ Adds the series of the file to families, which maps the name of a
+        metric to its TYPE line, its series lines in order and their
+        names with labels """
+    name = None
+    filehandler = open(filename, 'r')
+    try:
+        for line in filehandler:
+            line = line.rstrip('\n')
+            if line.startswith('# TYPE '):
+                name = line.split()[2]
+                families.setdefault(name, (line, [], set()))
+            elif line and not line.startswith('#') and name:
+                # A series that several files have is reported once
+                series = line.rsplit(' ', 1)[0]
+                if series not in families[name][2]:
+                    families[name][2].add(series)
+                    families[name][1].append(line)
+    finally:
+        filehandler.close()
+
+
+def read_files(path=METRICS_PATH, vmuuid=None):
+    """ Returns the metrics written by the monitor processes of this host,
+        merged per metric, only those of a VM if vmuuid is given """
+    families = {}
+    now = time.time()
+    for filename in sorted(glob.glob(path) + glob.glob(path + '.*')):
+        if filename.endswith('.tmp'):
+            continue
+        try:
+            if now - os.path.getmtime(filename) > STALE_AFTER_S:
+                continue
+            _read_file(filename, families)
+        except (IOError, OSError):
+            # Removed by a process that exited meanwhile
+            continue
+    lines = []
+    for name in sorted(families.keys()):
+        typeline, samples, _ = families[name]
+        if vmuuid:
+            samples = [line for line in samples
+                       if 'vm="%s"' % (vmuuid) in line]
+        if samples:
+            lines.append(typeline)
+            lines.extend(samples)
+    if not lines:
+        return ""
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,55 @@
+import json
+import unittest
+
+from xscontainer.util import json_stream
+
+CONTAINERS = [{"Id": "8dfafdbc3a40", "Names": ["/web"],
+               "Status": "Up 3 hours", "Command": "echo '{'"},
+              {"Id": "9cd87474be90", "Names": ["/db"], "SizeRw": 12288,
+               "Labels": {"com.example": "}{"}}]
+
+
+def _feed_in_pieces(decoder, data, size):
+    values = []
+    for index in range(0, len(data), size):
+        values.extend(decoder.feed(data[index:index + size]))
+    values.extend(decoder.close())
+    return values
+
+
+class TestJsonStreamDecoder(unittest.TestCase):
+
+    def test_array_in_pieces(self):
+        data = json.dumps(CONTAINERS)
+        for size in [1, 2, 7, 64, len(data)]:
+            decoder = json_stream.JsonStreamDecoder(array=True)
+            self.assertEqual(_feed_in_pieces(decoder, data, size),
+                             CONTAINERS)
+
+    def test_empty_array(self):
+        decoder = json_stream.JsonStreamDecoder(array=True)
+        self.assertEqual(_feed_in_pieces(decoder, ' [ ]\n', 1), [])
+
+    def test_array_of_numbers_across_pieces(self):
+        decoder = json_stream.JsonStreamDecoder(array=True)
+        self.assertEqual(_feed_in_pieces(decoder, '[12,345]', 2), [12, 345])
+
+    def test_concatenated_values(self):
+        data = "\n".join(json.dumps(value) for value in CONTAINERS) + "\n"
+        decoder = json_stream.JsonStreamDecoder()
+        self.assertEqual(_feed_in_pieces(decoder, data, 3), CONTAINERS)
+
+    def test_truncated_array(self):
+        decoder = json_stream.JsonStreamDecoder(array=True)
+        decoder.feed(json.dumps(CONTAINERS)[:-10])
+        self.assertRaises(json_stream.JsonStreamException, decoder.close)
+
+    def test_not_an_array(self):
+        decoder = json_stream.JsonStreamDecoder(array=True)
+        self.assertRaises(json_stream.JsonStreamException, decoder.feed,
+                          '{"message": "page not found"}')
+
+    def test_value_size_is_limited(self):
+        decoder = json_stream.JsonStreamDecoder(max_value_size=10)
+        self.assertRaises(json_stream.JsonStreamException, decoder.feed,
+                          '{"Id": "' + 'a' * 20)
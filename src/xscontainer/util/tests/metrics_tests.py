@@ -0,0 +1,124 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from xscontainer.util import metrics
+
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def test_render(self):
+        registry = metrics.MetricsRegistry()
+        registry.inc('events_total', {'vm': 'a'})
+        registry.inc('events_total', {'vm': 'a'}, 2)
+        registry.set('queued', {}, 4)
+        registry.observe('request_seconds', {'vm': 'a'}, 0.02)
+        registry.observe('request_seconds', {'vm': 'a'}, 60)
+
+        lines = registry.render().splitlines()
+
+        self.assertTrue('# TYPE events_total counter' in lines)
+        self.assertTrue('events_total{vm="a"} 3' in lines)
+        self.assertTrue('queued 4' in lines)
+        self.assertTrue('request_seconds_bucket{vm="a",le="0.01"} 0' in lines)
+        self.assertTrue('request_seconds_bucket{vm="a",le="0.025"} 1'
+                        in lines)
+        self.assertTrue('request_seconds_bucket{vm="a",le="30.0"} 1' in lines)
+        self.assertTrue('request_seconds_bucket{vm="a",le="+Inf"} 2' in lines)
+        self.assertTrue('request_seconds_count{vm="a"} 2' in lines)
+
+    def test_collectors_and_remove(self):
+        registry = metrics.MetricsRegistry()
+        registry.touch('since_refresh', {'vm': 'a'})
+        registry.inc('events_total', {'vm': 'b'})
+        registry.add_collector(lambda: [('vms', metrics.GAUGE, {}, 1)])
+
+        registry.remove(vm='a')
+
+        rendered = registry.render()
+        self.assertTrue('since_refresh{' not in rendered)
+        self.assertTrue('events_total{vm="b"} 1' in rendered)
+        self.assertTrue('vms 1' in rendered)
+        self.assertEqual(registry.get_value('events_total', vm='b'), 1)
+
+    def test_host_labels(self):
+        registry = metrics.MetricsRegistry()
+        registry.inc('events_total', {'vm': 'a'})
+        registry.inc('writes_total', {'result': 'failed'})
+        registry.set('vms', {}, 1)
+
+        lines = registry.render({'shard': 2}).splitlines()
+
+        self.assertTrue('events_total{vm="a"} 1' in lines)
+        self.assertTrue('writes_total{result="failed",shard="2"} 1' in lines)
+        self.assertTrue('vms{shard="2"} 1' in lines)
+
+
+class TestMetricsFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'monitor.prom')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_files_of_all_processes_are_read(self):
+        registry = metrics.MetricsRegistry()
+        registry.inc('events_total', {'vm': 'a'})
+        self.assertTrue(metrics.write_file(self.path, registry))
+        registry = metrics.MetricsRegistry()
+        registry.inc('events_total', {'vm': 'b'})
+        metrics.write_file(self.path + '.1', registry)
+
+        self.assertEqual(metrics.read_files(self.path).count('events_total{'),
+                         2)
+        self.assertEqual(metrics.read_files(self.path, 'b'),
+                         '# TYPE events_total counter\n'
+                         'events_total{vm="b"} 1\n')
+
+    def test_files_are_merged_per_metric(self):
+        for shard in range(2):
+            registry = metrics.MetricsRegistry()
+            registry.set('vms', {}, shard)
+            registry.observe('request_seconds', {'vm': 'a'}, 0.02)
+            metrics.write_file('%s.%d' % (self.path, shard), registry,
+                               {'shard': shard})
+
+        lines = metrics.read_files(self.path).splitlines()
+
+        self.assertEqual(lines.count('# TYPE vms gauge'), 1)
+        self.assertEqual(lines.count('# TYPE request_seconds histogram'), 1)
+        self.assertTrue('vms{shard="0"} 0' in lines)
+        self.assertTrue('vms{shard="1"} 1' in lines)
+        self.assertEqual(lines.count('request_seconds_count{vm="a"} 1'), 1)
+        buckets = [line for line in lines
+                   if line.startswith('request_seconds_bucket')]
+        self.assertTrue(buckets[-1].startswith(
+            'request_seconds_bucket{vm="a",le="+Inf"}'))
+
+    def test_stale_files_are_not_read(self):
+        registry = metrics.MetricsRegistry()
+        registry.set('vms', {}, 1)
+        metrics.write_file(self.path + '.3', registry, {'shard': 3})
+        stale = time.time() - metrics.STALE_AFTER_S - 1
+        os.utime(self.path + '.3', (stale, stale))
+
+        self.assertEqual(metrics.read_files(self.path), '')
+
+    def test_stopped_exporter_removes_its_file(self):
+        registry = metrics.MetricsRegistry()
+        registry.set('vms', {}, 1)
+        exporter = metrics.Exporter(self.path, registry=registry)
+        exporter.start()
+        for _ in range(100):
+            if os.path.exists(self.path):
+                break
+            time.sleep(0.01)
+        self.assertTrue(os.path.exists(self.path))
+
+        exporter.stop(remove=True)
+
+        self.assertFalse(os.path.exists(self.path))
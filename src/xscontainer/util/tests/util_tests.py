@@ -1,6 +1,8 @@
 import unittest
 import json
 import os
+import socket
+import time
 
 
 import xscontainer.util as util
@@ -32,3 +34,24 @@ class TestUtil(unittest.TestCase):
 
         print(xmloutput)
         self.assertEqual(xmloutput, expected_xml)
+
+
+class TestProbeConnections(unittest.TestCase):
+
+    def test_first_listening_address_wins(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        port = listener.getsockname()[1]
+        closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        closed.bind(('127.0.0.2', 0))
+        try:
+            start = time.time()
+            addresses = list(util.probe_connections(
+                ['127.0.0.2', '127.0.0.1'], port, timeout=5))
+            self.assertEqual(addresses, ['127.0.0.1'])
+            # The refused address mustn't hold up the result
+            self.assertTrue(time.time() - start < 2)
+        finally:
+            closed.close()
+            listener.close()
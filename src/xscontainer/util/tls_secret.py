@@ -66,29 +66,39 @@ def set_for_vm(session, vm_uuid, client_cert_content,
     api_helper.update_vm_other_config(session, vm_uuid, content)
 
 
-def export_for_vm(session, vm_uuid):
-    other_config = api_helper.get_vm_other_config(session, vm_uuid)
-    secretdict = {}
-    for key, value in other_config.items():
-        if key in XSCONTAINER_TLS_KEYS:
-            secret_uuid = value
-            secret_ref = session.xenapi.secret.get_by_uuid(secret_uuid)
-            secret_record = session.xenapi.secret.get_record(secret_ref)
-            secretdict[key] = secret_record['value']
+def get_secret_uuids(other_config):
+    """ Returns the uuids of the TLS secrets in the other_config of a VM,
+        keyed by the names in XSCONTAINER_TLS_KEYS """
+    secret_uuids = {}
+    for key in XSCONTAINER_TLS_KEYS:
+        if key in other_config:
+            secret_uuids[key] = other_config[key]
+    return secret_uuids
+
+
+def get_secret_uuids_for_vm(session, vm_uuid):
+    return get_secret_uuids(api_helper.get_vm_other_config(session, vm_uuid))
+
+
+def export_for_vm(session, vm_uuid, secret_uuids=None):
+    if secret_uuids is None:
+        secret_uuids = get_secret_uuids_for_vm(session, vm_uuid)
+    values = api_helper.get_secret_values(session, secret_uuids.values())
+    secretdict = dict((key, values[secret_uuid])
+                      for (key, secret_uuid) in secret_uuids.items())
     temptlspaths = _get_temptlspaths(vm_uuid)
-    if util.file_old_or_none_existent(temptlspaths['client_cert']):
-        if not os.path.exists(temptlspaths['parent']):
-            os.makedirs(temptlspaths['parent'])
-        os.chmod(temptlspaths['parent'], 0o600)
-        util.write_file(
-            temptlspaths['client_cert'],
-            secretdict[XSCONTAINER_TLS_CLIENT_CERT])
-        util.write_file(
-            temptlspaths['client_key'],
-            secretdict[XSCONTAINER_TLS_CLIENT_KEY])
-        util.write_file(
-            temptlspaths['ca_cert'],
-            secretdict[XSCONTAINER_TLS_CA_CERT])
+    if not os.path.exists(temptlspaths['parent']):
+        os.makedirs(temptlspaths['parent'])
+    os.chmod(temptlspaths['parent'], 0o600)
+    util.write_file(
+        temptlspaths['client_cert'],
+        secretdict[XSCONTAINER_TLS_CLIENT_CERT])
+    util.write_file(
+        temptlspaths['client_key'],
+        secretdict[XSCONTAINER_TLS_CLIENT_KEY])
+    util.write_file(
+        temptlspaths['ca_cert'],
+        secretdict[XSCONTAINER_TLS_CA_CERT])
     return temptlspaths
 
 